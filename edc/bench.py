@@ -0,0 +1,267 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+bench.py : offline benchmark of the ingest pipeline
+
+A synthetic feed is built in a scratch energy-dashboard directory by
+replicating the test zips ('test/testdata/zip') with every date shifted,
+so each copy holds distinct resources. Each step then runs as a separate
+`edc` process, exactly as a user would run it, and is measured with
+wait4(): wall time, cpu time and peak RSS of the step and its children.
+
+The 'restore' step restores the newest archive: the tar file, or with
+'--incremental' in the archive args, the newest snapshot manifest.
+
+Results can be saved as a baseline json file and compared against later.
+"""
+
+from edl.cli import feed as clifeed
+from edl.resources import log
+from edc import metrics
+from edc import snapshot
+from edc import stages as edcstages
+import datetime
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import zipfile
+
+FEED        = "bench-feed"
+STEPS       = ['unzip', 'parse', 'insert', 'status', 'archive', 'restore']
+# only in a source checkout, the test data is not installed with edc
+TESTDATA    = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'testdata', 'zip')
+DATE_ISO    = re.compile(rb'(?<!\d)(\d{4})-(\d{2})-(\d{2})(?!\d)')
+DATE_PACKED = re.compile(rb'(?<!\d)(20\d{2})(\d{2})(\d{2})(?!\d)')
+
+def shift_dates(data, days):
+    """
+    Shift every YYYY-MM-DD and 20YYMMDD date in data (bytes) by 'days'.
+    """
+    def iso(m):
+        d = datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3))) + datetime.timedelta(days=days)
+        return d.strftime("%Y-%m-%d").encode('ascii')
+    def packed(m):
+        try:
+            d = datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            return m.group(0)
+        return (d + datetime.timedelta(days=days)).strftime("%Y%m%d").encode('ascii')
+    return DATE_PACKED.sub(packed, DATE_ISO.sub(iso, data))
+
+def build_feed(logger, ed_path, testdata, copies):
+    """
+    Create the synthetic feed with 'copies' shifted copies of the test
+    zips. Returns (zip count, total zip bytes).
+    """
+    chlogger    = logger.getChild(__name__)
+    clifeed.create(chlogger, ed_path, FEED, "bench", "bench", "bench@localhost",
+            "http://localhost/_START__END_.zip", [2019, 1, 1], 0)
+    zip_dir     = os.path.join(ed_path, 'data', FEED, 'zip')
+    os.makedirs(zip_dir, exist_ok=True)
+    sources     = sorted([f for f in os.listdir(testdata) if f.endswith(".zip")])
+    span        = len(sources)
+    count       = 0
+    size        = 0
+    with open(os.path.join(zip_dir, 'state.txt'), 'w') as state:
+        for copy in range(copies):
+            days = copy * span
+            for f in sources:
+                name = shift_dates(f.encode('utf-8'), days).decode('utf-8')
+                with zipfile.ZipFile(os.path.join(testdata, f), 'r') as src, \
+                        zipfile.ZipFile(os.path.join(zip_dir, name), 'w', zipfile.ZIP_DEFLATED) as dst:
+                    for member in src.namelist():
+                        dst.writestr(shift_dates(member.encode('utf-8'), days).decode('utf-8'),
+                                shift_dates(src.read(member), days))
+                state.write("http://localhost/%s\n" % name)
+                size  += os.path.getsize(os.path.join(zip_dir, name))
+                count += 1
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "build_feed",
+        "path"      : ed_path,
+        "feed"      : FEED,
+        "copies"    : copies,
+        "zip_files" : count,
+        "zip_bytes" : size,
+        })
+    return (count, size)
+
+def edc_cmd(ed_path, args):
+    return [sys.executable, "-c", "from edc.main import cli; cli(prog_name='edc')",
+            "--ed-dir", ed_path, "--log-level", "ERROR"] + args
+
+def run_step(logger, cmd):
+    """
+    Run cmd, discarding its output. Returns (returncode, wall, cpu, rss_kb).
+    """
+    start   = time.time()
+    proc    = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr  = proc.stderr.read()
+    (_, status, ru) = os.wait4(proc.pid, 0)
+    # like subprocess: -N when killed by signal N (os.waitstatus_to_exitcode is 3.9+)
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    wall    = time.time() - start
+    if proc.returncode != 0:
+        log.error(logger, {
+            "name"      : __name__,
+            "method"    : "run_step",
+            "cmd"       : " ".join(cmd),
+            "returncode": proc.returncode,
+            "stderr"    : stderr.decode('utf-8', 'replace')[-2000:],
+            })
+    return (proc.returncode, wall, ru.ru_utime + ru.ru_stime, ru.ru_maxrss)
+
+def step_input(feed_dir, step):
+    """
+    (files, bytes) that the step works through, for throughput.
+    """
+    dirs = {'unzip': ('zip', '.zip'), 'parse': ('xml', '.xml'), 'insert': ('sql', '.sql')}
+    if step in dirs:
+        (d, ending) = dirs[step]
+        path = os.path.join(feed_dir, d)
+        files = [f for f in os.listdir(path) if f.endswith(ending)] if os.path.isdir(path) else []
+        if step == 'parse' and not files:
+            # members indexed by 'proc unzip --no-extract'
+            members = edcstages.read_members(path)
+            return (len(members), sum([e[5] for e in members.values()]))
+        return (len(files), sum([os.path.getsize(os.path.join(path, f)) for f in files]))
+    return (0, metrics.dir_size(feed_dir))
+
+def default_testdata():
+    """
+    TESTDATA, or None when edc is not run from a source checkout.
+    """
+    return TESTDATA if os.path.isdir(TESTDATA) else None
+
+def latest_archive(archive_dir):
+    """
+    The newest archive written by the 'archive' step: a snapshot manifest
+    or a tar file, or None when there is none.
+    """
+    manifests = snapshot.list_snapshots(archive_dir, FEED)
+    if manifests:
+        return manifests[-1]
+    if not os.path.isdir(archive_dir):
+        return None
+    tars = sorted([os.path.join(archive_dir, f) for f in os.listdir(archive_dir)
+        if f.startswith(FEED) and not f.endswith('.tmp')])
+    return tars[-1] if tars else None
+
+def run(logger, ed_path, testdata, copies, proc_args, archive_args):
+    """
+    Build the synthetic feed under ed_path and run the STEPS. Returns the
+    results dict: {"copies", "zip_files", "zip_bytes", "steps": {step: {...}}}.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', FEED)
+    archive_dir = os.path.join(ed_path, 'archive')
+    if os.path.exists(feed_dir):
+        shutil.rmtree(feed_dir)
+    if os.path.exists(archive_dir):
+        shutil.rmtree(archive_dir)
+    os.makedirs(os.path.join(ed_path, 'data'), exist_ok=True)
+    (zip_files, zip_bytes) = build_feed(chlogger, ed_path, testdata, copies)
+
+    results = {"copies": copies, "zip_files": zip_files, "zip_bytes": zip_bytes, "steps": {}}
+    archive = None
+    for step in STEPS:
+        (files, size) = step_input(feed_dir, step)
+        if step in ['unzip', 'parse', 'insert']:
+            cmd = edc_cmd(ed_path, ['feed', FEED, 'proc', step] + shlex.split(proc_args))
+        elif step == 'status':
+            cmd = edc_cmd(ed_path, ['feed', FEED, 'status', '--refresh', '--rows'])
+        elif step == 'archive':
+            cmd = edc_cmd(ed_path, ['feed', FEED, 'archive', '--archivedir', archive_dir] + shlex.split(archive_args))
+        else:
+            archive = latest_archive(archive_dir)
+            if archive is None:
+                log.error(chlogger, {
+                    "name"      : __name__,
+                    "method"    : "run",
+                    "archive_dir" : archive_dir,
+                    "ERROR"     : "the archive step left nothing to restore",
+                    })
+                results["steps"][step] = {"returncode": 1, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                        "peak_rss_kb": 0, "files": 0, "bytes": 0, "mb_per_second": 0.0}
+                continue
+            shutil.rmtree(feed_dir)
+            cmd = edc_cmd(ed_path, ['feed', FEED, 'restore', archive])
+        (returncode, wall, cpu, rss) = run_step(chlogger, cmd)
+        results["steps"][step] = {
+                "returncode"    : returncode,
+                "wall_seconds"  : round(wall, 3),
+                "cpu_seconds"   : round(cpu, 3),
+                "peak_rss_kb"   : rss,
+                "files"         : files,
+                "bytes"         : size,
+                "mb_per_second" : round(size / (1024.0 * 1024.0) / wall, 3) if wall > 0 else 0.0,
+                }
+        if step in ['insert', 'restore']:
+            results["steps"][step]["rows"] = metrics.db_rows(os.path.join(feed_dir, 'db'))
+        if step == 'restore' and returncode == 0 \
+                and results["steps"][step]["rows"] != results["steps"]["insert"]["rows"]:
+            # the restored feed must hold what was inserted
+            log.error(chlogger, {
+                "name"      : __name__,
+                "method"    : "run",
+                "archive"   : archive,
+                "rows"      : results["steps"][step]["rows"],
+                "expected"  : results["steps"]["insert"]["rows"],
+                "ERROR"     : "restored db does not match the inserted db",
+                })
+            results["steps"][step]["returncode"] = 1
+    return results
+
+def report(results, baseline=None):
+    """
+    Lines of the results table, with the change in wall time against the
+    baseline results when given.
+    """
+    yield "synthetic feed: %d copies, %d zip files, %.1f MB" % (
+            results["copies"], results["zip_files"], results["zip_bytes"] / (1024.0 * 1024.0))
+    yield "%-8s %9s %9s %9s %7s %9s %9s %10s" % (
+            "step", "wall(s)", "cpu(s)", "rss(MB)", "files", "MB", "MB/s", "vs base")
+    for step in STEPS:
+        r = results["steps"].get(step)
+        if r is None:
+            continue
+        delta = ""
+        if baseline is not None and step in baseline.get("steps", {}):
+            base = baseline["steps"][step]["wall_seconds"]
+            if base > 0:
+                delta = "%+.1f%%" % ((r["wall_seconds"] - base) / base * 100.0)
+        yield "%-8s %9.2f %9.2f %9.1f %7d %9.1f %9.2f %10s%s" % (
+                step, r["wall_seconds"], r["cpu_seconds"], r["peak_rss_kb"] / 1024.0,
+                r["files"], r["bytes"] / (1024.0 * 1024.0), r["mb_per_second"], delta,
+                "" if r["returncode"] == 0 else "  FAILED (%d)" % r["returncode"])
+
+def regressions(results, baseline, tolerance):
+    """
+    Steps whose wall time is more than 'tolerance' (a fraction) slower
+    than the baseline.
+    """
+    slow = []
+    for (step, r) in results["steps"].items():
+        base = baseline.get("steps", {}).get(step)
+        if base is not None and base["wall_seconds"] > 0 \
+                and r["wall_seconds"] > base["wall_seconds"] * (1.0 + tolerance):
+            slow.append(step)
+    return slow
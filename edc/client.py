@@ -0,0 +1,87 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+client.py : `edcc`, the thin client for `edc serve`
+
+Takes the same arguments as `edc`. The argv is forwarded to the server
+listening on '$EDC_SOCKET', or '[--ed-dir]/.edc/edc.sock', and its output
+and exit status are passed through. When no server is listening, the
+command runs in-process, exactly like `edc`.
+
+Only stdlib modules are imported before connecting, so a request costs
+little more than interpreter start up.
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+
+SOCKET_FILE = os.path.join(".edc", "edc.sock")
+HEADER      = struct.Struct(">cI")
+
+def socket_path(argv):
+    if os.environ.get("EDC_SOCKET"):
+        return os.environ["EDC_SOCKET"]
+    ed_dir = os.path.curdir
+    if '--ed-dir' in argv[:-1]:
+        ed_dir = argv[argv.index('--ed-dir') + 1]
+    return os.path.join(os.path.abspath(os.path.expanduser(ed_dir)), SOCKET_FILE)
+
+def recv_exact(sock, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError("connection closed")
+        buf += chunk
+    return buf
+
+def request(path, argv):
+    """
+    Run argv on the server at path. Returns the exit status, or None if
+    no server is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    with sock:
+        sock.sendall(("%s\n" % json.dumps({"argv": argv, "cwd": os.getcwd()})).encode('utf-8'))
+        out = {b'o': sys.stdout.buffer, b'e': sys.stderr.buffer}
+        while True:
+            try:
+                (channel, size) = HEADER.unpack(recv_exact(sock, HEADER.size))
+                payload = recv_exact(sock, size)
+            except EOFError:
+                sys.stderr.write("edcc: server closed the connection\n")
+                return 1
+            if channel == b'x':
+                return int(payload.decode('ascii'))
+            out[channel].write(payload)
+            out[channel].flush()
+
+def main():
+    argv    = sys.argv[1:]
+    status  = request(socket_path(argv), argv)
+    if status is None:
+        from edc.main import cli
+        cli(args=argv, prog_name='edc')
+    sys.exit(status)
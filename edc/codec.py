@@ -0,0 +1,305 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+codec.py : selectable compression for feed archives and dist artifacts
+
+Supported codecs:
+
+    gzip : stdlib, single threaded (the default, compatible with the
+           existing tar.gz archives and .db.gz artifacts)
+    xz   : stdlib lzma, single threaded
+    zstd : multi-threaded, requires the optional 'zstandard' package
+
+Compressed files are recognized by their magic bytes, so restoring never
+needs to be told which codec was used. Compressed output does not embed a
+timestamp, so compressing the same file twice gives the same bytes.
+"""
+
+from edl.resources import filesystem
+from edl.resources import log
+from edc import statusindex
+import gzip
+import json
+import lzma
+import os
+import shutil
+import tarfile
+
+CHUNK_SIZE  = 1 << 20
+CODECS      = ['gzip', 'zstd', 'xz']
+EXTENSIONS  = {'gzip': '.gz', 'zstd': '.zst', 'xz': '.xz'}
+MAGIC       = [
+        (b'\x1f\x8b', 'gzip'),
+        (b'\x28\xb5\x2f\xfd', 'zstd'),
+        (b'\xfd7zXZ\x00', 'xz'),
+        ]
+DEFAULT_LEVEL = {'gzip': 6, 'zstd': 3, 'xz': 6}
+DIST_FILE   = "dist.json"
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("the zstd codec requires the 'zstandard' package: pip install zstandard")
+    return zstandard
+
+def detect(path):
+    """
+    Return the codec of the compressed file at path, or None.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for (magic, codec) in MAGIC:
+        if head.startswith(magic):
+            return codec
+    return None
+
+def open_writer(fileobj, codec, level=None, threads=1):
+    """
+    Wrap the binary fileobj in a compressing writer. Closing the writer
+    flushes the compressed stream but leaves fileobj open.
+    """
+    level = DEFAULT_LEVEL[codec] if level is None else level
+    if codec == 'gzip':
+        return gzip.GzipFile(filename='', fileobj=fileobj, mode='wb', compresslevel=level, mtime=0)
+    if codec == 'xz':
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+    if codec == 'zstd':
+        cctx = _zstandard().ZstdCompressor(level=level, threads=threads)
+        return cctx.stream_writer(fileobj, closefd=False)
+    raise ValueError("unknown codec: %s" % codec)
+
+def open_reader(fileobj, codec):
+    """
+    Wrap the binary fileobj in a decompressing reader.
+    """
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if codec == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+    if codec == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    raise ValueError("unknown codec: %s" % codec)
+
+def compress_file(src, dst, codec, level=None, threads=1):
+    """
+    Compress src to dst, going through a temporary file so that dst is
+    never left half written.
+    """
+    tmp = "%s.tmp" % dst
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        with open_writer(fout, codec, level, threads) as writer:
+            shutil.copyfileobj(fin, writer, CHUNK_SIZE)
+    os.replace(tmp, dst)
+    return dst
+
+def decompress_file(src, dst):
+    """
+    Decompress src to dst, detecting the codec.
+    """
+    codec = detect(src)
+    if codec is None:
+        raise ValueError("not a compressed file: %s" % src)
+    tmp = "%s.tmp" % dst
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        with open_reader(fin, codec) as reader:
+            shutil.copyfileobj(reader, fout, CHUNK_SIZE)
+    os.replace(tmp, dst)
+    return dst
+
+def archive(logger, feed, ed_path, archivedir, codec, level=None, threads=1):
+    """
+    Same as `clifeed.archive_locally`, with a selectable codec. Writes
+    '[archivedir]/[feed].tar.[ext]' and returns its path.
+    """
+    chlogger    = logger.getChild(__name__)
+    archivedir  = os.path.expanduser(archivedir)
+    if not archivedir.startswith("/"):
+        archivedir = os.path.join(ed_path, archivedir)
+    root_dir    = os.path.join(ed_path, 'data', feed)
+    target      = os.path.join(archivedir, "%s.tar%s" % (feed, EXTENSIONS[codec]))
+    log.debug(chlogger, {
+        "name"      : __name__,
+        "method"    : "archive",
+        "path"      : ed_path,
+        "feed"      : feed,
+        "archive"   : target,
+        "codec"     : codec,
+        "level"     : level,
+        "threads"   : threads,
+        })
+    tmp         = "%s.tmp" % target
+    try:
+        os.makedirs(archivedir, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            with open_writer(f, codec, level, threads) as writer:
+                with tarfile.open(fileobj=writer, mode='w|') as tf:
+                    tf.add(root_dir, arcname='.')
+        os.replace(tmp, target)
+        return target
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        log.critical(chlogger, {
+            "name"      : __name__,
+            "method"    : "archive",
+            "path"      : ed_path,
+            "feed"      : feed,
+            "archive"   : target,
+            "codec"     : codec,
+            "ERROR"     : "make archive failed",
+            "exception" : str(e),
+            })
+
+def restore(logger, feed, ed_path, archive):
+    """
+    Same as `clifeed.restore_locally`, for a tar archive compressed with
+    any of the CODECS.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    codec       = detect(archive)
+    if os.path.exists(feed_dir):
+        log.critical(chlogger, {
+            "name"      : __name__,
+            "method"    : "restore",
+            "path"      : ed_path,
+            "feed"      : feed,
+            "archive"   : archive,
+            "feed_dir"  : feed_dir,
+            "ERROR"     : "Must delete the feed_dir before restoring."
+            })
+    try:
+        with open(archive, 'rb') as f:
+            if codec is None:
+                tf = tarfile.open(fileobj=f, mode='r|')
+            else:
+                tf = tarfile.open(fileobj=open_reader(f, codec), mode='r|')
+            with tf:
+                tf.extractall(feed_dir)
+        return feed_dir
+    except Exception as e:
+        log.critical(chlogger, {
+            "name"      : __name__,
+            "method"    : "restore",
+            "path"      : ed_path,
+            "feed"      : feed,
+            "archive"   : archive,
+            "codec"     : codec,
+            "feed_dir"  : feed_dir,
+            "ERROR"     : "Failed to restore archive to feed_dir",
+            "exception" : str(e),
+            })
+
+def dist_file(feed, ed_path):
+    return os.path.join(statusindex.sidecar_dir(feed, ed_path), DIST_FILE)
+
+def load_dist(feed, ed_path):
+    try:
+        with open(dist_file(feed, ed_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_dist(feed, ed_path, built):
+    os.makedirs(statusindex.sidecar_dir(feed, ed_path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (dist_file(feed, ed_path), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(built, f, indent=4, sort_keys=True)
+    os.replace(tmp, dist_file(feed, ed_path))
+
+def edc_dist(feed, ed_path):
+    """
+    True when the feed's ./dist is built by `dist`, which then also runs
+    its 'arch' stage (see `edc.transfer.arch`), so that ./dist is kept.
+    """
+    return os.path.exists(dist_file(feed, ed_path))
+
+def source_stamp(path, codec, level):
+    st = os.stat(path)
+    return "%d %d %s %s" % (st.st_size, st.st_mtime_ns, codec, level)
+
+def dist(logger, feed, ed_path, codec, level=None, threads=1):
+    """
+    Build the feed's ./dist directory, like the feed's './src/60_dist.sh',
+    compressing the databases with the selected codec. Yields the name of
+    each file written.
+
+    Unlike the script, ./dist is updated in place: a file is only copied
+    or compressed again when the size or mtime of its source (or the
+    codec) changed since the last dist, as recorded in
+    '[feed]/.edc/dist.json', and files whose source is gone are removed.
+    For a sharded feed (see `edc.shards`) only the shards written to since
+    are recompressed; the others keep their bytes, so 's3archive' skips
+    them. The feed's './src/70_arch.py' deletes ./dist after archiving,
+    so once edc has built it, 'arch' is run by edc and keeps ./dist.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    zip_dir     = os.path.join(feed_dir, 'zip')
+    db_dir      = os.path.join(feed_dir, 'db')
+    dist_dir    = os.path.join(feed_dir, 'dist')
+    built       = load_dist(feed, ed_path)
+    """built : map : file (relative to dist_dir) -> stamp of its source"""
+    os.makedirs(os.path.join(dist_dir, 'zip'), exist_ok=True)
+    os.makedirs(os.path.join(dist_dir, 'db'), exist_ok=True)
+    wanted      = []
+    # sources that do not exist (yet) are skipped, e.g. a feed with no
+    # downloads has no zip/state.txt
+    zips        = sorted(filesystem.glob_dir(zip_dir, ".zip")) if os.path.isdir(zip_dir) else []
+    for f in zips + ['state.txt']:
+        if os.path.exists(os.path.join(zip_dir, f)):
+            wanted.append((os.path.join('zip', f), os.path.join(zip_dir, f), None))
+    dbs         = sorted(filesystem.glob_dir(db_dir, ".db")) if os.path.isdir(db_dir) else []
+    for f in dbs:
+        wanted.append((os.path.join('db', "%s%s" % (f, EXTENSIONS[codec])), os.path.join(db_dir, f), codec))
+    keep        = set([name for (name, _, _) in wanted])
+    unchanged   = 0
+    try:
+        for sub in ['zip', 'db']:
+            for f in os.listdir(os.path.join(dist_dir, sub)):
+                name = os.path.join(sub, f)
+                if name not in keep:
+                    os.chmod(os.path.join(dist_dir, name), 0o644)
+                    os.remove(os.path.join(dist_dir, name))
+                    built.pop(name, None)
+        for (name, src, file_codec) in wanted:
+            target  = os.path.join(dist_dir, name)
+            stamp   = source_stamp(src, file_codec, level)
+            if built.get(name) == stamp and os.path.exists(target):
+                unchanged += 1
+                continue
+            if os.path.exists(target):
+                os.chmod(target, 0o644)
+            if file_codec is None:
+                shutil.copyfile(src, target)
+            else:
+                compress_file(src, target, file_codec, level, threads)
+            built[name] = stamp
+            yield name
+    finally:
+        save_dist(feed, ed_path, built)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "dist",
+        "path"      : ed_path,
+        "feed"      : feed,
+        "codec"     : codec,
+        "level"     : level,
+        "threads"   : threads,
+        "unchanged" : unchanged,
+        })
@@ -0,0 +1,282 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+download.py : concurrent download stage with adaptive rate control
+
+Downloads the same urls as the feed's '10_down.py' (one per day from the
+manifest's 'start_date' to today) into './zip', and appends each url to
+'./zip/state.txt' as its file completes. Instead of sleeping the
+manifest's fixed 'download_delay_secs' between requests, requests share a
+pooled http session and each host gets a RateController:
+
+    * at most 'limit' requests are in flight, and request starts are at
+      least 'delay' seconds apart
+    * a 429 or 5xx response (or a connection error) halves 'limit',
+      doubles 'delay' (to at least BACKOFF seconds) and pauses the host
+      for 'delay', or for as long as a Retry-After header asks
+    * every successful response grows 'limit' by 1/limit, up to the
+      configured concurrency, and halves 'delay', down to the configured
+      minimum
+
+so a backfill runs as fast as the server allows and backs off when it
+pushes back. Files are written to '[file].part' first; an interrupted
+download resumes from the size of its '.part' with a Range request.
+"""
+
+from edl.resources import filesystem
+from edl.resources import log
+from edl.resources import time as xtime
+from edl.resources import web
+from edc import statestore
+from stat import S_IREAD, S_IRGRP, S_IROTH
+from urllib.parse import urlparse
+import concurrent.futures
+import datetime
+import email.utils
+import json
+import os
+import requests
+import threading
+import time
+
+CHUNK_SIZE      = 1 << 16
+RETRY_STATUS    = [429, 500, 502, 503, 504]
+TIMEOUT         = 60
+BACKOFF         = 0.5
+
+class RateController():
+    """
+    Additive increase, multiplicative decrease of the concurrency and
+    pacing of the requests to one host.
+    """
+    def __init__(self, concurrency, min_delay, max_delay):
+        self.max_limit  = max(1, concurrency)
+        self.limit      = float(self.max_limit)
+        self.min_delay  = min_delay
+        self.max_delay  = max(max_delay, min_delay)
+        self.delay      = min_delay
+        self.in_flight  = 0
+        self.next_start = 0.0
+        self.cond       = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.in_flight < int(self.limit) and now >= self.next_start:
+                    self.in_flight  += 1
+                    self.next_start = now + self.delay
+                    return
+                wait = max(0.0, self.next_start - now) if self.in_flight < int(self.limit) else None
+                self.cond.wait(wait)
+
+    def release(self, ok, retry_after=None):
+        with self.cond:
+            self.in_flight -= 1
+            if ok:
+                self.limit  = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                self.delay  = max(self.min_delay, self.delay / 2.0)
+            else:
+                self.limit  = max(1.0, self.limit / 2.0)
+                self.delay  = min(self.max_delay, max(self.delay * 2.0, BACKOFF))
+                pause       = max(self.delay, min(self.max_delay, retry_after or 0.0))
+                self.next_start = max(self.next_start, time.time() + pause)
+            self.cond.notify_all()
+
+    def state(self):
+        with self.cond:
+            return (int(self.limit), round(self.delay, 3))
+
+def retry_after(headers):
+    """
+    Seconds from a Retry-After header (delta seconds or http date), or None.
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def manifest_urls(logger, feed, ed_path):
+    """
+    The urls that the feed's '10_down.py' would download.
+    """
+    with open(os.path.join(ed_path, 'data', feed, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    start_date  = datetime.date(*manifest['start_date'])
+    dates       = xtime.range_pairs(xtime.day_range_to_today(start_date))
+    return list(web.generate_urls(logger, dates, manifest['url']))
+
+class Downloader():
+    def __init__(self, logger, download_dir, concurrency, min_delay, max_delay, retries):
+        self.logger         = logger
+        self.download_dir   = download_dir
+        self.concurrency    = max(1, concurrency)
+        self.min_delay      = min_delay
+        self.max_delay      = max_delay
+        self.retries        = retries
+        self.controllers    = {}
+        self.lock           = threading.Lock()
+        self.session        = requests.Session()
+        adapter             = requests.adapters.HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def controller(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.controllers:
+                self.controllers[host] = RateController(self.concurrency, self.min_delay, self.max_delay)
+            return self.controllers[host]
+
+    def attempt(self, url, target):
+        """
+        One request for url. Returns (done, retryable, retry_after, detail).
+        """
+        part    = "%s.part" % target
+        offset  = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+            if r.status_code in RETRY_STATUS:
+                return (False, True, retry_after(r.headers), "status %d" % r.status_code)
+            if r.status_code == 416 and offset > 0:
+                # the .part already holds the whole file
+                os.replace(part, target)
+                return (True, False, None, "resumed, complete")
+            if r.status_code not in (200, 206):
+                return (False, False, None, "status %d" % r.status_code)
+            mode = 'ab' if r.status_code == 206 else 'wb'
+            with open(part, mode) as fd:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    fd.write(chunk)
+            expected = r.headers.get('Content-Length')
+            written  = os.path.getsize(part) - (offset if mode == 'ab' else 0)
+            if expected is not None and written < int(expected):
+                return (False, True, None, "short read, %d of %s bytes" % (written, expected))
+            os.replace(part, target)
+            return (True, False, None, "resumed from %d" % offset if mode == 'ab' else "downloaded")
+
+    def fetch(self, url):
+        """
+        Download url, retrying up to self.retries times. Returns
+        (url, ok, detail).
+        """
+        target  = os.path.join(self.download_dir, filesystem.url2filename(url, ending=".zip"))
+        rc      = self.controller(url)
+        detail  = None
+        for tries in range(self.retries + 1):
+            rc.acquire()
+            (done, retryable, wait) = (False, True, None)
+            try:
+                (done, retryable, wait, detail) = self.attempt(url, target)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                detail = str(e)
+            finally:
+                rc.release(done or not retryable, wait)
+            if done:
+                os.chmod(target, S_IREAD|S_IRGRP|S_IROTH)
+                return (url, True, detail)
+            (limit, delay) = rc.state()
+            log.warning(self.logger, {
+                "name"      : __name__,
+                "method"    : "Downloader.fetch",
+                "url"       : url,
+                "try"       : tries + 1,
+                "detail"    : detail,
+                "retry"     : retryable,
+                "limit"     : limit,
+                "delay"     : delay,
+                })
+            if not retryable:
+                break
+        return (url, False, detail)
+
+def download(logger, feed, ed_path, concurrency, min_delay=0.0, max_delay=60.0, retries=5, urls=None):
+    """
+    Download the feed's new urls (or 'urls') into './zip'. Each url is
+    recorded for the download stage (in './zip/state.txt', see
+    `edc.statestore`) as soon as its file is complete.
+
+    Yields the name of each file downloaded.
+    """
+    chlogger    = logger.getChild(__name__)
+    zip_dir     = os.path.join(ed_path, 'data', feed, 'zip')
+    os.makedirs(zip_dir, exist_ok=True)
+    if urls is None:
+        urls = manifest_urls(chlogger, feed, ed_path)
+    store   = statestore.StateStore(feed, ed_path)
+    done    = 0
+    todo    = []
+    found   = []
+    for url in urls:
+        if store.contains('download', url):
+            done += 1
+            continue
+        if os.path.exists(os.path.join(zip_dir, filesystem.url2filename(url, ending=".zip"))):
+            # on disk but not recorded, like `web.download`
+            found.append(url)
+            continue
+        todo.append(url)
+    filename = lambda url: filesystem.url2filename(url, ending=".zip")
+    if found:
+        store.record('download', found, zip_dir, filename=filename)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "download",
+        "feed"      : feed,
+        "urls"      : len(urls),
+        "recorded"  : done,
+        "found"     : len(found),
+        "todo"      : len(todo),
+        "concurrency": concurrency,
+        })
+    downloader  = Downloader(chlogger, zip_dir, concurrency, min_delay, max_delay, retries)
+    status      = {'downloaded': 0, 'error': 0}
+    start       = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool, store:
+        futures = [pool.submit(downloader.fetch, url) for url in todo]
+        for future in concurrent.futures.as_completed(futures):
+            (url, ok, detail) = future.result()
+            if not ok:
+                status['error'] += 1
+                log.error(chlogger, {
+                    "name"      : __name__,
+                    "method"    : "download",
+                    "feed"      : feed,
+                    "url"       : url,
+                    "ERROR"     : "http_request_failed",
+                    "detail"    : detail,
+                    })
+                continue
+            status['downloaded'] += 1
+            store.record('download', [url], zip_dir, filename=filename)
+            yield filename(url)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "download",
+        "feed"      : feed,
+        "downloaded": status['downloaded'],
+        "error"     : status['error'],
+        "seconds"   : round(time.time() - start, 3),
+        "hosts"     : dict([(h, c.state()) for (h, c) in downloader.controllers.items()]),
+        })
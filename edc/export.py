@@ -0,0 +1,338 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+export.py : columnar (Parquet) export of the feed databases
+
+Reading a whole OASIS table into pandas row by row through sqlite3 is slow
+and takes a lot of memory. The 'export' stage writes every table of the
+feed's databases (all shards and depths) to a Parquet dataset in
+'[feed]/parquet', partitioned by day:
+
+    parquet/[table]/partition_date=2019-09-01/part-0.parquet
+    parquet/[table]/_metadata
+    parquet/manifest.json
+
+The day is the date prefix of the table's date column: 'opr_date' when
+the table has one, otherwise the first time column (see
+`edc.indexes.TIME_PATTERN`) holding dates. Rows without a date go to the
+'__HIVE_DEFAULT_PARTITION__' partition, and tables without a date column
+to a single 'part-0.parquet'. Text columns other than the ids are
+dictionary encoded, so pandas loads them as categoricals.
+
+The export is incremental. 'manifest.json' records the row count and the
+largest rowid of each exported partition, and only the partitions that
+are new or where either changed are written again. An upsert (see
+`edc.upsert`) replaces a row with one of a new rowid, so a revision that
+keeps the row count still shows. A table whose columns changed is
+exported again in full. '_metadata' holds the schema and row group
+statistics of all of a table's files, so a filtered read is planned
+without opening every file:
+
+    >>> import pyarrow.dataset as ds
+    >>> d = ds.parquet_dataset('parquet/report_data/_metadata', partitioning='hive')
+    >>> d.to_table(filter=ds.field('partition_date') >= '2019-09-01').to_pandas()
+
+'pandas.read_parquet("parquet/report_data", filters=[...])' works too.
+
+Requires the optional 'pyarrow' package. The parquet directory has its
+own '.gitignore', which keeps it out of the 'git add *' done by the save
+stage.
+"""
+
+from edl.resources import log
+from edc import indexes as edcindexes
+from edc import query as edcquery
+import json
+import os
+import re
+import shutil
+import sqlite3
+import urllib.parse
+
+EXPORT_DIR      = 'parquet'
+MANIFEST_FILE   = 'manifest.json'
+PARTITION       = 'partition_date'
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+PART_FILE       = 'part-0.parquet'
+COMPRESSION     = 'zstd'
+DATE_VALUE      = re.compile(r'^((?:19|20)\d{2})(-?)(0[1-9]|1[0-2])-?(0[1-9]|[12]\d|3[01])')
+# sorts after any text starting with the same prefix
+UPPER           = '\uffff'
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("the export stage requires the 'pyarrow' package: pip install pyarrow")
+    return pyarrow
+
+def export_dir(feed, ed_path):
+    return os.path.join(ed_path, 'data', feed, EXPORT_DIR)
+
+def load_manifest(feed, ed_path):
+    try:
+        with open(os.path.join(export_dir(feed, ed_path), MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(feed, ed_path, manifest):
+    path = os.path.join(export_dir(feed, ed_path), MANIFEST_FILE)
+    tmp  = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp, path)
+
+def connect(db_file):
+    # immutable: a read-only reader would leave -wal and -shm files behind
+    return sqlite3.connect("%s&immutable=1" % edcquery.ro_uri(db_file), uri=True)
+
+def table_columns(cnxs):
+    """
+    map : table -> [[column, declared type]], over all the databases. A
+    column missing from some of them is NULL in their rows.
+    """
+    tables = {}
+    for cnx in cnxs:
+        for table in edcquery.tables(cnx, 'main'):
+            columns = tables.setdefault(table, [])
+            known   = set([c for (c, _) in columns])
+            for r in cnx.execute("PRAGMA table_info(%s)" % edcquery.quote_id(table)):
+                if r[1] not in known:
+                    columns.append([r[1], (r[2] or '').upper()])
+    return tables
+
+def has_table(cnx, table):
+    return cnx.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+def date_column(cnxs, table, columns):
+    """
+    (column, width of its date prefix) for the table, or (None, None).
+    """
+    names = sorted([c for (c, _) in columns if edcindexes.TIME_PATTERN.search(c)], key=lambda c: c != 'opr_date')
+    for c in names:
+        for cnx in [x for x in cnxs if has_table(x, table)]:
+            row = cnx.execute("SELECT %s FROM %s WHERE typeof(%s)='text' LIMIT 1" % (
+                edcquery.quote_id(c), edcquery.quote_id(table), edcquery.quote_id(c))).fetchone()
+            if row is None:
+                continue
+            m = DATE_VALUE.match(row[0])
+            if m is None:
+                break
+            return (c, 10 if m.group(2) else 8)
+    return (None, None)
+
+def arrow_type(pa, column, declared):
+    if 'INT' in declared:
+        return pa.int64()
+    if 'REAL' in declared or 'FLOA' in declared or 'DOUB' in declared:
+        return pa.float64()
+    if column == 'id' or column.endswith('_id'):
+        return pa.string()
+    return pa.dictionary(pa.int32(), pa.string())
+
+def partition_stats(cnxs, table, column, width):
+    """
+    map : date prefix ('' for rows without one) -> {'rows', 'max_rowid'},
+    over all the databases. 'max_rowid' is the sum of each database's
+    largest rowid in the partition.
+    """
+    stats = {}
+    for cnx in [x for x in cnxs if has_table(x, table)]:
+        if column is None:
+            sql = "SELECT '', count(*), max(rowid) FROM %s" % edcquery.quote_id(table)
+        else:
+            qc  = edcquery.quote_id(column)
+            sql = "SELECT CASE WHEN typeof(%s)='text' AND length(%s) >= %d THEN substr(%s, 1, %d) ELSE '' END AS d, " \
+                    "count(*), max(rowid) FROM %s GROUP BY d" % (qc, qc, width, qc, width, edcquery.quote_id(table))
+        for (key, n, max_rowid) in cnx.execute(sql):
+            if n:
+                stat = stats.setdefault(key, {'rows': 0, 'max_rowid': 0})
+                stat['rows']        += n
+                stat['max_rowid']   += max_rowid
+    return stats
+
+def partition_file(entry, key):
+    """
+    The partition's file, relative to the table directory.
+    """
+    if entry['date_column'] is None:
+        return PART_FILE
+    if key == '':
+        value = DEFAULT_PARTITION
+    else:
+        m = DATE_VALUE.match(key)
+        value = "%s-%s-%s" % (m.group(1), m.group(3), m.group(4)) if m else urllib.parse.quote(key, safe='')
+    return "%s=%s/%s" % (PARTITION, value, PART_FILE)
+
+def partition_rows(cnxs, table, entry, key):
+    """
+    Yield the rows of the partition from every database, in the table's
+    column order.
+    """
+    names   = [c for (c, _) in entry['columns']]
+    column  = entry['date_column']
+    for cnx in [x for x in cnxs if has_table(x, table)]:
+        have    = set([r[1] for r in cnx.execute("PRAGMA table_info(%s)" % edcquery.quote_id(table))])
+        select  = ", ".join([edcquery.quote_id(c) if c in have else "NULL" for c in names])
+        sql     = "SELECT %s FROM %s" % (select, edcquery.quote_id(table))
+        args    = ()
+        if column is not None:
+            qc = edcquery.quote_id(column)
+            if key == '':
+                sql += " WHERE typeof(%s) != 'text' OR length(%s) < %d" % (qc, qc, entry['width'])
+            else:
+                # the range lets sqlite use an index on the column
+                sql += " WHERE %s >= ? AND %s < ? AND substr(%s, 1, %d) = ?" % (qc, qc, qc, entry['width'])
+                args = (key, key + UPPER, key)
+            sql += " ORDER BY %s" % qc
+        for row in cnx.execute(sql, args):
+            yield row
+
+def to_arrow(pa, schema, rows):
+    """
+    Build the arrow table for the rows, column by column.
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays  = []
+    for (field, values) in zip(schema, columns):
+        if pa.types.is_dictionary(field.type):
+            values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        elif pa.types.is_string(field.type):
+            arrays.append(pa.array([v if v is None or isinstance(v, str) else str(v) for v in values], type=pa.string()))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_metadata(pa, table_dir, files, schema):
+    """
+    Write '_common_metadata' (the schema) and '_metadata' (the schema and
+    the row groups of every file) for the table directory.
+    """
+    pq = pa.parquet
+    pq.write_metadata(schema, os.path.join(table_dir, '_common_metadata'))
+    combined = None
+    for rel in sorted(files):
+        md = pq.read_metadata(os.path.join(table_dir, rel))
+        md.set_file_path(rel)
+        if combined is None:
+            combined = md
+        else:
+            combined.append_row_groups(md)
+    if combined is not None:
+        combined.write_metadata_file(os.path.join(table_dir, '_metadata'))
+
+def export_table(logger, pa, cnxs, out_dir, table, columns, entry):
+    """
+    Bring the table's dataset up to date. Returns the updated manifest
+    entry and the list of files written.
+    """
+    table_dir = os.path.join(out_dir, table)
+    # manifests written before 'max_rowid' hold only the row counts
+    if entry is None or entry['columns'] != columns or \
+            not all([isinstance(v, dict) for v in entry['partitions'].values()]):
+        (column, width) = date_column(cnxs, table, columns)
+        entry = {'columns': columns, 'date_column': column, 'width': width, 'partitions': {}}
+        if os.path.isdir(table_dir):
+            shutil.rmtree(table_dir)
+    schema  = pa.schema([pa.field(c, arrow_type(pa, c, t)) for (c, t) in columns])
+    stats   = partition_stats(cnxs, table, entry['date_column'], entry['width'])
+    done    = entry['partitions']
+    written = []
+    for key in [k for k in list(done.keys()) if k not in stats]:
+        path = os.path.join(table_dir, partition_file(entry, key))
+        if os.path.exists(path):
+            os.remove(path)
+        done.pop(key)
+    for key in sorted(stats.keys()):
+        rel = partition_file(entry, key)
+        if done.get(key) == stats[key] and os.path.exists(os.path.join(table_dir, rel)):
+            continue
+        try:
+            data = to_arrow(pa, schema, list(partition_rows(cnxs, table, entry, key)))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError) as e:
+            # not recorded, so it is tried again by the next export
+            log.error(logger, {
+                "name"      : __name__,
+                "method"    : "export_table",
+                "table"     : table,
+                "partition" : rel,
+                "ERROR"     : "rows do not match the column types",
+                "exception" : str(e),
+                })
+            continue
+        path = os.path.join(table_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp  = "%s.%d.tmp" % (path, os.getpid())
+        pa.parquet.write_table(data, tmp, compression=COMPRESSION, use_dictionary=True, write_statistics=True)
+        os.replace(tmp, path)
+        done[key] = stats[key]
+        written.append(rel)
+    if written or not os.path.exists(os.path.join(table_dir, '_metadata')):
+        write_metadata(pa, table_dir, [partition_file(entry, k) for k in done.keys()], schema)
+    entry['rows']   = sum([stat['rows'] for stat in done.values()])
+    dates           = sorted([k for k in done.keys() if k != ''])
+    entry['min']    = dates[0] if dates and entry['date_column'] else None
+    entry['max']    = dates[-1] if dates and entry['date_column'] else None
+    return (entry, written)
+
+def export(logger, feed, ed_path, full=False):
+    """
+    Export the feed's tables to '[feed]/parquet' (see above). With
+    full==True everything is written again. Yields "[table] file" for
+    each file written.
+    """
+    pa          = _pyarrow()
+    chlogger    = logger.getChild(__name__)
+    out_dir     = export_dir(feed, ed_path)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, '.gitignore'), 'w') as f:
+        f.write("# exported by 'edc feed %s export', not saved to git\n*\n" % feed)
+    if full:
+        for d in os.listdir(out_dir):
+            if os.path.isdir(os.path.join(out_dir, d)):
+                shutil.rmtree(os.path.join(out_dir, d))
+    manifest    = {} if full else load_manifest(feed, ed_path)
+    manifest['partitioning'] = {"flavor": "hive", "column": PARTITION}
+    entries     = manifest.setdefault('tables', {})
+    cnxs        = [connect(f) for (_, f) in edcquery.feed_dbs(ed_path, [feed])]
+    count       = 0
+    try:
+        tables = table_columns(cnxs)
+        for table in sorted(tables.keys()):
+            (entries[table], written) = export_table(chlogger, pa, cnxs, out_dir, table, tables[table], entries.get(table))
+            for rel in written:
+                count += 1
+                yield "[%s] %s" % (table, rel)
+        for table in [t for t in list(entries.keys()) if t not in tables]:
+            shutil.rmtree(os.path.join(out_dir, table), ignore_errors=True)
+            entries.pop(table)
+    finally:
+        for cnx in cnxs:
+            cnx.close()
+        save_manifest(feed, ed_path, manifest)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "export",
+        "feed"      : feed,
+        "path"      : ed_path,
+        "databases" : len(cnxs),
+        "tables"    : len(entries),
+        "written"   : count,
+        })
@@ -0,0 +1,183 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+indexes.py : table ddl, inferred secondary indexes and db maintenance
+
+The tables generated from the xml only have their primary key indexed.
+Dashboard queries filter on time, node, market and resource columns, and
+join child rows to their parent, so an index is inferred for every column
+that is:
+
+    * a time column (TIME_PATTERN, e.g. 'interval_start_gmt', 'opr_date')
+    * a key column (KEY_PATTERN, e.g. 'node', 'market_run_id', 'data_item')
+    * a foreign key to the parent row ('[parent]_id')
+
+Indexes slow down the bulk insert, so they are not part of the insert
+sql. `optimize` builds the missing ones afterwards, then runs ANALYZE,
+'PRAGMA optimize' and, optionally, VACUUM.
+"""
+
+from edl.resources import filesystem
+from edl.resources import log
+from edc import schema as edcschema
+import json
+import os
+import re
+import sqlite3
+
+TIME_PATTERN    = re.compile(r'(^|_)(gmt|date|time|timedate|datetime|dt|hr|hour|interval_num|interval_start|interval_end|start|end)($|_)')
+KEY_PATTERN     = re.compile(r'(^|_)(node|pnode|apnode|market|market_run_id|resource|resource_name|data_item|xml_data_item|zone|tac_area|transaction_type)($|_)')
+
+def index_name(table, column):
+    return "idx_%s_%s" % (table, column)
+
+def infer(cnx):
+    """
+    Return the CREATE INDEX statements inferred from the tables of the
+    sqlite3 connection (schema 'main').
+    """
+    statements = []
+    for (table,) in cnx.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall():
+        info    = cnx.execute("PRAGMA table_info(%s)" % table).fetchall()
+        pk      = [r[1] for r in sorted(info, key=lambda r: r[5]) if r[5] > 0]
+        fks     = set([r[3] for r in cnx.execute("PRAGMA foreign_key_list(%s)" % table)])
+        for r in info:
+            column = r[1]
+            if pk[:1] == [column]:
+                # the primary key index already covers it
+                continue
+            if column in fks or TIME_PATTERN.search(column) or KEY_PATTERN.search(column):
+                statements.append("CREATE INDEX IF NOT EXISTS %s ON %s (%s);" % (index_name(table, column), table, column))
+    return statements
+
+def infer_from_ddl(ddl):
+    """
+    Return the CREATE INDEX statements inferred from table ddl.
+    """
+    cnx = sqlite3.connect(":memory:")
+    try:
+        cnx.executescript("\n".join(ddl))
+        return infer(cnx)
+    finally:
+        cnx.close()
+
+def create_ddl(logger, feed, ed_path, xmlfile=None, save=False, sample=1, workers=1):
+    """
+    Generate the table ddl and the inferred index ddl from the xmlfile, or
+    from 'sample' xml files of the feed (see `edc.schema`). With save==True
+    they are written to the manifest's 'ddl_create' and 'ddl_index'.
+    Returns (ddl, index_ddl, drift).
+    """
+    chlogger    = logger.getChild(__name__)
+    found       = edcschema.xml_files(feed, ed_path)
+    if xmlfile is not None:
+        name    = os.path.basename(xmlfile)
+        files   = {xmlfile if os.path.exists(xmlfile) else name : found.get(name)}
+    else:
+        files   = dict([(f, found[f]) for f in edcschema.pick(found.keys(), sample)])
+    schemas     = edcschema.infer(chlogger, feed, ed_path, files, workers) if files else {}
+    if not schemas:
+        log.critical(chlogger, {
+            "name"      : __name__,
+            "method"    : "create_ddl",
+            "feed"      : feed,
+            "path"      : ed_path,
+            "xml_files" : sorted(files.keys()),
+            "ERROR"     : "no xml file to infer the schema from",
+            })
+    (schema, drift) = edcschema.merge(schemas)
+    ddl         = edcschema.to_ddl(schema)
+    index_ddl   = infer_from_ddl(ddl)
+    if save:
+        manifest = os.path.join(ed_path, 'data', feed, 'manifest.json')
+        with open(manifest, 'r') as f:
+            obj = json.load(f)
+        obj['ddl_create'] = ddl
+        obj['ddl_index']  = index_ddl
+        with open(manifest, 'w') as f:
+            f.write(json.dumps(obj, indent=4, sort_keys=True))
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "create_ddl",
+        "feed"      : feed,
+        "xml_files" : len(schemas),
+        "tables"    : len(ddl),
+        "indexes"   : len(index_ddl),
+        "drift"     : len(drift),
+        "saved"     : save,
+        })
+    return (ddl, index_ddl, drift)
+
+def index_count(cnx):
+    return cnx.execute("SELECT count(*) FROM sqlite_master WHERE type='index'").fetchone()[0]
+
+def optimize_db(logger, db_file, index_ddl=None, vacuum=True):
+    """
+    Build the missing indexes (index_ddl, or the inferred ones), then
+    ANALYZE, 'PRAGMA optimize' and VACUUM. Returns (indexes created, size
+    before, size after).
+    """
+    before  = os.path.getsize(db_file)
+    cnx     = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        start = index_count(cnx)
+        for statement in (index_ddl if index_ddl else infer(cnx)):
+            try:
+                cnx.execute(statement)
+            except sqlite3.OperationalError as e:
+                # a manifest index on a column this (older) db lacks
+                log.warning(logger, {
+                    "name"      : __name__,
+                    "method"    : "optimize_db",
+                    "db_file"   : db_file,
+                    "statement" : statement,
+                    "WARNING"   : "index not created",
+                    "exception" : str(e),
+                    })
+        created = index_count(cnx) - start
+        cnx.execute("ANALYZE")
+        cnx.execute("PRAGMA optimize")
+        if vacuum:
+            cnx.execute("VACUUM")
+        if cnx.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+            cnx.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        cnx.close()
+    return (created, before, os.path.getsize(db_file))
+
+def optimize(logger, feed, ed_path, vacuum=True):
+    """
+    Optimize each of the feed's databases, using the manifest's 'ddl_index'
+    when it has one. Yields a line per database.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    db_dir      = os.path.join(feed_dir, 'db')
+    with open(os.path.join(feed_dir, 'manifest.json'), 'r') as f:
+        index_ddl = json.load(f).get('ddl_index')
+    for db in (filesystem.glob_dir(db_dir, ".db") if os.path.isdir(db_dir) else []):
+        (created, before, after) = optimize_db(chlogger, os.path.join(db_dir, db), index_ddl, vacuum)
+        log.info(chlogger, {
+            "name"      : __name__,
+            "method"    : "optimize",
+            "feed"      : feed,
+            "db_file"   : db,
+            "indexes_created" : created,
+            "bytes_before"  : before,
+            "bytes_after"   : after,
+            })
+        yield "%s: %d index(es) created, %d -> %d bytes" % (db, created, before, after)
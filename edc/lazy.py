@@ -0,0 +1,82 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+lazy.py : deferred module imports and import-time profiling for `edc`
+
+Most `edc` invocations run a single small command, so the interpreter
+start and module imports dominate their run time. `edc.main` binds its
+command modules with `module()`, which returns a module object whose
+code only runs on first attribute access.
+
+`profile()` backs `edc --startup-profile`: it re-runs the command under
+`python -X importtime` and prints the slowest imports.
+"""
+
+import importlib.util
+import re
+import sys
+
+IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+BOUND      = []
+"""BOUND : names passed to module(), in order (see `edc.server`)"""
+
+def module(name):
+    """
+    Return the module 'name', deferring its execution until an attribute
+    is first used. Modules that are already imported are returned as is.
+    """
+    if name not in BOUND:
+        BOUND.append(name)
+    if name in sys.modules:
+        return sys.modules[name]
+    spec    = importlib.util.find_spec(name)
+    loader  = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    mod     = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    loader.exec_module(mod)
+    (parent, _, child) = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, mod)
+    return mod
+
+def profile(args, top=25):
+    """
+    Run 'edc [args]' with import timing enabled. The command's own output
+    is passed through; yields the report lines, slowest cumulative
+    import first.
+    """
+    import subprocess
+    import time
+    cmd     = [sys.executable, "-X", "importtime", "-c", "from edc.main import cli; cli(prog_name='edc')"]
+    start   = time.perf_counter()
+    proc    = subprocess.run(cmd + list(args), stderr=subprocess.PIPE, universal_newlines=True)
+    wall    = time.perf_counter() - start
+    imports = []
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME.match(line)
+        if m is None:
+            if not line.startswith("import time:"):
+                sys.stderr.write("%s\n" % line)
+            continue
+        imports.append((int(m.group(2)), int(m.group(1)), len(m.group(3)) // 2, m.group(4)))
+    total = sum([i[0] for i in imports if i[2] == 0])
+    yield "%10s %10s  %s" % ("cumul(ms)", "self(ms)", "module")
+    for (cumulative, own, depth, name) in sorted(imports, reverse=True)[:top]:
+        yield "%10.1f %10.1f  %s%s" % (cumulative / 1000.0, own / 1000.0, "  " * depth, name)
+    yield "imports: %d modules, %.1f ms" % (len(imports), total / 1000.0)
+    yield "command: %.1f ms wall, exit status %d" % (wall * 1000.0, proc.returncode)
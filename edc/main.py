@@ -14,18 +14,52 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from edl.cli import feed as clifeed
-from edl.cli import feeds as clifeeds
-from edl.cli import repo as clirepo
-from edl.resources.exec import runyield
-from edl.resources import filesystem as fs
-from edl.resources import xmlparser
 from edl.resources import log
+from edc import lazy
 import click
 import os
 import sys
 import logging
+import contextlib
 import copy
+import json
+import sqlite3
+
+# Command modules are only imported when a command uses them (see edc/lazy.py)
+clifeed         = lazy.module('edl.cli.feed')
+clifeeds        = lazy.module('edl.cli.feeds')
+clirepo         = lazy.module('edl.cli.repo')
+fs              = lazy.module('edl.resources.filesystem')
+runner          = lazy.module('edc.runner')
+edcstages       = lazy.module('edc.stages')
+edcstream       = lazy.module('edc.stream')
+statusindex     = lazy.module('edc.statusindex')
+edcsearch       = lazy.module('edc.search')
+transfer        = lazy.module('edc.transfer')
+snapshot        = lazy.module('edc.snapshot')
+edccodec        = lazy.module('edc.codec')
+server          = lazy.module('edc.server')
+edcschedule     = lazy.module('edc.schedule')
+metrics         = lazy.module('edc.metrics')
+edcbench        = lazy.module('edc.bench')
+edcquery        = lazy.module('edc.query')
+edcindexes      = lazy.module('edc.indexes')
+edcschema       = lazy.module('edc.schema')
+edcdownload     = lazy.module('edc.download')
+edcshards       = lazy.module('edc.shards')
+edcupsert       = lazy.module('edc.upsert')
+statestore      = lazy.module('edc.statestore')
+edcrepo         = lazy.module('edc.repo')
+edcexport       = lazy.module('edc.export')
+
+# 'proc' stages run by edc only, not part of 'all'
+EXTRA_STAGES    = ['export']
+
+# option choices, kept here so that building the commands does not import
+# the modules (edc.codec.CODECS, edc.repo.LFS_MODES and edc.repo.URL)
+CODECS          = ['gzip', 'zstd', 'xz']
+LFS_MODES       = ['all', 'skip', 'lazy']
+ED_URL          = "https://github.com/energy-analytics-project/energy-dashboard.git"
 
 # CTX OBJ KEYS
 EDDIR           ='eddir'
@@ -35,13 +69,19 @@ FEED            ='feed'
 @click.group()
 @click.option('--ed-dir', help="Energy Dashboard directory (defaults to cwd)")
 @click.option('--log-level', type=click.Choice(log.LOG_LEVELS), default="INFO")
+@click.option('--startup-profile', is_flag=True, help="Run the command and print an import time breakdown")
 @click.pass_context
-def cli(ctx,  ed_dir, log_level):
+def cli(ctx,  ed_dir, log_level, startup_profile):
     """
     Command Line Interface for the Energy Dashboard. This tooling 
     collects information from a number of data feeds, imports that data, 
     transforms it, and inserts it into a database.
     """
+    if startup_profile:
+        args = [a for a in sys.argv[1:] if a != '--startup-profile']
+        for line in lazy.profile(args):
+            click.echo(line, err=True)
+        ctx.exit()
     # pass this logger as a child logger to the edl methods
     log.configure_logging()
     logger = logging.getLogger(__name__)
@@ -98,8 +138,12 @@ def license():
 # Init
 #------------------------------------------------------------------------------
 @cli.command('clone', short_help="Clone energy-dashboard locally")
+@click.option('--depth', type=int, help="Shallow clone with this many commits of history")
+@click.option('--filter', 'filter_spec', help="Partial clone filter, e.g. 'blob:none'")
+@click.option('--lfs', type=click.Choice(LFS_MODES), default='all', help="Fetch the git-lfs database blobs: all, skip or lazy (on use)")
+@click.option('--url', default=ED_URL, help="Repository to clone")
 @click.pass_context
-def repo_clone(ctx):
+def repo_clone(ctx, depth, filter_spec, lfs, url):
     """
     Use git to clone the energy-dashboard locally.
     
@@ -111,24 +155,173 @@ def repo_clone(ctx):
 
     After cloning, use the 'update' command to bring in
     all the data in the submodules.
+
+    --depth makes a shallow clone and --filter a partial one. With
+    --lfs skip or lazy, the database files are left as git-lfs pointers;
+    lazy fetches a database when 'edc query' uses it. The lfs mode is
+    kept for 'update'.
     """
     logger  = ctx.obj[LOGGER]
     path = ctx.obj[EDDIR]
-    for output in clirepo.clone(logger, path):
+    for output in edcrepo.clone(logger, path, url, depth, filter_spec, lfs):
         click.echo(output)
 
 @cli.command('update', short_help="Update the submodules")
+@click.option('--jobs', '-j', default=os.cpu_count(), type=int, help="Number of submodules to fetch concurrently (defaults to cpu count)")
+@click.option('--depth', type=int, help="Shallow submodules with this many commits of history")
+@click.option('--filter', 'filter_spec', help="Partial clone filter for the submodules, e.g. 'blob:none'")
+@click.option('--feeds', multiple=True, help="Only initialize the feeds matching this glob (repeatable)")
+@click.option('--lfs', type=click.Choice(LFS_MODES), help="Fetch the git-lfs database blobs: all, skip or lazy (defaults to the mode set by 'clone')")
 @click.pass_context
-def repo_update(ctx):
+def repo_update(ctx, jobs, depth, filter_spec, feeds, lfs):
     """
     Update the submodules that have been previously cloned
     via the 'clone' command.
+
+    Submodules are fetched --jobs at a time. --feeds selects the feed
+    submodules to initialize (the others are left alone), and --depth,
+    --filter and --lfs work as for 'clone':
+
+        $ edc update --jobs 8 --depth 1 --feeds 'data-oasis-as-*' --lfs lazy
     """
     logger  = ctx.obj[LOGGER]
     path = ctx.obj[EDDIR]
-    for output in clirepo.update(logger, path):
+    for output in edcrepo.update(logger, path, jobs, depth, filter_spec, feeds, lfs):
         click.echo(output)
 
+#------------------------------------------------------------------------------
+# Serve
+#------------------------------------------------------------------------------
+@cli.command('serve', short_help="Serve edc commands on a local unix socket")
+@click.option('--socket', 'socket_file', type=click.Path(), help="Socket path (defaults to [ed-dir]/.edc/edc.sock)")
+@click.option('--workers', '-w', default=os.cpu_count(), type=int, help="Number of requests to run concurrently")
+@click.pass_context
+def serve(ctx, socket_file, workers):
+    """
+    Run a long lived edc server. The server loads the edl and edc modules
+    once, and runs each request in a forked copy of itself, so requests
+    skip the interpreter and import start up cost of 'edc'.
+
+    Use 'edcc' (same arguments as 'edc') to send commands to the server:
+
+        $ edc serve &
+        $ edcc feed data-oasis-atl-lap-all status
+
+    Commands on the same feed are serialized, except for read-only ones
+    like 'status' and 'dir'.
+    """
+    logger  = ctx.obj[LOGGER]
+    path    = ctx.obj[EDDIR]
+    if socket_file is None:
+        socket_file = server.socket_path(path)
+    server.serve(logger, path, os.path.abspath(socket_file), workers)
+
+@cli.command('bench', short_help="Benchmark the ingest pipeline offline")
+@click.option('--workdir', type=click.Path(), help="Scratch energy-dashboard directory (defaults to a temp dir, removed afterwards)")
+@click.option('--copies', '-c', default=10, type=int, help="Number of date shifted copies of the test zips")
+@click.option('--testdata', type=click.Path(exists=True, file_okay=False),
+        help="Directory of source zips (defaults to test/testdata/zip in a source checkout)")
+@click.option('--proc-args', default="", help="Extra 'feed proc' options for unzip, parse and insert, e.g. '--workers 4'")
+@click.option('--archive-args', default="", help="Extra 'feed archive' options, e.g. '--codec xz'")
+@click.option('--save-baseline', type=click.Path(), help="Write the results to this json file")
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help="Compare against a saved baseline")
+@click.option('--tolerance', default=0.10, type=float, help="Allowed wall time slowdown against the baseline (fraction)")
+@click.pass_context
+def bench(ctx, workdir, copies, testdata, proc_args, archive_args, save_baseline, baseline, tolerance):
+    """
+    Benchmark unzip, parse, insert, status, archive and restore on a
+    synthetic feed built from the bundled test zips. Runs fully offline.
+
+    Each step runs as its own 'edc' process; wall time, cpu time, peak
+    RSS and throughput are reported per step. With '--baseline', exits
+    with status 1 when a step is slower than the baseline by more than
+    '--tolerance'.
+
+        $ edc bench --copies 50 --save-baseline bench.json
+        $ edc bench --copies 50 --baseline bench.json
+    """
+    import shutil
+    import tempfile
+    logger  = ctx.obj[LOGGER]
+    testdata = testdata or edcbench.default_testdata()
+    if testdata is None:
+        raise click.UsageError("--testdata is required: the test zips are only in the edc source tree (test/testdata/zip)")
+    scratch = workdir is None
+    workdir = tempfile.mkdtemp(prefix="edc-bench-") if scratch else os.path.abspath(workdir)
+    try:
+        results = edcbench.run(logger, workdir, testdata, copies, proc_args, archive_args)
+    finally:
+        if scratch:
+            shutil.rmtree(workdir, ignore_errors=True)
+    base = None
+    if baseline is not None:
+        with open(baseline, 'r') as f:
+            base = json.load(f)
+    for line in edcbench.report(results, base):
+        click.echo(line)
+    if save_baseline is not None:
+        with open(save_baseline, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    failed = [s for (s, r) in results["steps"].items() if r["returncode"] != 0]
+    if failed:
+        click.echo("failed steps: %s" % ", ".join(failed), err=True)
+        ctx.exit(1)
+    if base is not None:
+        slow = edcbench.regressions(results, base, tolerance)
+        if slow:
+            click.echo("slower than baseline by more than %d%%: %s" % (tolerance * 100, ", ".join(slow)), err=True)
+            ctx.exit(1)
+
+@cli.command('query', short_help="Run one sql query over the feed databases")
+@click.argument('sql', required=False)
+@click.option('--match', '-m', multiple=True, help="Only query feeds matching this pattern (repeatable)")
+@click.option('--regex/--glob', default=False, help="Treat --match patterns as regular expressions (default is glob)")
+@click.option('--format', '-f', 'fmt', type=click.Choice(['csv', 'json', 'jsonl', 'arrow']), default='csv')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help="Write the results to this file instead of stdout")
+@click.option('--per-db', is_flag=True, help="Run the query against each database separately, in parallel")
+@click.option('--workers', '-w', default=os.cpu_count(), type=int, help="Threads for --per-db")
+@click.option('--attach-limit', type=int, help="Databases per attached batch (defaults to the sqlite limit)")
+@click.option('--tables', 'list_tables', is_flag=True, help="List the union views and how many databases each covers")
+@click.pass_context
+def query(ctx, sql, match, regex, fmt, output, per_db, workers, attach_limit, list_tables):
+    """
+    Run a read-only sql query across the feed databases.
+
+    The databases are attached to one connection, and each table name is
+    a view over the UNION ALL of that table in every database, with an
+    extra '_feed' column:
+
+        $ edc query "SELECT _feed, count(*) FROM report_data GROUP BY _feed"
+
+    With more databases than the attach limit, the query runs once per
+    batch of databases; use --match to select fewer feeds. With --per-db,
+    the query runs against each database on its own and rows are prefixed
+    with '_feed' and '_db'.
+
+    Results stream as csv, json, jsonl or an Arrow IPC stream ('arrow'
+    requires pyarrow).
+    """
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    feeds   = runner.select_feeds(logger, path, match, regex)
+    dbs     = edcrepo.fetch_dbs(logger, path, edcquery.feed_dbs(path, feeds))
+    if list_tables:
+        for (view, count) in edcquery.list_views(logger, dbs, attach_limit):
+            click.echo("%s,%d" % (view, count))
+        return
+    if sql is None:
+        raise click.UsageError("missing the SQL argument")
+    if per_db:
+        results = edcquery.query_per_db(logger, dbs, sql, workers)
+    else:
+        results = edcquery.query_attached(logger, dbs, sql, attach_limit)
+    try:
+        with contextlib.ExitStack() as stack:
+            out = stack.enter_context(open(output, 'wb')) if output else click.get_binary_stream('stdout')
+            edcquery.write(results, fmt, out)
+    except (RuntimeError, sqlite3.Error) as e:
+        raise click.ClickException(str(e))
+
 #------------------------------------------------------------------------------
 # Feeds (plural)
 #------------------------------------------------------------------------------
@@ -151,12 +344,117 @@ def feeds_list(ctx):
     for item in clifeeds.list(logger, path):
         click.echo(item)
 
-@feeds.command('search', short_help='Search feeds (NYI)')
-def feeds_search():
+@feeds.command('proc', short_help='Process many feeds through the provided stages in parallel')
+@click.argument('stages', nargs=-1)
+@click.option('--jobs', '-j', default=os.cpu_count(), type=int, help="Number of feeds to process concurrently (defaults to cpu count)")
+@click.option('--match', '-m', multiple=True, help="Only process feeds matching this pattern (repeatable)")
+@click.option('--regex/--glob', default=False, help="Treat --match patterns as regular expressions (default is glob)")
+@click.option('--codec', type=click.Choice(CODECS), help="Build the dist stage with this codec instead of ./src")
+@click.option('--level', type=int, help="Compression level for --codec")
+@click.option('--threads', default=1, type=int, help="Compression threads for --codec (zstd only)")
+@click.option('--download-concurrency', type=int, help="Run the download stage in edc with this many requests per host")
+@click.pass_context
+def feeds_procstage(ctx, stages, jobs, match, regex, codec, level, threads, download_concurrency):
     """
-    NYI -- implement a full text search against the feed's manifest.json
+    Process the selected feeds through the stages, running up to --jobs
+    feeds at a time. Stages are the same as for 'feed X proc', and
+    'export', --codec and --download-concurrency run in edc as they do
+    there. So do the 'insert' of sharded and upserted feeds, and the
+    'dist' of sharded feeds.
+
+    Output lines are prefixed with the feed name. A summary table with
+    the wall time and exit status of each feed is printed at the end.
+
+    Example:
+
+        $ edc feeds proc unzip parse insert --jobs 8 --match 'data-oasis-atl-*'
     """
-    pass
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    vstages = expand_stages(stages)
+    feeds   = runner.select_feeds(logger, path, match, regex)
+    results = []
+    options = {
+            'codec'                 : codec,
+            'level'                 : level,
+            'threads'               : threads,
+            'download_concurrency'  : download_concurrency,
+            }
+    for (feed, line, result) in runner.process_feeds(logger, path, feeds, vstages, jobs, options):
+        if result is None:
+            click.echo("[%s] %s" % (feed, line))
+        else:
+            results.append(result)
+    for line in runner.summary(results):
+        click.echo(line)
+    if any(r["returncode"] != 0 for r in results):
+        sys.exit(1)
+
+@feeds.command('status', short_help='Show the status of all feeds')
+@click.option('--separator', '-s', default=',')
+@click.option('--header/--no-header', default=True)
+@click.option('--format', '-f', 'fmt', type=click.Choice(['csv', 'json']), default='csv')
+@click.option('--jobs', '-j', default=16, type=int, help="Number of feeds to scan concurrently")
+@click.option('--match', '-m', multiple=True, help="Only show feeds matching this pattern (repeatable)")
+@click.option('--regex/--glob', default=False, help="Treat --match patterns as regular expressions (default is glob)")
+@click.option('--refresh', is_flag=True, help="Ignore the cached indexes and rescan the feeds")
+@click.option('--rows/--no-rows', default=False, help="Add the total row count of the feed databases")
+@click.pass_context
+def feeds_status(ctx, separator, header, fmt, jobs, match, regex, refresh, rows):
+    """
+    Return the 'feed status' row for every feed, in a single process.
+
+    With --format json, a list of objects keyed by the header names is
+    returned instead.
+    """
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    feeds   = runner.select_feeds(logger, path, match, regex)
+    columns = statusindex.header_row(rows)
+    result  = statusindex.all_status(logger, path, feeds, jobs, refresh, rows)
+    if fmt == 'json':
+        click.echo(json.dumps([dict(zip(columns, row)) for row in result], indent=4))
+        return
+    if header:
+        click.echo(separator.join(columns))
+    for row in result:
+        click.echo(separator.join([str(v) for v in row]))
+
+@feeds.command('search', short_help='Search feed manifests')
+@click.argument('query', nargs=-1, required=True)
+@click.option('--limit', '-l', default=50, type=int, help="Maximum number of feeds to return")
+@click.option('--rank/--no-rank', default=False, help="Show the bm25 rank of each result")
+@click.option('--rebuild', is_flag=True, help="Rebuild the search index from scratch")
+@click.pass_context
+def feeds_search(ctx, query, limit, rank, rebuild):
+    """
+    Full text search against the feeds' manifest.json, best match first.
+
+    Indexed fields: feed, url, queryname, maintainer, company, email,
+    description, comments, tables, columns (tables and columns come
+    from the manifest's 'ddl_create').
+
+    The query uses sqlite FTS5 syntax; restrict a term to a field with
+    'field:term'. Terms are matched as is, so 'data-oasis' needs no
+    quoting.
+
+    Example:
+
+        # which feeds have an 'interval_num' column?
+        $ edc feeds search columns:interval_num
+
+        $ edc feeds search 'queryname:ATL* AND maintainer:todd'
+    """
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    try:
+        for (feed, score) in edcsearch.search(logger, path, " ".join(query), limit, rebuild):
+            if rank:
+                click.echo("%s %.3f" % (feed, score))
+            else:
+                click.echo(feed)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
 
 #------------------------------------------------------------------------------
 # Feed (singular)
@@ -261,17 +559,40 @@ def feed_invoke(ctx, command):
 @feed.command('status', short_help='Show feed status')
 @click.option('--separator', '-s', default=',')
 @click.option('--header/--no-header', default=True)
+@click.option('--refresh', is_flag=True, help="Ignore the cached index and rescan the feed")
+@click.option('--rows/--no-rows', default=False, help="Add the total row count of the feed databases")
 @click.pass_context
-def feed_status(ctx, separator, header):
+def feed_status(ctx, separator, header, refresh, rows):
     """
     Return the feed status as:
 
         "feed name","download count","unzipped count","inserted count", "db count"
+
+    Counts come from an index in [feed]/.edc/status.json, which only
+    re-reads state files (and databases, with --rows) that have changed.
     """
     feed    = ctx.obj[FEED]
     path    = ctx.obj[EDDIR]
     logger  = ctx.obj[LOGGER]
-    for line in clifeed.status(logger, feed, path, separator, header):
+    for line in statusindex.status(logger, feed, path, separator, header, refresh, rows):
+        click.echo(line)
+
+@feed.command('stats', short_help='Summarize the metrics of recent proc runs')
+@click.option('--last', '-n', default=10, type=int, help="Number of runs to summarize")
+@click.pass_context
+def feed_stats(ctx, last):
+    """
+    Show the per-stage metrics recorded by the last runs of
+    'feed X proc --metrics', followed by the mean of each stage over those
+    runs.
+
+    'maxrss' is the largest resident set size of edc or one of its child
+    processes since the run started (ru_maxrss), not of the stage alone:
+    it only ever grows from one stage of a run to the next.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    for line in metrics.stats(feed, path, last):
         click.echo(line)
 
 @feed.command('prune', short_help='prune feed stage')
@@ -284,7 +605,8 @@ def feed_prune(ctx, stages, confirm):
 
     prune a stage. This is a destructive action, make backups first!.
     This will delete the stage files, but not the directory and not
-    the state file.
+    the state file. Only the files that the next stage has recorded as
+    done are deleted, the others are kept.
 
     !!!USE WITH CAUTION!!!
 
@@ -303,9 +625,9 @@ def feed_prune(ctx, stages, confirm):
         if confirm:
             p = clifeed.pre_prune(logger, feed, path, stage)
             if click.confirm('About to prune: %s. Do you want to continue?' % p):
-                click.echo(clifeed.prune(logger, feed, path, stage))
+                click.echo(statestore.prune(logger, feed, path, stage))
         else:
-            click.echo(clifeed.prune(logger, feed, path, stage))
+            click.echo(statestore.prune(logger, feed, path, stage))
 
 @feed.command('reset', short_help='Reset feed stage')
 @click.argument('stages', nargs=-1)
@@ -339,45 +661,173 @@ def feed_reset(ctx, stages, confirm):
     for stage in vstages:
         if confirm:
             p = clifeed.pre_reset(logger, feed, path, stage)
-            if click.confirm('About to delete: %s. Do you want to continue?' % p):
-                click.echo(clifeed.reset(logger, feed, path, stage))
-        else:
-            click.echo(clifeed.reset(logger, feed, path, stage))
+            if not click.confirm('About to delete: %s. Do you want to continue?' % p):
+                continue
+        click.echo(clifeed.reset(logger, feed, path, stage))
+        if stage in statestore.STAGES:
+            with statestore.StateStore(feed, path, sync=False) as store:
+                store.clear(stage)
 
 @feed.command('archive', short_help='Archive feed to tar.gz')
 @click.option('--archivedir', help="Path to save archive", required=False, default="archive")
+@click.option('--incremental/--full', default=False, help="Write an incremental snapshot instead of a full tar.gz")
+@click.option('--workers', '-w', default=os.cpu_count(), type=int, help="Threads used to hash and compress files (incremental only)")
+@click.option('--codec', type=click.Choice(CODECS), default='gzip', help="Compression codec for the tar archive")
+@click.option('--level', type=int, help="Compression level (codec specific)")
+@click.option('--threads', default=1, type=int, help="Compression threads (zstd only)")
 @click.pass_context
-def feed_archive_to_targz(ctx, archivedir):
+def feed_archive_to_targz(ctx, archivedir, incremental, workers, codec, level, threads):
     """
     Archive a feed. Especially useful before a destructive action like:
     'feed X reset'
 
     If archivedir starts with "/" then this is an absolute path.
+
+    With --incremental, files are stored by content hash under
+    [archivedir]/objects and a snapshot manifest listing only the files
+    that changed since the previous snapshot is written under
+    [archivedir]/snapshots/[feed]. Prints the manifest path, which can
+    be passed to 'feed X restore'.
+
+    --codec selects the compression of the tar archive: gzip (default,
+    writes [feed].tar.gz), xz or zstd (requires the 'zstandard' package,
+    and can use several --threads).
     """
     feed    = ctx.obj[FEED]
     path    = ctx.obj[EDDIR]
     logger  = ctx.obj[LOGGER]
-    click.echo(clifeed.archive_locally(logger, feed, path, archivedir))
+    if incremental:
+        click.echo(snapshot.archive(logger, feed, path, archivedir, workers))
+    else:
+        click.echo(edccodec.archive(logger, feed, path, archivedir, codec, level, threads))
+
+@feed.command('snapshots', short_help='List incremental archive snapshots')
+@click.option('--archivedir', help="Path to the archive", required=False, default="archive")
+@click.pass_context
+def feed_snapshots(ctx, archivedir):
+    """
+    List the feed's snapshot manifests, oldest first.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    for manifest in snapshot.list_snapshots(snapshot.archive_root(path, archivedir), feed):
+        click.echo(manifest)
 
 @feed.command('restore', short_help='Restore feed from tar.gz')
 @click.argument('archive', type=click.Path(exists=True))
+@click.option('--workers', '-w', default=os.cpu_count(), type=int, help="Threads used to decompress files (snapshots only)")
 @click.pass_context
-def feed_restore_from_targz(ctx, archive):
+def feed_restore_from_targz(ctx, archive, workers):
     """
     Restore a feed from an archive.
 
-    archive : tar.gz to restore
+    archive : tar archive to restore (gzip, xz and zstd compression are
+              detected automatically), or a snapshot manifest (.json)
+              written by 'feed X archive --incremental'
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    if archive.endswith(".json"):
+        click.echo(snapshot.restore(logger, feed, path, archive, workers))
+    else:
+        click.echo(edccodec.restore(logger, feed, path, archive))
+
+
+@feed.command('download', short_help='Download from source url, concurrently')
+@click.option('--concurrency', '-c', default=4, type=int, help="Maximum requests in flight per host")
+@click.option('--min-delay', default=0.0, type=float, help="Minimum seconds between request starts per host")
+@click.option('--max-delay', default=60.0, type=float, help="Maximum back off between request starts per host")
+@click.option('--retries', default=5, type=int, help="Retries per url on 429/5xx, connection errors and short reads")
+@click.pass_context
+def feed_download(ctx, concurrency, min_delay, max_delay, retries):
+    """
+    Download the feed's resources, like the 'download' stage, but with
+    up to --concurrency requests in flight per host over pooled
+    connections, instead of one request every 'download_delay_secs'.
+
+    The rate adapts: 429 and 5xx responses halve the concurrency and
+    double the delay between requests (honouring Retry-After), while
+    successful responses grow them back. Partial files are kept as
+    '.part' and resumed with Range requests.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    for output in edcdownload.download(logger, feed, path, concurrency, min_delay, max_delay, retries):
+        click.echo(output)
+
+@feed.command('export', short_help='Export the feed tables to partitioned Parquet')
+@click.option('--full', is_flag=True, help="Rewrite every partition instead of only the new and changed ones")
+@click.pass_context
+def feed_export(ctx, full):
+    """
+    Export the tables of the feed's databases to a Parquet dataset per
+    table in ./parquet, partitioned by day ('partition_date=YYYY-MM-DD'),
+    with dictionary encoded text columns. Like the 'export' stage of
+    'feed proc'.
+
+    Only the partitions that are new, or whose row count changed, are
+    written. ./parquet/[table]/_metadata lets pyarrow and pandas plan
+    filtered reads from the file footers:
+
+        pandas.read_parquet('parquet/report_data',
+                filters=[('partition_date', '>=', '2019-09-01')])
+
+    Requires the 'pyarrow' package.
     """
     feed    = ctx.obj[FEED]
     path    = ctx.obj[EDDIR]
     logger  = ctx.obj[LOGGER]
-    click.echo(clifeed.restore_locally(logger, feed, path, archive))
+    try:
+        for output in edcexport.export(logger, feed, path, full):
+            click.echo(output)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+@feed.command('reinsert', short_help='Re-process selected files into the feed database')
+@click.argument('pattern')
+@click.option('--from', 'from_stage', type=click.Choice(['unzip', 'parse', 'insert']), default='unzip', help="Stage to re-process the files from, which the pattern matches the input files of")
+@click.option('--workers', '-w', default=1, type=int, help="Processes to fan unzip and parse out over")
+@click.option('--extract/--no-extract', default=True, help="See 'feed X proc --no-extract'")
+@click.pass_context
+def feed_reinsert(ctx, pattern, from_stage, workers, extract):
+    """
+    Re-process the files matching the glob PATTERN into the database,
+    instead of 'reset insert' and re-inserting every file. With --from
+    unzip (the default) the pattern matches zip files, with 'parse' xml
+    files and with 'insert' sql files, e.g.
+
+        edc feed X reinsert '*20190901*'
 
+    Only those files are removed from the state files and run through
+    the stages again. With a 'natural_key' in the manifest (see 'db
+    createddl --save') their rows replace the earlier ones in place;
+    without one, re-parsed rows are inserted next to the old ones.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    for output in edcschedule.reinsert(logger, feed, path, pattern, from_stage, workers, extract):
+        click.echo(output)
+    statusindex.update(logger, feed, path)
 
 @feed.command('proc', short_help='Process a feed through the provided stage in ./src')
 @click.argument('stages', nargs=-1)
+@click.option('--workers', '-w', default=1, type=int, help="Processes to fan the unzip and parse stages out over")
+@click.option('--stream/--no-stream', default=False, help="Stream zip files straight into the db, replacing unzip, parse and insert")
+@click.option('--extract/--no-extract', default=True, help="With --no-extract, unzip only indexes the xml members and parse reads them from the zip")
+@click.option('--batch-size', type=int, help="Rows per executemany batch when streaming (default 10000)")
+@click.option('--codec', type=click.Choice(CODECS), help="Build the dist stage with this codec instead of ./src")
+@click.option('--level', type=int, help="Compression level for --codec")
+@click.option('--threads', default=1, type=int, help="Compression threads for --codec (zstd only)")
+@click.option('--download-concurrency', type=int, help="Run the download stage in edc with this many requests per host (see 'feed X download')")
+@click.option('--schedule/--no-schedule', default=False, help="Only run the stages and files that are out of date, pipelining unzip, parse and insert")
+@click.option('--dry-run', is_flag=True, help="Print the --schedule plan without running it")
+@click.option('--metrics/--no-metrics', 'with_metrics', default=False, help="Record per-stage metrics in [feed]/.edc/metrics.jsonl")
+@click.option('--prom-file', type=click.Path(), help="Also write this run's metrics to a Prometheus textfile")
 @click.pass_context
-def feed_procstage(ctx, stages):
+def feed_procstage(ctx, stages, workers, stream, extract, batch_size, codec, level, threads, download_concurrency, schedule, dry_run, with_metrics, prom_file):
     """
     Process the feed through the stages.
 
@@ -385,25 +835,85 @@ def feed_procstage(ctx, stages):
 
     Otherwise the stage argument can be any combination of these stages:
 
-        ['download', 'unzip', 'parse', 'insert', 'save', 'dist', 'arch']
-
+        ['download', 'unzip', 'parse', 'insert', 'save', 'dist', 'arch',
+         'export']
+
+    'export' is not part of 'all'. It writes the feed's tables to
+    partitioned Parquet in ./parquet (see 'feed X export').
+
+    With --workers N (N > 1), the 'unzip' and 'parse' stages are run by edc
+    over a pool of N processes instead of by the feed's ./src scripts. Each
+    file is added to the stage's state.txt as soon as it completes.
+
+    With --stream, the 'unzip', 'parse' and 'insert' stages are replaced by a
+    single pass that reads the xml out of each zip file and inserts it into
+    the db in one transaction, without writing xml or sql files. Streamed
+    zip files are recorded in ./db/state.txt.
+
+    With --no-extract, the 'unzip' stage does not write xml files. It
+    records each xml member's zip file and offset in ./xml/members.txt,
+    and the 'parse' stage reads the members straight out of the zip
+    files. Both stages are then run by edc.
+
+    With --download-concurrency N, the 'download' stage is run by edc,
+    N requests at a time with adaptive rate control, instead of by the
+    feed's ./src script (see 'feed X download').
+
+    With --codec, the 'dist' stage is run by edc instead of the feed's
+    ./src script, and the databases in ./dist/db are compressed with the
+    codec (e.g. '--codec zstd --threads 8' writes *.db.zst). Only the
+    files whose source changed since the last dist are rewritten. From
+    then on 'arch' is run by edc as well, and keeps ./dist for the next
+    dist, where the feed's ./src script deletes it.
+
+    A sharded feed (see 'feed X db shard') is always inserted by edc, into
+    the shard of each file's date, and its 'dist' is run by edc ('gzip'
+    unless --codec is given), so only the changed shards are recompressed.
+    Likewise a feed with a 'natural_key' in its manifest is inserted by
+    edc, as upserts.
+
+    With --schedule, edc works out which files and stages are out of date
+    and runs only those: 'unzip', 'parse' and 'insert' are pipelined over
+    --workers processes, and 'save' and 'dist' are skipped when their
+    inputs have not changed since they last ran. --dry-run prints the plan.
+
+    With --metrics, each stage's wall and cpu time, files and bytes
+    processed, rows inserted and peak memory are logged and appended to
+    the feed's metrics file (see 'feed X stats'), along with the time and
+    rows of each file edc inserts itself. Rows inserted by a ./src script
+    are not counted.
     """
     feed    = ctx.obj[FEED]
     path    = ctx.obj[EDDIR]
     logger  = ctx.obj[LOGGER]
-
-    valid_stages = copy.copy(clifeed.STAGES)
-    all_stages = copy.copy(valid_stages)
-    all_stages.append('all')
-    vstages = [filter_input_to_stage(all_stages, stage) for stage in stages]
-    
-    if 'all' in vstages:
-        vstages = valid_stages
-
-    for sout in clifeed.process_stages(logger, feed, path, vstages):
-        for output in sout:
-            for output2 in output:
-                click.echo(output)
+    vstages = expand_stages(stages)
+    records = []
+    run     = metrics.run_id() if with_metrics else None
+    def measure(stage):
+        if not with_metrics or dry_run:
+            return metrics.unmeasured()
+        return metrics.measure(logger, feed, path, stage, run, records)
+
+    if codec is None and 'dist' in vstages and edcshards.scheme(feed, path) is not None:
+        # the ./src dist script recompresses every shard
+        codec = 'gzip'
+    if schedule or dry_run:
+        if stream:
+            raise click.UsageError("--stream cannot be combined with --schedule")
+        dist = None
+        if codec is not None:
+            dist = lambda lg, f, p: edccodec.dist(lg, f, p, codec, level, threads)
+        download = None
+        if download_concurrency is not None:
+            download = lambda lg, f, p: edcdownload.download(lg, f, p, download_concurrency)
+        for output in edcschedule.run(logger, feed, path, vstages, workers, dry_run, dist, measure, extract, download):
+            click.echo(output)
+    else:
+        proc_stages(logger, feed, path, vstages, workers, stream, extract, batch_size, codec, level, threads, download_concurrency, measure)
+    if not dry_run:
+        statusindex.update(logger, feed, path)
+    if prom_file and records:
+        metrics.write_prometheus(prom_file, records)
 
 #@feed.command('procfile', short_help='Process a file through the stages in ./src')
 #@click.argument('stage')
@@ -429,34 +939,45 @@ def feed_procstage(ctx, stages):
 
 @feed.command('s3archive', short_help='Archive feed to S3 bucket')
 @click.option('--service', '-s', type=click.Choice(['wasabi', 'digitalocean',]), default='wasabi')
+@click.option('--concurrency', '-c', default=4, type=int, help="Number of parallel transfers")
+@click.option('--bwlimit', default="100M", help="[rclone] Bandwidth limit in kBytes/s, or use suffix b|k|M|G")
+@click.option('--store-dir', type=click.Path(), help="Archive to this directory instead of the S3 service")
 @click.pass_context
-def feed_archive_to_s3(ctx, service):
+def feed_archive_to_s3(ctx, service, concurrency, bwlimit, store_dir):
     """
     Archive feed to an S3 bucket.
+
+    Objects whose size and checksum already match the bucket are skipped,
+    and large files are uploaded in parallel multipart chunks.
     """
     feed    = ctx.obj[FEED]
     path    = ctx.obj[EDDIR]
     logger  = ctx.obj[LOGGER]
-    for output in clifeed.archive_to_s3(logger, feed, path, service):
+    for output in transfer.archive(logger, feed, path, service, concurrency, bwlimit, store_dir):
         click.echo(output)
 
 
 @feed.command('s3restore', short_help='Restore feed from from S3 bucket')
 @click.option('--service', '-s', type=click.Choice(['wasabi', 'digitalocean',]), default='wasabi')
+@click.option('--concurrency', '-c', default=4, type=int, help="Number of parallel transfers")
+@click.option('--store-dir', type=click.Path(exists=True), help="Restore from this directory instead of the S3 service")
 @click.pass_context
-def feed_restore_from_s3(ctx, service):
+def feed_restore_from_s3(ctx, service, concurrency, store_dir):
     """
     Restore from dist files on S3:
 
         [s3]/zip/*.zip      -> [feed]/zip/*.zip
-        [s3]/db/*.db.7z     -> [feed]/db/*.db   (decompresses after file transfer)
-        
+        [s3]/db/*.db.gz     -> [feed]/db/*.db   (decompressed while downloading)
+
+    Artifacts are downloaded in parallel. Interrupted downloads resume
+    where they stopped, each artifact is checked against the remote size
+    and md5, and artifacts that are already restored are skipped.
     """
     feed            = ctx.obj[FEED]
     path            = ctx.obj[EDDIR]
     logger          = ctx.obj[LOGGER]
 
-    for output in clifeed.restore_from_s3(logger, feed, path, service):
+    for output in transfer.restore(logger, feed, path, service, concurrency, store_dir):
         click.echo(output)
 
 @feed.command('s3urls', short_help='Urls to download artifacts from S3 bucket')
@@ -485,18 +1006,115 @@ def db():
 
 @db.command('createddl')
 @click.option("--xmlfile", "-x", help="File to scan")
-@click.option("--save/--no-save", default=False, help="Save ddl to manifest")
+@click.option("--save/--no-save", default=False, help="Save ddl and index ddl to manifest")
+@click.option("--indexes/--no-indexes", default=True, help="Also emit the inferred CREATE INDEX statements")
+@click.option("--sample", "-n", default=5, type=int, help="Number of xml files to sample and merge (0 for all)")
+@click.option("--workers", "-w", default=os.cpu_count(), type=int, help="Processes to parse the sampled files with")
 @click.pass_context
-def feed_db_create_ddl(ctx, xmlfile, save):
+def feed_db_create_ddl(ctx, xmlfile, save, indexes, sample, workers):
     """
     Generate SQL DDL for table creation.
 
-    If no xmlfile is provided, looks at the newest xml file in the feed.
+    If no xmlfile is provided, samples --sample xml files spread across the
+    feed (always including the newest) and merges their schemas, so that
+    optional columns are covered. Differences between the sampled files are
+    reported on stderr. Schemas are cached per file hash in
+    '[feed]/.edc/schema.json'.
+
+    Secondary indexes are inferred for the time, key (node, market,
+    resource, ...) and parent id columns. With --save the table ddl is
+    saved to the manifest's 'ddl_create' and the index ddl to
+    'ddl_index', which 'db optimize' uses.
+
+    A natural key is inferred for the leaf tables (e.g. report_data): the
+    columns other than the ids and the manifest's 'pk_exclusion'. With
+    --save it is saved to the manifest's 'natural_key', unless one is
+    declared there already, and the insert stage then upserts on it (see
+    'feed X reinsert'). Its unique index is printed with the other
+    indexes.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    (ddl, index_ddl, drift) = edcindexes.create_ddl(logger, feed, path, xmlfile, save, sample, workers)
+    keys    = edcupsert.infer_keys(feed, path, ddl)
+    if save:
+        keys = edcupsert.save_keys(logger, feed, path, keys)
+    for line in drift:
+        click.echo("drift: %s" % line, err=True)
+    for statement in ddl + (index_ddl + edcupsert.index_ddl(keys) if indexes else []):
+        click.echo(statement)
+
+@db.command('checkschema', short_help='Check xml files against the feed tables')
+@click.option("--sample", "-n", default=0, type=int, help="Number of xml files to check (0 for all)")
+@click.option("--workers", "-w", default=os.cpu_count(), type=int, help="Processes to parse the files with")
+@click.pass_context
+def feed_db_check_schema(ctx, sample, workers):
+    """
+    List the xml files with columns that the feed's tables lack, and that
+    would fail to insert. The tables come from the manifest's 'ddl_create',
+    or from the feed's first database when that is empty. Exits with
+    status 1 if there are any. Schemas are cached per file hash, so
+    re-checking is quick.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    bad     = 0
+    for (f, lines) in edcschema.check(logger, feed, path, sample, workers):
+        bad += 1
+        for line in lines:
+            click.echo("%s: %s" % (f, line))
+    if bad:
+        sys.exit(1)
+
+@db.command('optimize', short_help='Build indexes, ANALYZE and VACUUM the feed databases')
+@click.option("--vacuum/--no-vacuum", default=True, help="VACUUM the databases")
+@click.pass_context
+def feed_db_optimize(ctx, vacuum):
+    """
+    Build the missing secondary indexes, then run ANALYZE, 'PRAGMA
+    optimize' and VACUUM on each of the feed's databases.
+
+    The indexes come from the manifest's 'ddl_index' (see 'db createddl
+    --save'), or are inferred from the database tables. Run this after a
+    bulk insert: indexes are not maintained during the insert stage.
     """
     feed    = ctx.obj[FEED]
     path    = ctx.obj[EDDIR]
     logger  = ctx.obj[LOGGER]
-    click.echo(clifeed.create_and_save_ddl(logger, feed, path, xmlfile, save))
+    for line in edcindexes.optimize(logger, feed, path, vacuum):
+        click.echo(line)
+
+@db.command('shard', short_help='Partition the feed database by month or year')
+@click.option("--by", type=click.Choice(['month', 'year', 'none']), help="Set the shard scheme for future inserts")
+@click.pass_context
+def feed_db_shard(ctx, by):
+    """
+    Partition the feed database by time. With --by month (or year), later
+    inserts write each file to the database of its month (or year),
+    '[name]_201909_00.db', so adding a day only changes the current shard
+    and 'dist', 's3archive' and 's3restore' only process that shard.
+    '--by none' goes back to the single '[name]_00.db'. Existing rows stay
+    where they are.
+
+    Writes '[name].attach.sql' to the db directory, which attaches every
+    shard and creates a view per table over all of them:
+
+        $ cd [feed]/db && sqlite3 -init [name].attach.sql
+
+    and lists the databases as 'shard size file'. 'edc query' builds the
+    same views on the fly.
+    """
+    feed    = ctx.obj[FEED]
+    path    = ctx.obj[EDDIR]
+    logger  = ctx.obj[LOGGER]
+    if by is not None:
+        clifeed.manifest_update(logger, feed, path, 'shard', None if by == 'none' else by, None)
+    if os.path.isdir(os.path.join(path, 'data', feed, 'db')):
+        click.echo(edcshards.write_attach_script(logger, feed, path))
+    for (f, key, size) in edcshards.shards(feed, path):
+        click.echo("%-8s %12d %s" % (key or "-", size, f))
 
 @db.command('insertsql')
 @click.argument('xmlfile')
@@ -583,6 +1201,76 @@ def feed_manifest_update(ctx, field, value_str, value_int):
     logger  = ctx.obj[LOGGER]
     clifeed.manifest_update(logger, feed, path, field, value_str, value_int)
 
+def proc_stages(logger, feed, path, vstages, workers, stream, extract, batch_size, codec, level, threads, download_concurrency, measure):
+    """
+    Run the stages for 'feed proc' (without --schedule), one after the other.
+    """
+    streamed = False
+    batch_size = edcstream.BATCH_SIZE if batch_size is None else batch_size
+
+    for stage in vstages:
+        if stream and stage in edcstream.STREAM_STAGES:
+            if not streamed:
+                with measure('stream'):
+                    for output in edcstream.process_stream(logger, feed, path, batch_size):
+                        click.echo(output)
+                streamed = True
+            continue
+        with measure(stage):
+            # the ./src scripts know nothing of indexed (unextracted) members
+            in_process = (stage == 'unzip' and not extract) or \
+                    (stage == 'parse' and edcstages.has_members(feed, path))
+            if stage in edcstages.PARALLEL_STAGES and (workers > 1 or in_process):
+                for output in edcstages.process_stage(logger, feed, path, stage, workers, extract):
+                    click.echo(output)
+                continue
+            if stage == 'insert' and edcschedule.edc_inserts(feed, path):
+                for output in edcschedule.insert(logger, feed, path):
+                    click.echo(output)
+                continue
+            if download_concurrency is not None and stage == 'download':
+                for output in edcdownload.download(logger, feed, path, download_concurrency):
+                    click.echo(output)
+                continue
+            if codec is not None and stage == 'dist':
+                for output in edccodec.dist(logger, feed, path, codec, level, threads):
+                    click.echo(output)
+                continue
+            if stage == 'arch' and edccodec.edc_dist(feed, path):
+                for output in transfer.arch(logger, feed, path):
+                    click.echo(output)
+                continue
+            if stage == 'export':
+                for output in edcexport.export(logger, feed, path):
+                    click.echo(output)
+                continue
+            for sout in clifeed.process_stages(logger, feed, path, [stage]):
+                for output in sout:
+                    for output2 in output:
+                        click.echo(output)
+
+def expand_stages(stages):
+    """
+    Validate the 'proc' stage arguments against clifeed.STAGES and edc's
+    own EXTRA_STAGES, expanding 'all' (to clifeed.STAGES) in place, so
+    that 'all export' runs export after the others. With 'all', the
+    clifeed.STAGES given on their own are already covered by it.
+    """
+    valid_stages = copy.copy(clifeed.STAGES)
+    all_stages = copy.copy(valid_stages) + EXTRA_STAGES
+    all_stages.append('all')
+    vstages = [filter_input_to_stage(all_stages, stage) for stage in stages]
+    
+    if 'all' in vstages:
+        expanded = []
+        for stage in vstages:
+            if stage == 'all':
+                expanded.extend(valid_stages)
+            elif stage not in valid_stages:
+                expanded.append(stage)
+        vstages = expanded
+    return vstages
+
 def filter_input_to_stage(valid_stages, s):
     """
     Typically stages = clifeed.STAGES, and 's' is a particular stage
@@ -0,0 +1,298 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+metrics.py : per-stage instrumentation for `feed proc`
+
+Each stage run is measured from the outside, so the same numbers are
+collected whether the stage runs in edc or as a './src' script:
+
+    wall_seconds    : elapsed time
+    cpu_seconds     : user + system time of edc and its child processes
+    resources       : resources the stage recorded in the state store
+                      (see `edc.statestore`) while it ran
+    bytes_read      : size of those resources in the stage's source dir
+    bytes_written   : growth of the stage's working dir (its full size
+                      for REBUILT_STAGES, which start from scratch)
+    rows_inserted   : rows written by the in-process inserters, None
+                      when a './src' script inserted (ROW_STAGES)
+    peak_rss_kb     : high water mark (ru_maxrss) of edc and of its
+                      largest child process since edc started, which is
+                      not the stage's own peak: it never goes down from
+                      one stage to the next
+
+The in-process inserters (`edc.stream` and `edc.schedule.Inserter`)
+report each resource they insert with `report`, from their connection's
+total_changes, so nothing is counted by scanning the databases. Those
+per-resource records carry a 'resource' key.
+
+Every record is logged with `edl.resources.log` and appended to
+'[feed]/.edc/metrics.jsonl'. A Prometheus textfile with the latest run
+can be written too.
+"""
+
+from edl.cli import feed as clifeed
+from edl.resources import log
+from edc import statestore
+from edc import statusindex
+import contextlib
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+METRICS_FILE    = "metrics.jsonl"
+FIELDS          = ["wall_seconds", "cpu_seconds", "resources", "bytes_read",
+                   "bytes_written", "rows_inserted", "peak_rss_kb"]
+HELP            = {
+        "wall_seconds"  : "elapsed time of the stage",
+        "cpu_seconds"   : "user + system time of edc and its child processes during the stage",
+        "resources"     : "resources the stage recorded in the state store",
+        "bytes_read"    : "size of the recorded resources in the stage's source dir",
+        "bytes_written" : "growth of the stage's working dir",
+        "rows_inserted" : "rows written by the in-process inserters",
+        "peak_rss_kb"   : "process-lifetime max RSS (ru_maxrss) of edc and its largest child so far, not per stage",
+        }
+ROW_STAGES      = ['insert', 'stream', 'pipeline']
+REBUILT_STAGES  = ['dist']
+# the state store table of the stages that are not store stages themselves
+STORE_STAGES    = {'stream': 'insert', 'pipeline': 'insert'}
+
+def metrics_file(feed, ed_path):
+    return os.path.join(statusindex.sidecar_dir(feed, ed_path), METRICS_FILE)
+
+def run_id():
+    return datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+
+def dir_size(path):
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return total
+
+class Collector():
+    """
+    The resources reported by the in-process stages while a stage is
+    measured. Reports may come from any thread.
+    """
+    def __init__(self, run, feed, stage):
+        self.run        = run
+        self.feed       = feed
+        self.stage      = stage
+        self.lock       = threading.Lock()
+        self.records    = []
+
+    def add(self, stage, resource, wall, rows, bytes_read):
+        with self.lock:
+            self.records.append({
+                "run"           : self.run,
+                "feed"          : self.feed,
+                "stage"         : stage,
+                "resource"      : resource,
+                "wall_seconds"  : round(wall, 3),
+                "rows_inserted" : rows,
+                "bytes_read"    : bytes_read,
+                })
+
+_collector = None
+"""_collector : the Collector of the stage being measured, if any"""
+
+def report(stage, resource, wall, rows, bytes_read=0):
+    """
+    Report a resource processed by an in-process stage. Does nothing
+    unless a stage is being measured.
+    """
+    collector = _collector
+    if collector is not None:
+        collector.add(stage, resource, wall, rows, bytes_read)
+
+def db_rows(db_dir):
+    if not os.path.isdir(db_dir):
+        return 0
+    return sum([statusindex.count_rows(os.path.join(db_dir, f))
+        for f in os.listdir(db_dir) if f.endswith(".db")])
+
+def cpu_seconds():
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        total += ru.ru_utime + ru.ru_stime
+    return total
+
+def peak_rss_kb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def stage_dirs(feed_dir, stage):
+    """
+    (source_dir, working_dir) for the stage, or None where there is none.
+    """
+    if stage == 'stream':
+        return (os.path.join(feed_dir, 'zip'), os.path.join(feed_dir, 'db'))
+    if stage == 'pipeline':
+        return (os.path.join(feed_dir, 'sql'), os.path.join(feed_dir, 'db'))
+    if stage not in clifeed.STAGES:
+        return (None, None)
+    idx     = clifeed.STAGES.index(stage)
+    source  = os.path.join(feed_dir, clifeed.DIRS[idx - 1]) if 0 < idx <= len(clifeed.DIRS) else None
+    working = os.path.join(feed_dir, clifeed.DIRS[idx]) if idx < len(clifeed.DIRS) else None
+    return (source, working)
+
+@contextlib.contextmanager
+def unmeasured(*args):
+    """
+    Stands in for `measure` when nothing is recorded, like
+    contextlib.nullcontext (3.7+).
+    """
+    yield
+
+@contextlib.contextmanager
+def measure(logger, feed, ed_path, stage, run, records):
+    """
+    Measure the enclosed stage run. The record is logged, appended to the
+    feed's metrics file and to the 'records' list. The resources reported
+    meanwhile are appended to the metrics file before it.
+    """
+    global _collector
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    (source_dir, working_dir) = stage_dirs(feed_dir, stage)
+    store_stage = STORE_STAGES.get(stage, stage)
+    before_size = dir_size(working_dir) if working_dir and stage not in REBUILT_STAGES else 0
+    before_cpu  = cpu_seconds()
+    start       = time.time()
+    collector   = Collector(run, feed, stage)
+    _collector  = collector
+    try:
+        yield
+    finally:
+        _collector  = None
+        wall        = time.time() - start
+        (added, bytes_read) = recorded_since(feed, ed_path, store_stage, source_dir, start)
+        rows        = None
+        if collector.records:
+            rows    = sum([r["rows_inserted"] for r in collector.records])
+        elif stage in ['stream', 'pipeline']:
+            rows    = 0
+        record = {
+            "run"           : run,
+            "feed"          : feed,
+            "stage"         : stage,
+            "wall_seconds"  : round(wall, 3),
+            "cpu_seconds"   : round(cpu_seconds() - before_cpu, 3),
+            "resources"     : added,
+            "bytes_read"    : bytes_read,
+            "bytes_written" : (dir_size(working_dir) - before_size) if working_dir else 0,
+            "rows_inserted" : rows if stage in ROW_STAGES else 0,
+            "peak_rss_kb"   : peak_rss_kb(),
+            }
+        records.append(record)
+        log.info(chlogger, dict([("name", __name__), ("method", "measure")] + list(record.items())))
+        for r in collector.records:
+            log.debug(chlogger, dict([("name", __name__), ("method", "measure")] + list(r.items())))
+        os.makedirs(statusindex.sidecar_dir(feed, ed_path), exist_ok=True)
+        with open(metrics_file(feed, ed_path), 'a') as f:
+            for r in collector.records + [record]:
+                f.write("%s\n" % json.dumps(r, sort_keys=True))
+
+def recorded_since(feed, ed_path, stage, source_dir, start):
+    """
+    (count, bytes) of the resources recorded for the stage in the state
+    store since 'start'. The size of the entries imported from a state
+    file, which have none, is read from source_dir.
+    """
+    if stage not in statestore.STAGES:
+        return (0, 0)
+    with statestore.StateStore(feed, ed_path) as store:
+        rows = store.cnx.execute("SELECT resource, size FROM \"%s\" WHERE recorded >= ?" % stage, (start,)).fetchall()
+    total = 0
+    for (name, size) in rows:
+        if size is None and source_dir is not None:
+            try:
+                size = os.stat(os.path.join(source_dir, name)).st_size
+            except OSError:
+                size = 0
+        total += size or 0
+    return (len(rows), total)
+
+def write_prometheus(path, records):
+    """
+    Write the records as a Prometheus textfile (for the node exporter's
+    textfile collector), replacing the file atomically.
+    """
+    lines = []
+    for field in FIELDS:
+        name = "edc_stage_%s" % field
+        lines.append("# HELP %s %s" % (name, HELP[field]))
+        lines.append("# TYPE %s gauge" % name)
+        for r in records:
+            if r[field] is not None:
+                lines.append('%s{feed="%s",stage="%s"} %s' % (name, r["feed"], r["stage"], r[field]))
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write("%s\n" % "\n".join(lines))
+    os.replace(tmp, path)
+
+def load(feed, ed_path):
+    records = []
+    try:
+        with open(metrics_file(feed, ed_path), 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+def stats(feed, ed_path, last):
+    """
+    Summarize the last 'last' runs: one line per stage per run, then the
+    mean of each stage over those runs. Yields lines. 'maxrss' is the
+    process-lifetime peak_rss_kb, not the stage's own.
+    """
+    records = [r for r in load(feed, ed_path) if "resource" not in r]
+    runs    = sorted(set([r["run"] for r in records]))[-last:] if last > 0 else []
+    records = [r for r in records if r["run"] in runs]
+    header  = "%-24s %-10s %9s %9s %7s %11s %11s %10s %10s" % (
+            "run", "stage", "wall(s)", "cpu(s)", "files", "read(KB)", "written(KB)", "rows", "maxrss(MB)")
+    def line(run, stage, r):
+        rows = "-" if r["rows_inserted"] is None else "%d" % r["rows_inserted"]
+        return "%-24s %-10s %9.2f %9.2f %7d %11.1f %11.1f %10s %10.1f" % (
+                run, stage, r["wall_seconds"], r["cpu_seconds"], r["resources"],
+                r["bytes_read"] / 1024.0, r["bytes_written"] / 1024.0,
+                rows, r["peak_rss_kb"] / 1024.0)
+    yield header
+    for r in records:
+        yield line(r["run"], r["stage"], r)
+    stages = []
+    for r in records:
+        if r["stage"] not in stages:
+            stages.append(r["stage"])
+    for stage in stages:
+        group = [r for r in records if r["stage"] == stage]
+        mean  = {}
+        for k in FIELDS:
+            values  = [g[k] for g in group if g[k] is not None]
+            mean[k] = sum(values) / float(len(values)) if values else None
+        yield line("mean (%d runs)" % len(group), stage, mean)
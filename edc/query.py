@@ -0,0 +1,337 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+query.py : one sql query over many feed databases
+
+The feed databases ('[feed]/db/*.db') are attached read-only to a single
+in-memory sqlite3 connection, and a TEMP view is created for every table
+name found: the UNION ALL of that table across the attached databases,
+plus a '_feed' column. Columns missing from a database's copy of the
+table (its schema grew later) read as NULL. So
+
+    SELECT _feed, count(*) FROM report_data GROUP BY _feed
+
+counts the rows of every feed at once.
+
+sqlite limits the number of attached databases (10 by default). When
+there are more databases than that, they are attached in batches and the
+query runs once per batch, so aggregates are per batch; narrow the feeds
+down with --match to get a single batch.
+
+With per_db=True the query instead runs against each database on its own,
+on a pool of threads, and every row is prefixed with '_feed' and '_db'.
+"""
+
+from edl.resources import log
+import csv
+import io
+import json
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+
+FORMATS         = ['csv', 'json', 'jsonl', 'arrow']
+ATTACH_LIMIT    = 10
+FETCH_SIZE      = 1000
+ARROW_BATCH     = 10000
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise RuntimeError("the arrow format requires the 'pyarrow' package: pip install pyarrow")
+    return pyarrow
+
+def feed_dbs(ed_path, feeds):
+    """
+    Return [(feed, db file)] for the databases of the feeds.
+    """
+    dbs = []
+    for feed in feeds:
+        db_dir = os.path.join(ed_path, 'data', feed, 'db')
+        if not os.path.isdir(db_dir):
+            continue
+        for f in sorted(os.listdir(db_dir)):
+            if f.endswith(".db"):
+                dbs.append((feed, os.path.join(db_dir, f)))
+    return dbs
+
+def ro_uri(path):
+    return "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(path))
+
+def quote_id(name):
+    return '"%s"' % name.replace('"', '""')
+
+def quote_str(value):
+    return "'%s'" % value.replace("'", "''")
+
+def connect():
+    return sqlite3.connect("file::memory:", uri=True)
+
+def attach_limit(cnx):
+    try:
+        return cnx.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:
+        return ATTACH_LIMIT
+
+def tables(cnx, schema):
+    """
+    Map : table name -> [column names] for the attached schema.
+    """
+    result = {}
+    for (name,) in cnx.execute("SELECT name FROM %s.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%%'" % schema).fetchall():
+        result[name] = [r[1] for r in cnx.execute("PRAGMA %s.table_info(%s)" % (schema, quote_id(name)))]
+    return result
+
+def view_statements(found):
+    """
+    The union views of the tables found, given as
+    {table : [(schema, feed, [columns])]}. Returns [(view, sql, number of
+    databases)].
+    """
+    result = []
+    for (table, sources) in sorted(found.items()):
+        columns = []
+        for (_, _, cols) in sources:
+            columns.extend([c for c in cols if c not in columns])
+        selects = []
+        for (schema, feed, cols) in sources:
+            exprs = [quote_str(feed) + " AS _feed"] + [
+                    quote_id(c) if c in cols else "NULL AS %s" % quote_id(c) for c in columns]
+            selects.append("SELECT %s FROM %s.%s" % (", ".join(exprs), schema, quote_id(table)))
+        result.append((table, "CREATE TEMP VIEW %s AS %s" % (quote_id(table), " UNION ALL ".join(selects)), len(sources)))
+    return result
+
+def create_views(cnx, attached):
+    """
+    Create the TEMP union view of each table over the attached databases,
+    given as [(schema, feed)]. Returns {view : number of databases}.
+    """
+    found = {}
+    for (schema, feed) in attached:
+        for (table, columns) in tables(cnx, schema).items():
+            found.setdefault(table, []).append((schema, feed, columns))
+    views = {}
+    for (table, sql, count) in view_statements(found):
+        cnx.execute(sql)
+        views[table] = count
+    return views
+
+def batches(dbs, size):
+    return [dbs[i:i + size] for i in range(0, len(dbs), size)]
+
+def attach_batch(cnx, batch):
+    attached = []
+    for (idx, (feed, db_file)) in enumerate(batch):
+        schema = "db%d" % idx
+        cnx.execute("ATTACH DATABASE ? AS %s" % schema, (ro_uri(db_file),))
+        attached.append((schema, feed))
+    return attached
+
+def query_attached(logger, dbs, sql, limit=None):
+    """
+    Run sql over the union views, batch by batch. Yields the column names,
+    then the rows.
+    """
+    chlogger    = logger.getChild(__name__)
+    probe       = connect()
+    limit       = limit or attach_limit(probe)
+    probe.close()
+    groups      = batches(dbs, limit)
+    if len(groups) > 1:
+        log.warning(chlogger, {
+            "name"      : __name__,
+            "method"    : "query_attached",
+            "databases" : len(dbs),
+            "batches"   : len(groups),
+            "WARNING"   : "more databases than the attach limit, the query runs once per batch",
+            })
+    header = None
+    for batch in groups:
+        cnx = connect()
+        try:
+            create_views(cnx, attach_batch(cnx, batch))
+            cnx.execute("PRAGMA query_only=ON")
+            cur = cnx.execute(sql)
+            if header is None:
+                header = [d[0] for d in cur.description or []]
+                yield header
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cnx.close()
+    if header is None:
+        yield []
+
+def _query_db(logger, feed, db_file, sql, out):
+    """
+    Run sql against one database, putting ('header', columns) and then
+    ('rows', [rows]) on the out queue. Errors are logged and the database
+    skipped.
+    """
+    try:
+        cnx = sqlite3.connect(ro_uri(db_file), uri=True)
+        try:
+            cnx.execute("PRAGMA query_only=ON")
+            cur = cnx.execute(sql)
+            out.put(('header', [d[0] for d in cur.description or []]))
+            prefix = (feed, os.path.basename(db_file))
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                out.put(('rows', [prefix + row for row in rows]))
+        finally:
+            cnx.close()
+    except sqlite3.Error as e:
+        log.error(logger, {
+            "name"      : __name__,
+            "method"    : "_query_db",
+            "feed"      : feed,
+            "db_file"   : db_file,
+            "sql"       : sql,
+            "ERROR"     : "query failed, database skipped",
+            "exception" : str(e),
+            })
+
+def query_per_db(logger, dbs, sql, workers):
+    """
+    Run sql against each database on up to 'workers' threads. Yields the
+    column names ('_feed', '_db', then the query's), then the rows, as
+    they arrive.
+    """
+    chlogger    = logger.getChild(__name__)
+    out         = queue.Queue(maxsize=max(1, workers) * 4)
+    todo        = queue.Queue()
+    for db in dbs:
+        todo.put(db)
+
+    def worker():
+        while True:
+            try:
+                (feed, db_file) = todo.get_nowait()
+            except queue.Empty:
+                break
+            _query_db(chlogger, feed, db_file, sql, out)
+        out.put(('done', None))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, min(workers, len(dbs))))]
+    for t in threads:
+        t.start()
+    header  = None
+    running = len(threads)
+    while running:
+        (kind, payload) = out.get()
+        if kind == 'done':
+            running -= 1
+        elif kind == 'header':
+            if header is None:
+                header = ['_feed', '_db'] + payload
+                yield header
+        else:
+            for row in payload:
+                yield row
+    if header is None:
+        yield []
+
+def list_views(logger, dbs, limit=None):
+    """
+    Yield (view, number of databases) for the union views over all dbs.
+    """
+    probe   = connect()
+    limit   = limit or attach_limit(probe)
+    probe.close()
+    counts  = {}
+    for batch in batches(dbs, limit):
+        cnx = connect()
+        try:
+            for (view, n) in create_views(cnx, attach_batch(cnx, batch)).items():
+                counts[view] = counts.get(view, 0) + n
+        finally:
+            cnx.close()
+    for view in sorted(counts.keys()):
+        yield (view, counts[view])
+
+def write(results, fmt, out):
+    """
+    Write the results (column names, then rows) to the binary stream out.
+    Returns the number of rows written.
+    """
+    results = iter(results)
+    header  = next(results)
+    count   = 0
+    if fmt == 'arrow':
+        return write_arrow(header, results, out)
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+    try:
+        if fmt == 'csv':
+            writer = csv.writer(text)
+            writer.writerow(header)
+            for row in results:
+                writer.writerow(row)
+                count += 1
+        elif fmt == 'jsonl':
+            for row in results:
+                text.write("%s\n" % json.dumps(dict(zip(header, row))))
+                count += 1
+        else:
+            text.write("[")
+            for row in results:
+                text.write("%s\n    %s" % ("," if count else "", json.dumps(dict(zip(header, row)))))
+                count += 1
+            text.write("\n]\n")
+        text.flush()
+    finally:
+        text.detach()
+    return count
+
+def write_arrow(header, results, out):
+    """
+    Write an Arrow IPC stream, ARROW_BATCH rows per record batch. The
+    schema is inferred from the first batch.
+    """
+    pa      = _pyarrow()
+    writer  = None
+    count   = 0
+    def flush(rows, writer):
+        table = pa.Table.from_pylist([dict(zip(header, r)) for r in rows],
+                schema=writer.schema if writer is not None else None)
+        if writer is None:
+            writer = pa.ipc.new_stream(out, table.schema)
+        writer.write_table(table)
+        return writer
+    rows = []
+    for row in results:
+        rows.append(row)
+        count += 1
+        if len(rows) >= ARROW_BATCH:
+            writer = flush(rows, writer)
+            rows = []
+    if rows or writer is None:
+        if not rows and writer is None:
+            writer = pa.ipc.new_stream(out, pa.schema([(c, pa.null()) for c in header]))
+        else:
+            writer = flush(rows, writer)
+    writer.close()
+    return count
@@ -0,0 +1,183 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+repo.py : shallow, partial and parallel clone/update of the energy-dashboard
+
+Same operations as `edl.cli.repo`, with the knobs that make a fresh node
+practical:
+
+    depth   : shallow history (git --depth)
+    filter  : partial clone, e.g. 'blob:none' fetches blobs on demand
+              (git --filter)
+    jobs    : submodules fetched in parallel (git submodule update --jobs)
+    feeds   : only initialize the feed submodules matching these globs
+    lfs     : 'all' fetches the git-lfs database blobs (the default),
+              'skip' leaves the lfs pointer files in place, and 'lazy'
+              leaves them too but fetches a database when 'edc query'
+              needs it
+
+The lfs mode is kept in the energy-dashboard repo's git config
+('edc.lfs'), so that 'edc query' knows whether it may fetch.
+"""
+
+from edl.resources.exec import runyield
+from edl.resources import log
+import fnmatch
+import os
+import shlex
+import subprocess
+
+URL         = "https://github.com/energy-analytics-project/energy-dashboard.git"
+LFS_MODES   = ['all', 'skip', 'lazy']
+LFS_CONFIG  = 'edc.lfs'
+LFS_POINTER = b"version https://git-lfs.github.com/spec/v1"
+
+def git_options(depth=None, filter_spec=None):
+    options = []
+    if depth is not None:
+        options.append("--depth %d" % depth)
+    if filter_spec is not None:
+        options.append("--filter=%s" % shlex.quote(filter_spec))
+    return options
+
+def lfs_env(lfs):
+    """
+    Prefix for a git command line so that checkouts leave the lfs
+    pointer files in place, unless lfs == 'all'.
+    """
+    return "" if lfs == 'all' else "GIT_LFS_SKIP_SMUDGE=1 "
+
+def clone(logger, ed_path, url=URL, depth=None, filter_spec=None, lfs='all'):
+    """
+    Clone the energy-dashboard into [ed_path]/energy-dashboard, without
+    its submodules (see `update`).
+    """
+    target  = os.path.splitext(os.path.basename(url.rstrip('/')))[0]
+    cmd     = " ".join(["%sgit clone" % lfs_env(lfs)] + git_options(depth, filter_spec) + [shlex.quote(url)])
+    cmd     = "%s && git -C %s config %s %s" % (cmd, shlex.quote(target), LFS_CONFIG, lfs)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "clone",
+        "path"      : ed_path,
+        "cmd"       : cmd,
+        })
+    return runyield(cmd, ed_path)
+
+def submodules(ed_path):
+    """
+    The submodule paths of the repo at ed_path, from its .gitmodules.
+    """
+    if not os.path.exists(os.path.join(ed_path, '.gitmodules')):
+        return []
+    proc = subprocess.run(["git", "config", "-f", ".gitmodules", "--get-regexp", r"^submodule\..*\.path$"],
+            cwd=ed_path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return sorted([line.split(' ', 1)[1] for line in proc.stdout.splitlines() if ' ' in line])
+
+def select(paths, patterns):
+    """
+    The submodule paths whose feed name (last path component) or path
+    matches any of the glob patterns. No patterns selects all of them.
+    """
+    if not patterns:
+        return paths
+    return [p for p in paths if any([fnmatch.fnmatchcase(os.path.basename(p), pat)
+        or fnmatch.fnmatchcase(p, pat) for pat in patterns])]
+
+def update(logger, ed_path, jobs=1, depth=None, filter_spec=None, feeds=None, lfs=None):
+    """
+    Initialize and update the submodules, or only the feeds matching the
+    'feeds' patterns, 'jobs' at a time. lfs=None keeps the repo's lfs
+    mode.
+    """
+    lfs   = lfs_mode(ed_path) if lfs is None else lfs
+    paths = submodules(ed_path)
+    if feeds:
+        paths = select(paths, feeds)
+        if not paths:
+            log.warning(logger, {
+                "name"      : __name__,
+                "method"    : "update",
+                "path"      : ed_path,
+                "feeds"     : feeds,
+                "WARNING"   : "no submodule matches the feeds patterns",
+                })
+            return iter([])
+    cmd = " ".join(["%sgit submodule update --init --recursive --jobs %d" % (lfs_env(lfs), max(1, jobs))]
+            + git_options(depth, filter_spec))
+    if feeds:
+        cmd = "%s -- %s" % (cmd, " ".join([shlex.quote(p) for p in paths]))
+    cmd = "git config %s %s && %s" % (LFS_CONFIG, lfs, cmd)
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "update",
+        "path"      : ed_path,
+        "submodules": len(paths),
+        "cmd"       : cmd,
+        })
+    return runyield(cmd, ed_path)
+
+def lfs_mode(ed_path):
+    proc = subprocess.run(["git", "config", "--get", LFS_CONFIG], cwd=ed_path,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    mode = proc.stdout.strip()
+    return mode if mode in LFS_MODES else 'all'
+
+def is_lfs_pointer(path):
+    if os.path.getsize(path) > 1024:
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(LFS_POINTER)) == LFS_POINTER
+
+def fetch_dbs(logger, ed_path, dbs):
+    """
+    Make the (feed, db file) pairs usable: the databases that are still
+    lfs pointer files are fetched when the lfs mode is 'lazy', and left
+    out otherwise. Returns the usable pairs.
+    """
+    pointers = [(feed, f) for (feed, f) in dbs if is_lfs_pointer(f)]
+    if not pointers:
+        return dbs
+    mode    = lfs_mode(ed_path)
+    missing = set()
+    for feed in sorted(set([feed for (feed, _) in pointers])):
+        files   = [f for (fd, f) in pointers if fd == feed]
+        ok      = False
+        if mode == 'lazy':
+            feed_dir    = os.path.join(ed_path, 'data', feed)
+            include     = ",".join([os.path.relpath(f, feed_dir) for f in files])
+            proc        = subprocess.run(["git", "lfs", "pull", "--include=%s" % include], cwd=feed_dir,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            ok          = proc.returncode == 0 and not any([is_lfs_pointer(f) for f in files])
+            log.info(logger, {
+                "name"      : __name__,
+                "method"    : "fetch_dbs",
+                "feed"      : feed,
+                "files"     : len(files),
+                "fetched"   : ok,
+                "output"    : proc.stdout.strip(),
+                })
+        if not ok:
+            missing.update(files)
+            log.warning(logger, {
+                "name"      : __name__,
+                "method"    : "fetch_dbs",
+                "feed"      : feed,
+                "lfs"       : mode,
+                "files"     : files,
+                "WARNING"   : "databases are git-lfs pointers, skipped ('edc update --lfs lazy' fetches them on use)",
+                })
+    return [(feed, f) for (feed, f) in dbs if f not in missing]
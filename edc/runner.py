@@ -0,0 +1,206 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+runner.py : run feed stages across many feeds concurrently
+"""
+
+from edl.cli import feed as clifeed
+from edl.cli import feeds as clifeeds
+from edl.resources import log
+from edc import codec as edccodec
+from edc import schedule as edcschedule
+from edc import shards as edcshards
+import concurrent.futures
+import fnmatch
+import os
+import queue
+import re
+import subprocess
+import sys
+import time
+
+def select_feeds(logger, ed_path, patterns, regex=False):
+    """
+    Return the sorted list of feeds under [ed_path]/data that match any of
+    the patterns. Patterns are globs, or regular expressions if regex==True.
+    No patterns selects every feed.
+    """
+    data_dir = os.path.join(ed_path, "data")
+    feeds = sorted([f for f in clifeeds.list(logger, ed_path)
+        if os.path.isdir(os.path.join(data_dir, f))])
+    if not patterns:
+        return feeds
+    if regex:
+        matchers = [re.compile(p) for p in patterns]
+        return [f for f in feeds if any(m.search(f) for m in matchers)]
+    return [f for f in feeds if any(fnmatch.fnmatchcase(f, p) for p in patterns)]
+
+def stage_cmd(logger, stage):
+    """
+    Command line for a stage script, identical to `clifeed.process_file`.
+    """
+    level = log.LOGGING_LEVEL_STRINGS[logger.getEffectiveLevel()]
+    return "%s %s" % (os.path.join("src", clifeed.STAGE_PROCS[stage]), level)
+
+def edc_stage(logger, feed, ed_path, stage, options):
+    """
+    The command line of a stage that edc runs instead of the feed's ./src
+    script, as 'feed X proc' does, or None when the script runs. It is
+    'edc feed X proc [stage]', in a child process like the scripts, so
+    feeds do not share the GIL and a stage that exits cannot take the
+    pool down. Sharded and upserted feeds are always inserted by edc,
+    sharded feeds always dist'd by it, and a ./dist built by edc is
+    archived by it. 'options' holds the 'feeds proc' options: codec,
+    level, threads and download_concurrency.
+    """
+    codec   = options.get('codec')
+    args    = []
+    if codec is not None:
+        args.extend(['--codec', codec, '--threads', str(options.get('threads', 1))])
+        if options.get('level') is not None:
+            args.extend(['--level', str(options['level'])])
+    if options.get('download_concurrency') is not None:
+        args.extend(['--download-concurrency', str(options['download_concurrency'])])
+    in_edc  = stage == 'export' \
+            or (stage == 'insert' and edcschedule.edc_inserts(feed, ed_path)) \
+            or (stage == 'dist' and (codec is not None or edcshards.scheme(feed, ed_path) is not None)) \
+            or (stage == 'arch' and edccodec.edc_dist(feed, ed_path)) \
+            or (stage == 'download' and options.get('download_concurrency') is not None)
+    if not in_edc:
+        return None
+    level = log.LOGGING_LEVEL_STRINGS[logger.getEffectiveLevel()]
+    return [sys.executable, "-c", "from edc.main import cli; cli(prog_name='edc')",
+            "--ed-dir", os.path.abspath(ed_path), "--log-level", level,
+            "feed", feed, "proc", stage] + args
+
+def run_feed(logger, feed, ed_path, stages, emit, options=None):
+    """
+    Run the stages for a single feed, one after the other, stopping at the
+    first stage that fails. Each line of stage output is passed to
+    emit(feed, line).
+
+    Unlike `clifeed.process_file`, this does not go through `runyield`,
+    which buffers into a shared './edc.log' and cannot be used by more than
+    one feed at a time. Every stage, script or edc (see `edc_stage`), runs
+    as a child process.
+
+    Returns a result dict: {feed, seconds, returncode, stage}
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    start       = time.time()
+    result      = {"feed": feed, "seconds": 0.0, "returncode": 0, "stage": None}
+    options     = options or {}
+    stage       = None
+    try:
+        found_src_files = clifeed.src_files(chlogger, feed, ed_path)
+        for stage in stages:
+            cmd = edc_stage(chlogger, feed, ed_path, stage, options)
+            if cmd is None:
+                if clifeed.STAGE_PROCS[stage] not in found_src_files:
+                    log.debug(chlogger, {
+                        "name"      : __name__,
+                        "method"    : "run_feed",
+                        "path"      : ed_path,
+                        "feed"      : feed,
+                        "stage"     : stage,
+                        "ERROR"     : "stage_file not in src_files"
+                        })
+                    continue
+                cmd = stage_cmd(chlogger, stage)
+            log.debug(chlogger, {
+                "name"      : __name__,
+                "method"    : "run_feed",
+                "path"      : ed_path,
+                "feed"      : feed,
+                "cmd"       : cmd
+                })
+            proc = subprocess.Popen(cmd, cwd=feed_dir, shell=isinstance(cmd, str),
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in proc.stdout:
+                emit(feed, line.decode('utf-8', 'replace').rstrip())
+            proc.wait()
+            if proc.returncode != 0:
+                result["returncode"]    = proc.returncode
+                result["stage"]         = stage
+                break
+    except BaseException as e:
+        # BaseException: edl's log.critical raises SystemExit
+        log.error(chlogger, {
+            "name"      : __name__,
+            "method"    : "run_feed",
+            "path"      : ed_path,
+            "feed"      : feed,
+            "stage"     : stage,
+            "ERROR"     : "failed to process feed",
+            "exception" : repr(e)
+            })
+        result["returncode"]    = 1
+        result["stage"]         = stage
+    result["seconds"] = time.time() - start
+    return result
+
+def process_feeds(logger, ed_path, feeds, stages, jobs, options=None):
+    """
+    Process the feeds through the stages, running at most 'jobs' feeds at
+    a time. Every stage runs as a child process, so the pool only
+    supervises them. 'options' are passed to `run_feed`.
+
+    Yields (feed, line, None) for each line of output as it arrives, and
+    (feed, None, result) when a feed finishes. See `run_feed` for result.
+    """
+    chlogger    = logger.getChild(__name__)
+    events      = queue.Queue()
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "process_feeds",
+        "path"      : ed_path,
+        "feeds"     : len(feeds),
+        "stages"    : stages,
+        "jobs"      : jobs
+        })
+
+    def emit(feed, line):
+        events.put((feed, line, None))
+
+    def work(feed):
+        result = {"feed": feed, "seconds": 0.0, "returncode": 1, "stage": None}
+        try:
+            result = run_feed(chlogger, feed, ed_path, stages, emit, options)
+        finally:
+            # process_feeds waits for one result per feed
+            events.put((feed, None, result))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for feed in feeds:
+            pool.submit(work, feed)
+        remaining = len(feeds)
+        while remaining > 0:
+            event = events.get()
+            if event[2] is not None:
+                remaining -= 1
+            yield event
+
+def summary(results):
+    """
+    Format the feed results as a table, slowest feed first.
+    """
+    width = max([len("feed name")] + [len(r["feed"]) for r in results])
+    fmt = "%%-%ds  %%10s  %%6s  %%s" % width
+    yield fmt % ("feed name", "seconds", "exit", "failed stage")
+    for r in sorted(results, key=lambda r: r["seconds"], reverse=True):
+        yield fmt % (r["feed"], "%.1f" % r["seconds"], r["returncode"], r["stage"] or "")
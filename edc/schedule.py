@@ -0,0 +1,527 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+schedule.py : make-style incremental scheduling of the feed stages
+
+The plan is worked out per resource before anything runs:
+
+    * a zip file is out of date for 'unzip' until it is in xml/state.txt
+    * an xml file is out of date for 'parse' until it is in sql/state.txt
+      (or sql/failed.txt)
+    * a sql file is out of date for 'insert' until it is in db/state.txt
+
+as looked up in the feed's state store (see `edc.statestore`).
+
+Files are not re-processed when they change after being recorded: the
+rows of a re-inserted file would get new ids and duplicate the old ones.
+`reinsert` re-processes selected files on purpose, which is idempotent
+for the tables with a natural key (see `edc.upsert`).
+
+'unzip', 'parse' and 'insert' then run as one pipeline: each zip file
+flows on to 'parse' as soon as it is unzipped, and each sql file to
+'insert' as soon as it is parsed, so file N can be inserting while file
+N+1 is parsing. Unzip and parse run on a process pool; a single thread
+owns the database connection and inserts.
+
+'save', 'dist' and 'export' are whole-feed stages. They run only when the
+signature of their inputs (name, size and mtime of each input file)
+differs from the one recorded in '[feed]/.edc/schedule.json' the last
+time they succeeded. 'arch' runs only when there is a ./dist to archive
+(that changed, when edc builds it), and 'download' always runs, since only the remote knows what is new.
+"""
+
+from edl.resources import filesystem
+from edl.resources import log
+from edl.resources import zp
+from edc import codec as edccodec
+from edc import export as edcexport
+from edc import metrics
+from edc import runner
+from edc import shards as edcshards
+from edc import stages as edcstages
+from edc import statestore
+from edc import statusindex
+from edc import stream as edcstream
+from edc import upsert as edcupsert
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import zipfile
+
+PIPELINE_STAGES = ['unzip', 'parse', 'insert']
+SCHEDULE_FILE   = "schedule.json"
+MAX_DEPTH       = 5
+
+# inputs of the whole-feed stages, as (directory, ending) pairs
+STAGE_INPUTS = {
+        'save'  : [('zip', 'state.txt'), ('xml', 'state.txt'), ('sql', 'state.txt'),
+                   ('db', 'state.txt'), ('save', 'state.txt'), ('', 'manifest.json')],
+        'dist'  : [('zip', '.zip'), ('zip', 'state.txt'), ('db', '.db')],
+        'export': [('db', '.db')],
+        'arch'  : [('dist/zip', ''), ('dist/db', '')],
+        }
+
+def schedule_file(feed, ed_path):
+    return os.path.join(statusindex.sidecar_dir(feed, ed_path), SCHEDULE_FILE)
+
+def load(feed, ed_path):
+    try:
+        with open(schedule_file(feed, ed_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save(feed, ed_path, stamps):
+    os.makedirs(statusindex.sidecar_dir(feed, ed_path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (schedule_file(feed, ed_path), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(stamps, f, indent=4, sort_keys=True)
+    os.replace(tmp, schedule_file(feed, ed_path))
+
+def inputs_signature(feed_dir, stage):
+    """
+    Digest of the name, size and mtime of every input of a whole-feed stage.
+    """
+    h = hashlib.sha1()
+    for (d, ending) in STAGE_INPUTS[stage]:
+        path = os.path.join(feed_dir, d)
+        if not os.path.isdir(path):
+            continue
+        for f in sorted(os.listdir(path)):
+            if not f.endswith(ending):
+                continue
+            st = os.stat(os.path.join(path, f))
+            h.update(("%s/%s %d %d\n" % (d, f, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+def plan(logger, feed, ed_path, stages, readonly=False):
+    """
+    Work out what is out of date. Returns a dict with, for the pipeline
+    stages, the list of files to process and, for the other stages, a
+    boolean and the reason. With readonly==True the state store is opened
+    read-only, for a dry run.
+    """
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    stamps      = load(feed, ed_path)
+    result      = {}
+    store       = None
+    for stage in stages:
+        if stage in PIPELINE_STAGES:
+            if store is None:
+                store = statestore.StateStore(feed, ed_path, readonly=readonly)
+            (source_dir, working_dir, state_file, ending) = edcstages.stage_config(feed, ed_path, stage)
+            if stage == 'parse':
+                # includes the xml members indexed by a non-extracting unzip
+                found = store.pending('parse', edcstages.parse_inputs(source_dir, set()).keys(), statestore.HANDLED)
+            else:
+                found = store.pending(stage, filesystem.glob_dir(source_dir, ending) if os.path.isdir(source_dir) else [])
+            if stage == 'insert':
+                # a failed parse can leave a partial .sql behind
+                found = [f for f in found if not store.contains('parse', "%s.xml" % os.path.splitext(f)[0], ('failed',))]
+            result[stage] = sorted(found)
+        elif stage == 'download':
+            result[stage] = (True, "remote")
+        elif stage == 'arch':
+            exists = os.path.isdir(os.path.join(feed_dir, 'dist'))
+            if exists and edccodec.edc_dist(feed, ed_path):
+                # kept by edc's arch, so only archived when it changed
+                changed = stamps.get(stage) != inputs_signature(feed_dir, stage)
+                result[stage] = (changed, "dist changed" if changed else "up to date")
+            else:
+                result[stage] = (exists, "dist ready" if exists else "no ./dist")
+        else:
+            sig = inputs_signature(feed_dir, stage)
+            changed = stamps.get(stage) != sig
+            result[stage] = (changed, "inputs changed" if changed else "up to date")
+    if store is not None:
+        store.close()
+    return result
+
+def describe(stages, todo):
+    """
+    Human readable lines for a plan.
+    """
+    for stage in stages:
+        if stage in PIPELINE_STAGES:
+            extra = ""
+            idx = PIPELINE_STAGES.index(stage)
+            if idx > 0 and PIPELINE_STAGES[idx - 1] in stages:
+                extra = ", plus the output of '%s'" % PIPELINE_STAGES[idx - 1]
+            yield "%-9s %d file(s)%s" % (stage, len(todo[stage]), extra)
+        else:
+            (run, reason) = todo[stage]
+            yield "%-9s %s (%s)" % (stage, "run" if run else "skip", reason)
+
+def _unzip(resource_name, f, source_dir, working_dir):
+    """
+    Unzip f, returning (f, xml members) or (None, error).
+    """
+    if not zp.unzip_file(f, resource_name, source_dir, working_dir):
+        return (None, "unzip failed")
+    with zipfile.ZipFile(os.path.join(source_dir, f), 'r') as zf:
+        return (f, [m for m in zf.namelist() if m.endswith('.xml')])
+
+class Inserter(threading.Thread):
+    """
+    Insert sql files into the feed database from a queue, in the order
+    they arrive. A file that fails against [name]_00.db is retried on
+    [name]_01.db and so on, like `edl.resources.db.insert_file`. With a
+    shard scheme, each file goes to the shard of its date (see
+    `edc.shards`). With natural keys, inserts into the keyed tables are
+    upserts (see `edc.upsert`).
+    """
+    def __init__(self, logger, feed, ed_path, resource_name, sql_dir, db_dir, shard=None, keys=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.logger         = logger
+        self.feed           = feed
+        self.ed_path        = ed_path
+        self.resource_name  = resource_name
+        self.sql_dir        = sql_dir
+        self.db_dir         = db_dir
+        self.shard          = shard
+        self.keys           = keys or {}
+        self.queue          = queue.Queue()
+        self.done           = queue.Queue()
+        self.cnxs           = {}
+        self.indexed        = {}
+        """indexed : map : db name -> tables with their natural key index"""
+
+    def connection(self, period, depth):
+        name = edcshards.db_name(self.resource_name, period, depth)
+        if name not in self.cnxs:
+            self.cnxs[name]     = edcstream.connect(os.path.join(self.db_dir, name))
+            self.indexed[name]  = set()
+        return (name, self.cnxs[name])
+
+    def insert(self, f):
+        start = time.time()
+        with open(os.path.join(self.sql_dir, f), 'r') as fh:
+            script = edcupsert.upsert_script(fh.read(), self.keys)
+        period = edcshards.shard_key(f, self.shard)
+        for depth in range(MAX_DEPTH + 1):
+            (name, cnx) = self.connection(period, depth)
+            try:
+                if self.keys:
+                    edcupsert.ensure_indexes(self.logger, cnx, self.keys, self.indexed[name])
+                changes = cnx.total_changes
+                cnx.executescript("BEGIN;\n%s\nCOMMIT;" % script)
+                metrics.report('insert', f, time.time() - start, cnx.total_changes - changes,
+                        os.path.getsize(os.path.join(self.sql_dir, f)))
+                if self.keys:
+                    # the first file into a database creates its tables
+                    edcupsert.ensure_indexes(self.logger, cnx, self.keys, self.indexed[name])
+                return True
+            except Exception as e:
+                if cnx.in_transaction:
+                    cnx.execute("ROLLBACK")
+                log.error(self.logger, {
+                    "name"      : __name__,
+                    "method"    : "Inserter.insert",
+                    "sql_file"  : f,
+                    "shard"     : period,
+                    "depth"     : depth,
+                    "ERROR"     : "insert sql_file failed",
+                    "exception" : str(e),
+                    })
+        return False
+
+    def run(self):
+        # the store's connection belongs to this thread
+        with statestore.StateStore(self.feed, self.ed_path, sync=False) as store:
+            while True:
+                f = self.queue.get()
+                if f is None:
+                    break
+                if self.insert(f):
+                    store.record('insert', [f], self.sql_dir)
+                    self.done.put(f)
+        for cnx in self.cnxs.values():
+            cnx.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            cnx.close()
+
+def drain(inserter):
+    while inserter is not None and not inserter.done.empty():
+        yield "[insert] %s" % inserter.done.get()
+
+def run_pipeline(logger, feed, ed_path, stages, todo, workers, extract=True):
+    """
+    Run the pipeline stages for the planned files. Yields "[stage] file"
+    for each file as it completes a stage. With extract=False, zip files
+    are indexed instead of unzipped, and parsed from the zip (see
+    `edc.stages`).
+    """
+    chlogger        = logger.getChild(__name__)
+    resource_name   = edcstages.manifest(feed, ed_path)['name']
+    config          = dict([(s, edcstages.stage_config(feed, ed_path, s)) for s in PIPELINE_STAGES])
+    for s in PIPELINE_STAGES:
+        os.makedirs(config[s][1], exist_ok=True)
+    with statestore.StateStore(feed, ed_path) as store:
+        inserter = None
+        if 'insert' in stages:
+            (sql_dir, db_dir, _, _) = config['insert']
+            shard    = edcshards.scheme(feed, ed_path)
+            inserter = Inserter(chlogger, feed, ed_path, resource_name, sql_dir, db_dir, shard, edcupsert.keys(feed, ed_path))
+            inserter.start()
+            for f in todo['insert']:
+                inserter.queue.put(f)
+
+        # files queued in this run, so that nothing is queued twice
+        seen    = {'parse': set(), 'unzip': set()}
+        members = edcstages.read_members(config['parse'][0])
+        level   = log.LOGGING_LEVEL_STRINGS[chlogger.getEffectiveLevel()]
+        files   = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, workers),
+                initializer=edcstages._init_worker, initargs=(level,)) as pool:
+            def submit(stage, f):
+                if f in seen[stage] or (stage == 'parse' and store.contains('parse', f, statestore.HANDLED)):
+                    return
+                seen[stage].add(f)
+                (source_dir, working_dir, _, _) = config[stage]
+                if stage == 'parse':
+                    future = pool.submit(edcstages._parse, resource_name, f, source_dir, working_dir, members.get(f))
+                else:
+                    future = pool.submit(_unzip if extract else edcstages._index, resource_name, f, source_dir, working_dir)
+                files[future] = (stage, f)
+            for stage in ['unzip', 'parse']:
+                if stage in stages:
+                    for f in todo[stage]:
+                        submit(stage, f)
+            while files:
+                (done, _) = concurrent.futures.wait(list(files.keys()), timeout=1,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for line in drain(inserter):
+                    yield line
+                for future in done:
+                    (stage, f)      = files.pop(future)
+                    (result, extra) = future.result()
+                    (source_dir, working_dir, _, _) = config[stage]
+                    if stage == 'unzip' and not extract:
+                        if result:
+                            edcstages.write_members(working_dir, extra)
+                            members.update(dict([(e[0], e) for e in extra]))
+                            extra = [e[0] for e in extra]
+                        else:
+                            (result, extra) = (None, "index failed")
+                    if result is None:
+                        if stage == 'parse':
+                            store.record('parse', [f], source_dir, 'failed')
+                        log.error(chlogger, {
+                            "name"      : __name__,
+                            "method"    : "run_pipeline",
+                            "feed"      : feed,
+                            "stage"     : stage,
+                            "file"      : f,
+                            "ERROR"     : "failed to process file",
+                            "exception" : extra,
+                            })
+                        continue
+                    store.record(stage, [result], source_dir)
+                    yield "[%s] %s" % (stage, result)
+                    if stage == 'unzip' and 'parse' in stages:
+                        for member in extra:
+                            submit('parse', member)
+                    elif stage == 'parse' and inserter is not None:
+                        inserter.queue.put("%s.sql" % os.path.splitext(result)[0])
+
+        if inserter is not None:
+            inserter.queue.put(None)
+            inserter.join()
+            for line in drain(inserter):
+                yield line
+            store.rewrite('save', filesystem.glob_dir(config['insert'][1], ".db"))
+            if shard is not None:
+                edcshards.refresh_attach_script(chlogger, feed, ed_path)
+
+def edc_inserts(feed, ed_path):
+    """
+    True when the feed's insert stage must be run by edc rather than its
+    ./src script, which knows neither shards nor upserts.
+    """
+    return edcshards.scheme(feed, ed_path) is not None or bool(edcupsert.keys(feed, ed_path))
+
+def insert(logger, feed, ed_path):
+    """
+    Run the 'insert' stage on its own, with the `Inserter`. Yields
+    "[insert] file" for each sql file inserted.
+    """
+    todo = plan(logger, feed, ed_path, ['insert'])
+    for line in run_pipeline(logger, feed, ed_path, ['insert'], todo, 1):
+        yield line
+
+def delete_inserted(logger, feed, ed_path, sql_files):
+    """
+    Delete the rows that the sql files inserted from the databases of
+    their shard, at every depth (see `Inserter`).
+    """
+    resource_name           = edcstages.manifest(feed, ed_path)['name']
+    (sql_dir, db_dir, _, _) = edcstages.stage_config(feed, ed_path, 'insert')
+    shard                   = edcshards.scheme(feed, ed_path)
+    for f in sql_files:
+        if not os.path.exists(os.path.join(sql_dir, f)):
+            log.warning(logger, {
+                "name"      : __name__,
+                "method"    : "delete_inserted",
+                "sql_file"  : f,
+                "WARNING"   : "no earlier sql file, its inserted rows are not deleted",
+                })
+            continue
+        with open(os.path.join(sql_dir, f), 'r') as fh:
+            script = fh.read()
+        period = edcshards.shard_key(f, shard)
+        for depth in range(MAX_DEPTH + 1):
+            db_path = os.path.join(db_dir, edcshards.db_name(resource_name, period, depth))
+            if os.path.exists(db_path):
+                edcupsert.delete_rows(logger, script, db_path)
+
+def reinsert(logger, feed, ed_path, pattern, from_stage, workers, extract=True):
+    """
+    Re-process the files matching the glob pattern from 'from_stage'
+    ('unzip' matches zip files, 'parse' xml files, 'insert' sql files)
+    through 'insert', leaving the rest of the feed alone. The files are
+    removed from the state files of the stages they go through and run
+    through the pipeline again. Yields "[stage] file" lines.
+
+    The rows of the earlier parse of each sql file are deleted from the
+    feed database(s) first, by id, so that re-parsed rows (which get new
+    ids) do not add to them. Without the earlier sql file the old rows
+    cannot be found, and only a natural key (see `edc.upsert`) keeps the
+    re-parsed rows from being inserted next to them.
+    """
+    chlogger    = logger.getChild(__name__)
+    config      = dict([(s, edcstages.stage_config(feed, ed_path, s)) for s in PIPELINE_STAGES])
+    stages      = PIPELINE_STAGES[PIPELINE_STAGES.index(from_stage):]
+    (source_dir, _, _, ending) = config[from_stage]
+    if from_stage == 'parse':
+        found = edcstages.parse_inputs(source_dir, set()).keys()
+    else:
+        found = filesystem.glob_dir(source_dir, ending) if os.path.isdir(source_dir) else []
+    matched     = sorted(fnmatch.filter(found, pattern))
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "reinsert",
+        "feed"      : feed,
+        "pattern"   : pattern,
+        "from_stage": from_stage,
+        "files"     : len(matched),
+        })
+    # follow the files down the stages: zip -> xml members -> sql
+    names = {from_stage: set(matched)}
+    if from_stage == 'unzip':
+        xml = set()
+        for f in matched:
+            with zipfile.ZipFile(os.path.join(source_dir, f), 'r') as zf:
+                xml.update([m for m in zf.namelist() if m.endswith('.xml')])
+        names['parse'] = xml
+    if 'parse' in names:
+        names['insert'] = set(["%s.sql" % os.path.splitext(f)[0] for f in names['parse']])
+    if from_stage == 'unzip':
+        # unzip skips the xml files that are already extracted
+        xml_dir = config['parse'][0]
+        for f in names['parse']:
+            if os.path.exists(os.path.join(xml_dir, f)):
+                os.chmod(os.path.join(xml_dir, f), 0o644)
+                os.remove(os.path.join(xml_dir, f))
+    delete_inserted(chlogger, feed, ed_path, sorted(names['insert']))
+    with statestore.StateStore(feed, ed_path) as store:
+        for stage in stages:
+            store.forget(stage, names[stage])
+    todo = dict([(s, sorted(names[s]) if s == from_stage else []) for s in stages])
+    for line in run_pipeline(chlogger, feed, ed_path, stages, todo, workers, extract):
+        yield line
+
+def run(logger, feed, ed_path, stages, workers, dry_run=False, dist=None, measure=None, extract=True, download=None):
+    """
+    Bring the feed up to date for the stages. With dry_run==True only
+    the plan is yielded. 'dist', if given, is called as dist(logger, feed,
+    ed_path) and yields output lines, replacing the feed's dist script.
+    'measure', if given, is called as measure(stage) and returns a context
+    manager wrapped around each step ('pipeline' for unzip/parse/insert).
+    extract=False indexes zip members instead of unzipping them.
+    'download', if given, is called like 'dist' and replaces the feed's
+    download script.
+
+    Yields lines of output.
+    """
+    if measure is None:
+        measure = metrics.unmeasured
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    todo        = plan(chlogger, feed, ed_path, stages, readonly=dry_run)
+    for line in describe(stages, todo):
+        yield line
+    if dry_run:
+        return
+
+    def script(stage):
+        lines   = []
+        result  = runner.run_feed(chlogger, feed, ed_path, [stage], lambda f, line: lines.append(line))
+        return (result["returncode"] == 0, lines)
+
+    if 'download' in stages:
+        with measure('download'):
+            if download is not None:
+                (ok, lines) = (True, list(download(chlogger, feed, ed_path)))
+            else:
+                (ok, lines) = script('download')
+        for line in lines:
+            yield line
+        if not ok:
+            return
+        todo.update(plan(chlogger, feed, ed_path, [s for s in stages if s in PIPELINE_STAGES]))
+
+    pipeline = [s for s in stages if s in PIPELINE_STAGES]
+    if pipeline:
+        with measure('pipeline'):
+            for line in run_pipeline(chlogger, feed, ed_path, pipeline, todo, workers, extract):
+                yield line
+
+    for stage in [s for s in stages if s in ['save', 'dist', 'arch', 'export']]:
+        (needed, reason) = plan(chlogger, feed, ed_path, [stage])[stage]
+        if not needed:
+            continue
+        signature = inputs_signature(feed_dir, stage) if stage in STAGE_INPUTS else None
+        with measure(stage):
+            if stage == 'dist' and dist is not None:
+                for line in dist(chlogger, feed, ed_path):
+                    yield line
+                ok = True
+            elif stage == 'export':
+                for line in edcexport.export(chlogger, feed, ed_path):
+                    yield line
+                ok = True
+            else:
+                (ok, lines) = script(stage)
+                for line in lines:
+                    yield line
+        if not ok:
+            log.error(chlogger, {
+                "name"      : __name__,
+                "method"    : "run",
+                "feed"      : feed,
+                "stage"     : stage,
+                "ERROR"     : "stage failed",
+                })
+            return
+        if signature is not None:
+            stamps = load(feed, ed_path)
+            stamps[stage] = signature
+            save(feed, ed_path, stamps)
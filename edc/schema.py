@@ -0,0 +1,296 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+schema.py : cached, multi-file schema inference for the feed xml
+
+The schema of an xml file is what `xmlparser.XML2SQLTransormer` would
+create for it: the tables in creation order, and per table the columns
+and their types, the primary key and the foreign keys. Schemas are cached
+in '[feed]/.edc/schema.json' by the sha256 of the xml, so a file is only
+parsed once.
+
+Schemas of several files are merged: the union of the tables and columns,
+with a column's type widened as the parser does (NULL -> anything,
+INTEGER -> REAL, anything -> TEXT). Differences between the files (drift)
+are reported, and `check` lists the files whose columns do not fit the
+feed's tables, before an insert fails on them.
+"""
+
+from edl.resources import db as edldb
+from edl.resources import log
+from edl.resources import xmlparser
+from edc import stages as edcstages
+from edc import statusindex
+import concurrent.futures
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+
+CACHE_FILE  = "schema.json"
+TYPE_RANK   = {"": 0, "NULL": 0, "INTEGER": 1, "REAL": 2, "TEXT": 3, "BLOB": 3}
+
+def cache_file(feed, ed_path):
+    return os.path.join(statusindex.sidecar_dir(feed, ed_path), CACHE_FILE)
+
+def load_cache(feed, ed_path):
+    try:
+        with open(cache_file(feed, ed_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(feed, ed_path, cache):
+    os.makedirs(statusindex.sidecar_dir(feed, ed_path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (cache_file(feed, ed_path), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, sort_keys=True)
+    os.replace(tmp, cache_file(feed, ed_path))
+
+def from_ddl(ddl):
+    """
+    Schema of the tables created by the ddl statements:
+    {"order": [table], "tables": {table: {"columns": [[name, type]],
+    "pk": [column], "fk": [[column, parent table, parent column]]}}}
+    """
+    cnx = sqlite3.connect(":memory:")
+    try:
+        cnx.executescript("\n".join(ddl))
+        schema = {"order": [], "tables": {}}
+        for (table,) in cnx.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid"):
+            info = cnx.execute("PRAGMA table_info(%s)" % table).fetchall()
+            schema["order"].append(table)
+            schema["tables"][table] = {
+                    "columns"   : [[r[1], r[2]] for r in info],
+                    "pk"        : [r[1] for r in sorted(info, key=lambda r: r[5]) if r[5] > 0],
+                    "fk"        : [[r[3], r[2], r[4]] for r in cnx.execute("PRAGMA foreign_key_list(%s)" % table)],
+                    }
+        return schema
+    finally:
+        cnx.close()
+
+def from_xml(data):
+    """
+    Schema of the xml document (bytes).
+    """
+    logger = logging.getLogger(__name__)
+    xst = xmlparser.XML2SQLTransormer(logger, io.BytesIO(data)).parse().scan_all()
+    return from_ddl(list(xst.ddl()))
+
+def to_ddl(schema):
+    """
+    CREATE TABLE statements for the schema, in the same form as
+    `XML2SQLTransormer.ddl`.
+    """
+    ddl = []
+    for table in schema["order"]:
+        t = schema["tables"][table]
+        parts = ["%s %s" % (c, ty) for (c, ty) in t["columns"]]
+        parts.extend(["FOREIGN KEY (%s) REFERENCES %s(%s)" % (c, p, pc) for (c, p, pc) in t["fk"]])
+        ddl.append("CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s));" % (table, ", ".join(parts), ", ".join(t["pk"])))
+    return ddl
+
+def widen(a, b):
+    return a if TYPE_RANK.get(a, 3) >= TYPE_RANK.get(b, 3) else b
+
+def merge(schemas):
+    """
+    Merge {file : schema} into one schema. Returns (schema, drift), where
+    drift lists the differences between the files as lines.
+    """
+    merged  = {"order": [], "tables": {}}
+    seen    = {}
+    """seen : map : table -> {column -> {type -> [files]}}"""
+    tables  = {}
+    """tables : map : table -> [files]"""
+    for (f, schema) in sorted(schemas.items()):
+        for table in schema["order"]:
+            t = schema["tables"][table]
+            tables.setdefault(table, []).append(f)
+            if table not in merged["tables"]:
+                merged["order"].append(table)
+                merged["tables"][table] = {"columns": [], "pk": t["pk"], "fk": t["fk"]}
+            m = merged["tables"][table]
+            columns = dict(m["columns"])
+            for (c, ty) in t["columns"]:
+                seen.setdefault(table, {}).setdefault(c, {}).setdefault(ty, []).append(f)
+                if c not in columns:
+                    m["columns"].append([c, ty])
+                else:
+                    m["columns"] = [[mc, widen(mt, ty) if mc == c else mt] for (mc, mt) in m["columns"]]
+                columns = dict(m["columns"])
+    drift   = []
+    total   = len(schemas)
+    for table in merged["order"]:
+        if len(tables[table]) < total:
+            drift.append("table %s: in %d of %d files" % (table, len(tables[table]), total))
+        for (c, types) in sorted(seen[table].items()):
+            count = sum([len(fs) for fs in types.values()])
+            if count < len(tables[table]):
+                drift.append("column %s.%s: in %d of %d files" % (table, c, count, len(tables[table])))
+            if len(types) > 1:
+                drift.append("column %s.%s: types %s" % (table, c, ", ".join(
+                    ["%s (%d files)" % (ty, len(fs)) for (ty, fs) in sorted(types.items())])))
+    return (merged, drift)
+
+def xml_files(feed, ed_path):
+    """
+    Map : xml file -> members index entry (None for files on disk), for
+    every xml file of the feed, extracted or not.
+    """
+    return edcstages.parse_inputs(os.path.join(ed_path, 'data', feed, 'xml'), set())
+
+def pick(files, n):
+    """
+    Up to n of the sorted files, evenly spread and always including the
+    newest. n <= 0 picks all of them.
+    """
+    files = sorted(files)
+    if n <= 0 or n >= len(files):
+        return files
+    if n == 1:
+        return files[-1:]
+    step = (len(files) - 1) / float(n - 1)
+    return sorted(set([files[int(round(i * step))] for i in range(n)]))
+
+def _read(xml_dir, f, entry):
+    path = os.path.join(xml_dir, f)
+    if entry is None or os.path.exists(path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+    return edcstages.read_member(os.path.join(os.path.dirname(xml_dir), 'zip'), entry)
+
+def _scan(xml_dir, f, entry, cached):
+    """
+    Return (sha256, schema or None if cached, error).
+    """
+    try:
+        data    = _read(xml_dir, f, entry)
+        digest  = hashlib.sha256(data).hexdigest()
+        if digest in cached:
+            return (digest, None, None)
+        return (digest, from_xml(data), None)
+    except Exception as e:
+        return (None, None, str(e))
+
+def infer(logger, feed, ed_path, files, workers):
+    """
+    Return {file : schema} for the files ({file : members index entry}),
+    parsing the ones that are not cached on up to 'workers' processes.
+    Files that fail to parse are logged and left out.
+    """
+    chlogger    = logger.getChild(__name__)
+    xml_dir     = os.path.join(ed_path, 'data', feed, 'xml')
+    cache       = load_cache(feed, ed_path)
+    hits        = set(cache.keys())
+    result      = {}
+    parsed      = 0
+    level       = log.LOGGING_LEVEL_STRINGS[chlogger.getEffectiveLevel()]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, workers),
+            initializer=edcstages._init_worker, initargs=(level,)) as pool:
+        futures = {pool.submit(_scan, xml_dir, f, e, hits): f for (f, e) in files.items()}
+        for future in concurrent.futures.as_completed(futures):
+            f = futures[future]
+            (digest, schema, error) = future.result()
+            if error is not None:
+                log.error(chlogger, {
+                    "name"      : __name__,
+                    "method"    : "infer",
+                    "feed"      : feed,
+                    "xml_file"  : f,
+                    "ERROR"     : "failed to infer schema",
+                    "exception" : error,
+                    })
+                continue
+            if schema is not None:
+                cache[digest] = {"file": f, "schema": schema}
+                parsed += 1
+            result[f] = cache[digest]["schema"]
+    if parsed:
+        save_cache(feed, ed_path, cache)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "infer",
+        "feed"      : feed,
+        "files"     : len(files),
+        "parsed"    : parsed,
+        "cached"    : len(result) - parsed,
+        })
+    return result
+
+def misfits(schema, base):
+    """
+    Lines for the columns of schema that base's copy of the table lacks,
+    or whose type it cannot hold. Tables base lacks are created by the
+    insert ('CREATE TABLE IF NOT EXISTS'), so they are not misfits.
+    """
+    lines = []
+    for table in schema["order"]:
+        if table not in base["tables"]:
+            continue
+        have = dict(base["tables"][table]["columns"])
+        for (c, ty) in schema["tables"][table]["columns"]:
+            if c not in have:
+                lines.append("column %s.%s" % (table, c))
+            elif widen(have[c], ty) != have[c]:
+                lines.append("column %s.%s %s (is %s)" % (table, c, ty, have[c]))
+    return lines
+
+def base_ddl(feed, ed_path):
+    """
+    The manifest's 'ddl_create' or, when it is empty, the ddl of the feed's
+    first database, which the insert stage tries first.
+    """
+    feed_dir = os.path.join(ed_path, 'data', feed)
+    with open(os.path.join(feed_dir, 'manifest.json'), 'r') as f:
+        obj = json.load(f)
+    if obj.get('ddl_create'):
+        return obj['ddl_create']
+    db_file = os.path.join(feed_dir, 'db', edldb.gen_db_name(obj['name'], 0))
+    if not os.path.exists(db_file):
+        return []
+    cnx = sqlite3.connect("file:%s?mode=ro" % db_file, uri=True)
+    try:
+        return ["%s;" % r[0] for r in cnx.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid")]
+    finally:
+        cnx.close()
+
+def check(logger, feed, ed_path, sample, workers):
+    """
+    Check the schema of the sampled xml files (all with sample <= 0)
+    against `base_ddl`. Yields (file, [misfits]) for the files that would
+    fail to insert.
+    """
+    chlogger = logger.getChild(__name__)
+    ddl      = base_ddl(feed, ed_path)
+    if not ddl:
+        log.warning(chlogger, {
+            "name"      : __name__,
+            "method"    : "check",
+            "feed"      : feed,
+            "WARNING"   : "no 'ddl_create' in the manifest and no database, nothing to check against",
+            })
+        return
+    base    = from_ddl(ddl)
+    files   = xml_files(feed, ed_path)
+    chosen  = dict([(f, files[f]) for f in pick(files.keys(), sample)])
+    for (f, schema) in sorted(infer(chlogger, feed, ed_path, chosen, workers).items()):
+        lines = misfits(schema, base)
+        if lines:
+            yield (f, lines)
@@ -0,0 +1,196 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+search.py : full text search over the feed manifests
+
+The index is a sqlite3 FTS5 table in '[ed_path]/.edc/search.db'. Each
+feed's manifest.json is re-indexed only when its mtime changes, and feeds
+that have been removed are dropped from the index.
+
+Queries use the FTS5 query syntax, so fields can be filtered with
+'field:term' (e.g. 'columns:interval_num') and results are ranked by bm25.
+Bare terms are quoted as FTS5 strings (see `fts_query`), so 'data-oasis'
+is searched for as is rather than parsed as 'data NOT oasis'.
+"""
+
+from edl.cli import feeds as clifeeds
+from edl.resources import log
+from urllib.parse import parse_qs, urlparse
+import json
+import os
+import re
+import sqlite3
+
+INDEX_DIR   = ".edc"
+INDEX_FILE  = "search.db"
+FIELDS      = ["feed", "url", "queryname", "maintainer", "company", "email",
+               "description", "comments", "tables", "columns"]
+
+def index_file(ed_path):
+    return os.path.join(ed_path, INDEX_DIR, INDEX_FILE)
+
+def connect(ed_path):
+    d = os.path.join(ed_path, INDEX_DIR)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    cnx = sqlite3.connect(index_file(ed_path))
+    cnx.execute("CREATE TABLE IF NOT EXISTS manifests (feed TEXT PRIMARY KEY, mtime INTEGER)")
+    cnx.execute("CREATE VIRTUAL TABLE IF NOT EXISTS manifest_fts USING fts5(%s)" % ", ".join(FIELDS))
+    return cnx
+
+def ddl_tables_and_columns(ddl_create):
+    """
+    Return (tables, columns) from the manifest's 'ddl_create' statements.
+    """
+    tables  = []
+    columns = []
+    for ddl in ddl_create:
+        m = re.match(r'\s*CREATE TABLE(?: IF NOT EXISTS)?\s+(\w+)\s*\((.*)\)\s*;?\s*$', ddl, re.IGNORECASE | re.DOTALL)
+        if m is None:
+            continue
+        tables.append(m.group(1))
+        for part in m.group(2).split(","):
+            word = part.strip().split(" ")[0]
+            if word and word.upper() not in ("PRIMARY", "FOREIGN", "UNIQUE", "CHECK", "CONSTRAINT"):
+                columns.append(word)
+    return (tables, sorted(set(columns)))
+
+def manifest_document(feed, manifest):
+    """
+    Map a manifest to the FIELDS of the index.
+    """
+    url     = manifest.get("url", "")
+    query   = parse_qs(urlparse(url).query).get("queryname", [""])[0]
+    (tables, columns) = ddl_tables_and_columns(manifest.get("ddl_create", []))
+    return [feed, url, query,
+            manifest.get("maintainer", ""),
+            manifest.get("company", ""),
+            manifest.get("email", ""),
+            manifest.get("description", ""),
+            manifest.get("comments", ""),
+            " ".join(tables),
+            " ".join(columns)]
+
+TOKEN       = re.compile(r'"[^"]*"\*?|\S+')
+OPERATORS   = ["AND", "OR", "NOT"]
+
+def quote(term):
+    """
+    The term as an FTS5 string, keeping a trailing '*' (prefix query).
+    """
+    prefix = term.endswith("*") and len(term) > 1
+    if prefix:
+        term = term[:-1]
+    return '"%s"%s' % (term.replace('"', '""'), "*" if prefix else "")
+
+def fts_query(query):
+    """
+    Quote the bare terms of the query as FTS5 strings, keeping the
+    operators (AND, OR, NOT), quoted phrases and the 'field:' prefix of
+    the FIELDS.
+    """
+    parts = []
+    for token in TOKEN.findall(query):
+        if token in OPERATORS or token.startswith('"'):
+            parts.append(token)
+            continue
+        (field, sep, term) = token.partition(":")
+        if sep and field in FIELDS and term:
+            parts.append("%s:%s" % (field, term if term.startswith('"') else quote(term)))
+        else:
+            parts.append(quote(token))
+    return " ".join(parts)
+
+def update(logger, ed_path, cnx, rebuild=False):
+    """
+    Re-index manifests that changed since they were last indexed. Returns
+    the number of manifests (re)indexed.
+    """
+    chlogger    = logger.getChild(__name__)
+    data_dir    = os.path.join(ed_path, "data")
+    if rebuild:
+        cnx.execute("DELETE FROM manifests")
+        cnx.execute("DELETE FROM manifest_fts")
+    indexed     = dict(cnx.execute("SELECT feed, mtime FROM manifests").fetchall())
+    found       = set()
+    count       = 0
+    with cnx:
+        for feed in clifeeds.list(chlogger, ed_path):
+            manifest = os.path.join(data_dir, feed, "manifest.json")
+            try:
+                mtime = os.stat(manifest).st_mtime_ns
+            except OSError:
+                continue
+            found.add(feed)
+            if indexed.get(feed) == mtime:
+                continue
+            try:
+                with open(manifest, 'r') as f:
+                    doc = manifest_document(feed, json.load(f))
+            except ValueError as e:
+                log.error(chlogger, {
+                    "name"      : __name__,
+                    "method"    : "update",
+                    "path"      : ed_path,
+                    "feed"      : feed,
+                    "manifest"  : manifest,
+                    "ERROR"     : "failed to parse manifest",
+                    "exception" : str(e),
+                    })
+                continue
+            cnx.execute("DELETE FROM manifest_fts WHERE feed = ?", (feed,))
+            cnx.execute("INSERT INTO manifest_fts (%s) VALUES (%s)" % (", ".join(FIELDS), ", ".join(["?"] * len(FIELDS))), doc)
+            cnx.execute("INSERT OR REPLACE INTO manifests (feed, mtime) VALUES (?, ?)", (feed, mtime))
+            count += 1
+        for feed in set(indexed.keys()) - found:
+            cnx.execute("DELETE FROM manifest_fts WHERE feed = ?", (feed,))
+            cnx.execute("DELETE FROM manifests WHERE feed = ?", (feed,))
+    log.debug(chlogger, {
+        "name"      : __name__,
+        "method"    : "update",
+        "path"      : ed_path,
+        "indexed"   : count,
+        "removed"   : len(set(indexed.keys()) - found),
+        })
+    return count
+
+def search(logger, ed_path, query, limit=50, rebuild=False):
+    """
+    Search the manifests. Yields (feed, rank) tuples, best match first.
+    Raises RuntimeError for a query FTS5 rejects.
+    """
+    chlogger = logger.getChild(__name__)
+    cnx = connect(ed_path)
+    try:
+        update(chlogger, ed_path, cnx, rebuild)
+        try:
+            rows = cnx.execute("SELECT feed, rank FROM manifest_fts WHERE manifest_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (fts_query(query), limit)).fetchall()
+        except sqlite3.OperationalError as e:
+            log.error(chlogger, {
+                "name"      : __name__,
+                "method"    : "search",
+                "path"      : ed_path,
+                "query"     : query,
+                "ERROR"     : "invalid search query",
+                "exception" : str(e),
+                })
+            raise RuntimeError("invalid search query '%s': %s" % (query, e))
+        for row in rows:
+            yield row
+    finally:
+        cnx.close()
@@ -0,0 +1,251 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+server.py : `edc serve`, a warm edc process on a local unix socket
+
+The server imports the edl and edc command modules once (every module
+`edc.main` binds lazily), then forks a child per request. The child
+inherits the loaded modules, runs the request's argv through the same
+click command tree as `edc`, and streams its output back to the client
+(see `edc.client`). Forking, rather than
+threads, keeps commands that call sys.exit, change the working directory
+or spawn stage scripts isolated from each other and from the server.
+
+At most 'workers' requests run at once. Commands on a single feed take a
+lock on the feed name: read-only commands (READ_ONLY) share the lock,
+everything else holds it exclusively.
+
+Wire format, both directions:
+
+    request     : one json line {"argv": [...], "cwd": "..."}
+    response    : frames of 1 byte channel + 4 byte big endian length +
+                  payload. Channels are 'o' (stdout), 'e' (stderr) and
+                  'x' (exit status, as ascii digits, always last)
+"""
+
+from edl.resources import log
+import fcntl
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+
+SOCKET_FILE = os.path.join(".edc", "edc.sock")
+LOCK_DIR    = os.path.join(".edc", "locks")
+CHUNK_SIZE  = 1 << 16
+HEADER      = struct.Struct(">cI")
+READ_ONLY   = ['dir', 'status', 'snapshots', 's3urls']
+
+def socket_path(ed_path):
+    return os.path.join(ed_path, SOCKET_FILE)
+
+def send_frame(sock, channel, payload):
+    sock.sendall(HEADER.pack(channel, len(payload)) + payload)
+
+def recv_exact(sock, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError("connection closed")
+        buf += chunk
+    return buf
+
+def read_request(conn):
+    buf = b''
+    while not buf.endswith(b'\n'):
+        chunk = conn.recv(CHUNK_SIZE)
+        if not chunk:
+            raise EOFError("connection closed before request")
+        buf += chunk
+    return json.loads(buf.decode('utf-8'))
+
+def command_args(argv):
+    """
+    Drop the top level options (e.g. '--ed-dir DIR') from argv.
+    """
+    args = list(argv)
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ('--ed-dir', '--log-level') and args:
+            args.pop(0)
+    return args
+
+def feed_lock(argv):
+    """
+    Return (feed, shared) for 'feed [name] [command]' argv, or None for
+    commands that do not target a single feed.
+    """
+    args = command_args(argv)
+    if len(args) < 2 or args[0] != 'feed':
+        return None
+    command = args[2] if len(args) > 2 else None
+    return (args[1], command in READ_ONLY)
+
+def _pump(fd, sock, channel, sock_lock):
+    while True:
+        data = os.read(fd, CHUNK_SIZE)
+        if not data:
+            break
+        with sock_lock:
+            send_frame(sock, channel, data)
+    os.close(fd)
+
+def run_request(ed_path, conn, cli):
+    """
+    Run one request in the forked child and return its exit status.
+    """
+    request = read_request(conn)
+    argv    = request["argv"]
+    if command_args(argv)[:1] == ['serve']:
+        send_frame(conn, b'e', b"edc serve: cannot run 'serve' through the server\n")
+        send_frame(conn, b'x', b"2")
+        return 2
+    os.chdir(request.get("cwd", ed_path))
+    lockfh  = None
+    target  = feed_lock(argv)
+    if target is not None:
+        lock_dir = os.path.join(ed_path, LOCK_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        lockfh = open(os.path.join(lock_dir, "%s.lock" % target[0]), 'w')
+        fcntl.flock(lockfh, fcntl.LOCK_SH if target[1] else fcntl.LOCK_EX)
+
+    # point fds 0, 1 and 2 at /dev/null and two pipes, so that stage
+    # scripts spawned by the command stream through the socket too
+    sock_lock   = threading.Lock()
+    pumps       = []
+    devnull     = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    for (fd, channel) in [(1, b'o'), (2, b'e')]:
+        (r, w) = os.pipe()
+        os.dup2(w, fd)
+        os.close(w)
+        t = threading.Thread(target=_pump, args=(r, conn, channel, sock_lock), daemon=True)
+        t.start()
+        pumps.append(t)
+    status = 0
+    try:
+        cli.main(args=argv, prog_name='edc')
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            sys.stderr.write("%s\n" % e.code)
+            status = 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    nul = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(nul, 1)
+    os.dup2(nul, 2)
+    os.close(nul)
+    for t in pumps:
+        t.join()
+    send_frame(conn, b'x', str(status).encode('ascii'))
+    return status
+
+def serve(logger, ed_path, path, workers):
+    """
+    Accept requests on the unix socket at 'path' until interrupted,
+    running up to 'workers' at a time.
+    """
+    chlogger = logger.getChild(__name__)
+    from edc import lazy
+    from edc.main import cli
+    for name in lazy.BOUND:
+        # touching an attribute executes the modules edc.main bound lazily
+        sys.modules[name].__file__
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            log.critical(chlogger, {
+                "name"      : __name__,
+                "method"    : "serve",
+                "path"      : ed_path,
+                "socket"    : path,
+                "ERROR"     : "a server is already listening on the socket",
+                })
+        except ConnectionRefusedError:
+            os.remove(path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # the socket runs any edc command as this user: owner only, and never
+    # reachable with looser permissions between bind and chmod
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+    server.listen(max(16, workers * 4))
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "serve",
+        "path"      : ed_path,
+        "socket"    : path,
+        "workers"   : workers,
+        "pid"       : os.getpid(),
+        })
+    children = set()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            while len(children) >= workers:
+                (pid, _) = os.wait()
+                children.discard(pid)
+            (conn, _) = server.accept()
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                server.close()
+                status = 1
+                try:
+                    status = run_request(ed_path, conn, cli)
+                finally:
+                    conn.close()
+                    os._exit(status if 0 <= status < 256 else 1)
+            conn.close()
+            children.add(pid)
+            while children:
+                (done, _) = os.waitpid(-1, os.WNOHANG)
+                if done == 0:
+                    break
+                children.discard(done)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        log.info(chlogger, {
+            "name"      : __name__,
+            "method"    : "serve",
+            "path"      : ed_path,
+            "socket"    : path,
+            "message"   : "stopped",
+            })
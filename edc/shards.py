@@ -0,0 +1,178 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+shards.py : time-partitioned feed databases
+
+With 'shard' set to 'month' or 'year' in the manifest, the insert stage
+writes each file to the database of its period instead of one ever
+growing '[name]_00.db':
+
+    20190901_20190902_....sql   -> db/[name]_201909_00.db   (month)
+                                -> db/[name]_2019_00.db     (year)
+
+The period is the first date (YYYYMMDD) in the file name, which the
+OASIS zip, xml and sql names all start from. Files without a date go to
+'[name]_00.db', as do all the rows inserted before sharding was turned
+on. A file that fails against a shard is retried on the next depth of the
+same shard ('[name]_201909_01.db'), as without sharding.
+
+Only the current shard changes when a day is added, so 'dist' only
+recompresses that shard, and 's3archive' and 's3restore' only transfer
+it (see `edc.codec.dist`). 'arch' is then run by edc too, since the
+feed's ./src script deletes the ./dist that the next dist builds on.
+
+'[name].attach.sql' in the db directory attaches every shard and creates
+a TEMP view per table over all of them, for the sqlite3 shell:
+
+    $ cd [feed]/db && sqlite3 -init [name].attach.sql
+
+'edc query' builds the same views on the fly.
+"""
+
+from edl.resources import filesystem
+from edl.resources import db as edldb
+from edl.resources import log
+from edc import query as edcquery
+import json
+import os
+import re
+import sqlite3
+
+SCHEMES         = ['month', 'year']
+DATE_PATTERN    = re.compile(r'((?:19|20)\d{2})(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])')
+
+def scheme(feed, ed_path):
+    """
+    The manifest's 'shard' scheme, or None when the feed is not sharded.
+    """
+    with open(os.path.join(ed_path, 'data', feed, 'manifest.json'), 'r') as f:
+        value = json.load(f).get('shard')
+    return value if value in SCHEMES else None
+
+def shard_key(filename, scheme):
+    """
+    'YYYYMM' (month) or 'YYYY' (year) of the first date in filename, or
+    None when there is no scheme or no date.
+    """
+    if scheme is None:
+        return None
+    m = DATE_PATTERN.search(os.path.basename(filename))
+    if m is None:
+        return None
+    return m.group(1) + m.group(2) if scheme == 'month' else m.group(1)
+
+def db_name(resource_name, key, depth=0):
+    if key is None:
+        return edldb.gen_db_name(resource_name, depth)
+    return edldb.gen_db_name("%s_%s" % (resource_name, key), depth)
+
+def attach_file(resource_name):
+    return "%s.attach.sql" % resource_name
+
+def attach_script(db_dir, resource_name):
+    """
+    The statements attaching the databases in db_dir (by file name,
+    relative to db_dir) and creating the union views over them. Each
+    database's tables are read on a connection of its own, so there may be
+    more of them than sqlite can attach at once.
+    """
+    dbs         = sorted(filesystem.glob_dir(db_dir, ".db"))
+    statements  = []
+    found       = {}
+    for (idx, f) in enumerate(dbs):
+        schema = "db%d" % idx
+        statements.append("ATTACH DATABASE %s AS %s;" % (edcquery.quote_str(f), schema))
+        # immutable: a read-only reader would leave -wal and -shm files
+        # behind the WAL mode shards
+        cnx = sqlite3.connect("%s&immutable=1" % edcquery.ro_uri(os.path.join(db_dir, f)), uri=True)
+        try:
+            for (table, columns) in edcquery.tables(cnx, 'main').items():
+                found.setdefault(table, []).append((schema, resource_name, columns))
+        finally:
+            cnx.close()
+    statements.extend(["%s;" % sql for (_, sql, _) in edcquery.view_statements(found)])
+    cnx = edcquery.connect()
+    try:
+        limit = edcquery.attach_limit(cnx)
+    finally:
+        cnx.close()
+    return (statements, len(dbs), limit)
+
+def write_attach_script(logger, feed, ed_path):
+    """
+    (Re)write '[name].attach.sql' in the feed's db directory. Returns its
+    path.
+    """
+    chlogger        = logger.getChild(__name__)
+    feed_dir        = os.path.join(ed_path, 'data', feed)
+    db_dir          = os.path.join(feed_dir, 'db')
+    with open(os.path.join(feed_dir, 'manifest.json'), 'r') as f:
+        resource_name = json.load(f)['name']
+    (statements, count, limit) = attach_script(db_dir, resource_name)
+    if count > limit:
+        log.warning(chlogger, {
+            "name"      : __name__,
+            "method"    : "write_attach_script",
+            "feed"      : feed,
+            "databases" : count,
+            "attach_limit" : limit,
+            "WARNING"   : "more shards than sqlite can attach at once, use 'edc query' or shard by year",
+            })
+    path    = os.path.join(db_dir, attach_file(resource_name))
+    tmp     = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write("-- generated by 'edc feed %s db shard', run from this directory\n" % feed)
+        for s in statements:
+            f.write("%s\n" % s)
+    os.replace(tmp, path)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "write_attach_script",
+        "feed"      : feed,
+        "databases" : count,
+        "attach_file" : path,
+        })
+    return path
+
+def refresh_attach_script(logger, feed, ed_path):
+    """
+    `write_attach_script` at the end of an insert. A failure is logged,
+    and does not fail the insert: the databases are already written.
+    """
+    try:
+        return write_attach_script(logger, feed, ed_path)
+    except Exception as e:
+        log.error(logger.getChild(__name__), {
+            "name"      : __name__,
+            "method"    : "refresh_attach_script",
+            "feed"      : feed,
+            "ERROR"     : "failed to write the attach script, run 'edc feed %s db shard'" % feed,
+            "exception" : str(e),
+            })
+        return None
+
+def shards(feed, ed_path):
+    """
+    Yield (db file, shard key or None, size) for the feed's databases.
+    """
+    db_dir = os.path.join(ed_path, 'data', feed, 'db')
+    if not os.path.isdir(db_dir):
+        return
+    pattern = re.compile(r'_((?:19|20)\d{2}(?:\d{2})?)_\d{2}\.db$')
+    for f in sorted(filesystem.glob_dir(db_dir, ".db")):
+        m = pattern.search(f)
+        yield (f, m.group(1) if m else None, os.path.getsize(os.path.join(db_dir, f)))
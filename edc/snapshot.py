@@ -0,0 +1,253 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+snapshot.py : incremental, content-addressed feed archives
+
+Layout of the archive directory:
+
+    [archivedir]/objects/ab/abcdef...       : compressed file contents, named
+                                              by the sha256 of the contents
+    [archivedir]/snapshots/[feed]/[ts].json : snapshot manifests
+
+A snapshot manifest records its parent snapshot, the files that are new or
+changed since the parent, and the files that were removed. Objects are
+shared by every feed and snapshot in the archive directory, so a file is
+only ever stored once.
+
+Files whose size and mtime match the parent snapshot are not re-read, so
+a snapshot of a mostly unchanged feed only has to stat the tree.
+
+The feed's '.edc' directory (edc's own state, including the live
+'state.db') is not archived.
+"""
+
+from edl.resources import log
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+CHUNK_SIZE  = 1 << 20
+EXCLUDE     = ['.edc']
+
+def archive_root(ed_path, archivedir):
+    archivedir = os.path.expanduser(archivedir)
+    if archivedir.startswith("/"):
+        return archivedir
+    return os.path.join(ed_path, archivedir)
+
+def snapshots_dir(root, feed):
+    return os.path.join(root, "snapshots", feed)
+
+def object_path(root, digest):
+    return os.path.join(root, "objects", digest[:2], digest)
+
+def list_snapshots(root, feed):
+    """
+    Snapshot manifest paths for the feed, oldest first.
+    """
+    d = snapshots_dir(root, feed)
+    if not os.path.exists(d):
+        return []
+    return [os.path.join(d, f) for f in sorted(os.listdir(d)) if f.endswith(".json")]
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def resolve(manifest_path):
+    """
+    Return the full {relpath : entry} file table of a snapshot by
+    applying its chain of manifests, oldest first.
+    """
+    chain = []
+    path = manifest_path
+    while path is not None:
+        m = load_manifest(path)
+        chain.append(m)
+        path = os.path.join(os.path.dirname(manifest_path), m["parent"]) if m["parent"] else None
+    files = {}
+    for m in reversed(chain):
+        for p in m["removed"]:
+            files.pop(p, None)
+        files.update(m["changed"])
+    return files
+
+def walk(root_dir):
+    for (dirpath, dirnames, filenames) in os.walk(root_dir):
+        if dirpath == root_dir:
+            dirnames[:] = [d for d in dirnames if d not in EXCLUDE]
+        dirnames.sort()
+        for f in sorted(filenames):
+            full = os.path.join(dirpath, f)
+            if os.path.isfile(full) and not os.path.islink(full):
+                yield os.path.relpath(full, root_dir)
+
+class InFlight():
+    """
+    The digests being written by the workers of one archive, so that
+    identical files are only compressed once.
+    """
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.digests    = set()
+
+    def claim(self, digest):
+        with self.lock:
+            if digest in self.digests:
+                return False
+            self.digests.add(digest)
+            return True
+
+def store_object(root, path, inflight=None):
+    """
+    Hash the file and, if the archive does not already have it (and no
+    other worker of 'inflight' is writing it), write the compressed
+    object. Returns the sha256 hex digest.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    digest  = h.hexdigest()
+    target  = object_path(root, digest)
+    if os.path.exists(target) or (inflight is not None and not inflight.claim(digest)):
+        return digest
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    (fd, tmp) = tempfile.mkstemp(prefix="%s." % digest, suffix=".tmp", dir=os.path.dirname(target))
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.chmod(tmp, 0o644)
+        if os.path.exists(target):
+            os.remove(tmp)
+        else:
+            os.replace(tmp, target)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return digest
+
+def archive(logger, feed, ed_path, archivedir, workers):
+    """
+    Write a snapshot of the feed, storing only new or changed files.
+    Files are hashed and compressed on a pool of 'workers' threads.
+    Returns the path of the new snapshot manifest.
+    """
+    chlogger    = logger.getChild(__name__)
+    root        = archive_root(ed_path, archivedir)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    previous    = list_snapshots(root, feed)
+    parent      = previous[-1] if previous else None
+    known       = resolve(parent) if parent else {}
+
+    changed     = {}
+    pending     = []
+    for rel in walk(feed_dir):
+        st      = os.stat(os.path.join(feed_dir, rel))
+        entry   = {"size": st.st_size, "mtime": st.st_mtime_ns, "mode": st.st_mode & 0o7777}
+        old     = known.get(rel)
+        if old is not None and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+            if old["mode"] != entry["mode"]:
+                entry["sha256"] = old["sha256"]
+                changed[rel] = entry
+            continue
+        pending.append((rel, entry))
+
+    inflight    = InFlight()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        digests = pool.map(lambda re: store_object(root, os.path.join(feed_dir, re[0]), inflight), pending)
+        for ((rel, entry), digest) in zip(pending, digests):
+            if rel in known and known[rel]["sha256"] == digest and known[rel]["mode"] == entry["mode"]:
+                continue
+            entry["sha256"] = digest
+            changed[rel] = entry
+
+    current = set(walk(feed_dir))
+    removed = sorted([rel for rel in known.keys() if rel not in current])
+    stamp   = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+    manifest = {
+            "feed"      : feed,
+            "created"   : stamp,
+            "parent"    : os.path.basename(parent) if parent else None,
+            "changed"   : changed,
+            "removed"   : removed,
+            }
+    os.makedirs(snapshots_dir(root, feed), exist_ok=True)
+    path = os.path.join(snapshots_dir(root, feed), "%s.json" % stamp)
+    with open("%s.tmp" % path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace("%s.tmp" % path, path)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "archive",
+        "path"      : ed_path,
+        "feed"      : feed,
+        "snapshot"  : path,
+        "parent"    : manifest["parent"],
+        "changed"   : len(changed),
+        "removed"   : len(removed),
+        })
+    return path
+
+def restore_object(root, digest, target, entry):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with gzip.open(object_path(root, digest), 'rb') as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.chmod(target, entry["mode"])
+    os.utime(target, ns=(entry["mtime"], entry["mtime"]))
+
+def restore(logger, feed, ed_path, manifest_path, workers):
+    """
+    Rebuild the feed directory from a snapshot manifest. Like
+    `clifeed.restore_locally`, the feed directory must not exist.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    root        = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(manifest_path))))
+    if os.path.exists(feed_dir):
+        log.critical(chlogger, {
+            "name"      : __name__,
+            "method"    : "restore",
+            "path"      : ed_path,
+            "feed"      : feed,
+            "snapshot"  : manifest_path,
+            "feed_dir"  : feed_dir,
+            "ERROR"     : "Must delete the feed_dir before restoring."
+            })
+    files = resolve(manifest_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(lambda item: restore_object(root, item[1]["sha256"], os.path.join(feed_dir, item[0]), item[1]),
+            files.items()))
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "restore",
+        "path"      : ed_path,
+        "feed"      : feed,
+        "snapshot"  : manifest_path,
+        "files"     : len(files),
+        })
+    return feed_dir
@@ -0,0 +1,279 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+stages.py : in-process implementations of the per-file feed stages
+
+The feed's ./src scripts process one file at a time. The stages here do the
+same work as '20_unzp.py' and '30_pars.py', but fan the files out over a
+process pool. Only the parent process records to the state store (see
+`edc.statestore`), each resource as soon as its worker completes, so an
+interrupted run resumes where it left off.
+
+With extract=False the unzip stage does not write the xml to disk. It
+records each xml member in './xml/members.txt' instead (zip file, local
+header offset, compression method, sizes and crc), and the parse stage
+reads the member straight out of the memory-mapped zip file. The xml
+state file still lists the zip files, as it does after an extracting
+unzip.
+"""
+
+from edl.cli import feed as clifeed
+from edl.resources import filesystem
+from edl.resources import log
+from edl.resources import xmlparser
+from edl.resources import zp
+from edc import statestore
+import concurrent.futures
+import io
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import traceback
+import zipfile
+import zlib
+
+PARALLEL_STAGES = ['unzip', 'parse']
+MEMBERS_FILE    = 'members.txt'
+LOCAL_HEADER    = struct.Struct("<4sHHHHHIIIHH")
+
+def manifest(feed, ed_path):
+    with open(os.path.join(ed_path, 'data', feed, 'manifest.json'), 'r') as f:
+        return json.load(f)
+
+def stage_config(feed, ed_path, stage):
+    """
+    Return (source_dir, working_dir, state_file, ending) for the stage,
+    following the layout used by the feed's ./src scripts.
+    """
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    idx         = clifeed.STAGES.index(stage)
+    source_dir  = os.path.join(feed_dir, clifeed.DIRS[idx - 1])
+    working_dir = os.path.join(feed_dir, clifeed.DIRS[idx])
+    state_file  = os.path.join(working_dir, 'state.txt')
+    ending      = ".%s" % clifeed.DIRS[idx - 1]
+    return (source_dir, working_dir, state_file, ending)
+
+def _init_worker(level):
+    log.configure_logging()
+    logging.getLogger(__name__).setLevel(level)
+
+def members_file(xml_dir):
+    return os.path.join(xml_dir, MEMBERS_FILE)
+
+def index_zip(zip_path):
+    """
+    Return the members index entries for the xml members of the zip file:
+    [member, zip file, header offset, method, compressed size, size, crc].
+    """
+    entries = []
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        for info in zf.infolist():
+            if not info.filename.endswith('.xml'):
+                continue
+            entries.append([info.filename, os.path.basename(zip_path), info.header_offset,
+                info.compress_type, info.compress_size, info.file_size, info.CRC])
+    return entries
+
+def read_members(xml_dir):
+    """
+    Load the members index as a map : member -> entry. A member that is in
+    more than one zip file maps to the last one recorded.
+    """
+    members = {}
+    if not os.path.exists(members_file(xml_dir)):
+        return members
+    with open(members_file(xml_dir), 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 7:
+                continue
+            members[fields[0]] = [fields[0], fields[1]] + [int(x) for x in fields[2:]]
+    return members
+
+def write_members(xml_dir, entries):
+    with open(members_file(xml_dir), 'a') as f:
+        for e in entries:
+            f.write("%s\n" % "\t".join([str(x) for x in e]))
+
+def read_member(zip_dir, entry):
+    """
+    Read a member's bytes straight from the memory-mapped zip file, using
+    the offset and sizes from its index entry. Members that are neither
+    stored nor deflated, or are encrypted, are read with zipfile.
+    """
+    (member, zip_file, offset, method, compress_size, file_size, crc) = entry
+    zip_path = os.path.join(zip_dir, zip_file)
+    with open(zip_path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        (sig, _, flags, _, _, _, _, _, _, name_len, extra_len) = LOCAL_HEADER.unpack_from(mm, offset)
+        if sig != b"PK\x03\x04":
+            raise zipfile.BadZipFile("bad local header for %s in %s" % (member, zip_file))
+        if flags & 0x1 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with zipfile.ZipFile(zip_path, 'r') as zf:
+                return zf.read(member)
+        start   = offset + LOCAL_HEADER.size + name_len + extra_len
+        raw     = memoryview(mm)[start:start + compress_size]
+        try:
+            data = bytes(raw) if method == zipfile.ZIP_STORED else zlib.decompress(raw, -zlib.MAX_WBITS)
+        finally:
+            raw.release()
+    if len(data) != file_size or zlib.crc32(data) != crc:
+        raise zipfile.BadZipFile("bad crc or size for %s in %s" % (member, zip_file))
+    return data
+
+def parse_member(logger, resource_name, entry, zip_dir, output_dir):
+    """
+    Like `xmlparser.parse_file`, but the xml comes from a zip member and
+    the sql file is only written once the sql checks out.
+    """
+    chlogger = logger.getChild(__name__)
+    member   = entry[0]
+    outfile  = os.path.join(output_dir, "%s.sql" % os.path.splitext(member)[0])
+    xst      = xmlparser.XML2SQLTransormer(chlogger, io.BytesIO(read_member(zip_dir, entry))).parse().scan_all()
+    sqltext  = "\n".join(list(xst.ddl()) + list(xst.insertion_sql()))
+    sqlite3.connect(":memory:").executescript(sqltext)
+    with open(outfile, 'w') as outfh:
+        outfh.write(sqltext)
+    log.info(chlogger, {
+        "src"       : resource_name,
+        "action"    : "parse_member",
+        "zip_file"  : entry[1],
+        "member"    : member,
+        "outfile"   : outfile,
+        })
+    return member
+
+def _unzip(resource_name, f, source_dir, working_dir):
+    return zp.unzip_file(f, resource_name, source_dir, working_dir)
+
+def _index(resource_name, f, source_dir, working_dir):
+    """
+    Index the zip file's xml members instead of extracting them. Returns
+    (f, entries), or ("", []) on failure like `zp.unzip_file`.
+    """
+    try:
+        return (f, index_zip(os.path.join(source_dir, f)))
+    except Exception as e:
+        logging.error({
+            "src"       : resource_name,
+            "action"    : "index_zip",
+            "file"      : f,
+            "error"     : str(e),
+            })
+        return ("", [])
+
+def _parse(resource_name, f, source_dir, working_dir, entry=None):
+    """
+    Parse the xml file f, or, when it was not extracted, the zip member
+    described by its members index 'entry'.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        if entry is not None and not os.path.exists(os.path.join(source_dir, f)):
+            zip_dir = os.path.join(os.path.dirname(source_dir), 'zip')
+            return (parse_member(logger, resource_name, entry, zip_dir, working_dir), None)
+        return (xmlparser.parse_file(logger, resource_name, f, source_dir, working_dir), None)
+    except Exception as e:
+        return (None, "%s\n%s" % (str(e), traceback.format_exc()))
+
+def has_members(feed, ed_path):
+    return os.path.exists(members_file(os.path.join(ed_path, 'data', feed, 'xml')))
+
+def parse_inputs(source_dir, done):
+    """
+    The xml files to parse: those in source_dir plus the indexed members
+    that were not extracted, less the ones in 'done'. Returns a map :
+    file -> members index entry (None for files on disk).
+    """
+    found = dict([(f, None) for f in filesystem.glob_dir(source_dir, ".xml")]) if os.path.isdir(source_dir) else {}
+    for (member, entry) in read_members(source_dir).items():
+        if member not in found:
+            found[member] = entry
+    return dict([(f, e) for (f, e) in found.items() if f not in done])
+
+def process_stage(logger, feed, ed_path, stage, workers, extract=True):
+    """
+    Run 'unzip' or 'parse' for the feed with up to 'workers' processes.
+    With extract=False, 'unzip' only indexes the xml members (see above).
+
+    Yields the name of each resource as it is recorded in the state file.
+    """
+    chlogger        = logger.getChild(__name__)
+    resource_name   = manifest(feed, ed_path)['name']
+    (source_dir, working_dir, state_file, ending) = stage_config(feed, ed_path, stage)
+    if not os.path.exists(working_dir):
+        os.makedirs(working_dir)
+    store           = statestore.StateStore(feed, ed_path)
+    entries         = {}
+    if stage == 'parse':
+        entries     = parse_inputs(source_dir, set())
+        new_files   = sorted(store.pending(stage, entries.keys(), statestore.HANDLED))
+    else:
+        new_files   = sorted(store.pending(stage, filesystem.glob_dir(source_dir, ending)))
+
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "process_stage",
+        "feed"      : feed,
+        "path"      : ed_path,
+        "stage"     : stage,
+        "workers"   : workers,
+        "extract"   : extract,
+        "source_dir": source_dir,
+        "state_file": state_file,
+        "new_files_count" : len(new_files),
+        })
+
+    level   = log.LOGGING_LEVEL_STRINGS[chlogger.getEffectiveLevel()]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+            initializer=_init_worker, initargs=(level,)) as pool, store:
+        if stage == 'parse':
+            futures = {pool.submit(_parse, resource_name, f, source_dir, working_dir, entries[f]) : f for f in new_files}
+        else:
+            func    = _unzip if extract else _index
+            futures = {pool.submit(func, resource_name, f, source_dir, working_dir) : f for f in new_files}
+        for future in concurrent.futures.as_completed(futures):
+            f = futures[future]
+            if stage == 'parse':
+                (done, error) = future.result()
+            elif extract:
+                (done, error) = (future.result(), None)
+            else:
+                (done, members) = future.result()
+                error = None
+                if done:
+                    # the index entries must be in place before the zip is
+                    # recorded as unzipped
+                    write_members(working_dir, members)
+            if done:
+                store.record(stage, [done], source_dir)
+                yield done
+                continue
+            if stage == 'parse':
+                store.record(stage, [f], source_dir, 'failed')
+            log.error(chlogger, {
+                "name"      : __name__,
+                "method"    : "process_stage",
+                "feed"      : feed,
+                "path"      : ed_path,
+                "stage"     : stage,
+                "file"      : f,
+                "ERROR"     : "failed to process file",
+                "exception" : error,
+                })
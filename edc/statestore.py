@@ -0,0 +1,384 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+statestore.py : indexed per-feed stage state
+
+The feed's ./src scripts keep the stage state in line oriented files:
+'./zip/state.txt' lists the downloaded urls, './xml/state.txt' the
+unzipped zip files, './sql/state.txt' (and './sql/failed.txt') the parsed
+xml files, './db/state.txt' the inserted sql files and './save/state.txt'
+the database files. Answering "is this file done?" from them means reading
+the whole file.
+
+edc keeps the same state in '[feed]/.edc/state.db', an sqlite database
+with one table per stage:
+
+    resource    as listed in the state file (primary key)
+    status      'done', or 'failed' for the entries of './sql/failed.txt'
+    hash        sha1 of the resource's file when it was recorded
+    size        size of the resource's file when it was recorded
+    mtime       mtime (ns) of the resource's file when it was recorded
+    recorded    when it was recorded (seconds since the epoch)
+
+The state files are still written, for the ./src scripts and edl, and
+remain the source of truth: a record is appended to the state file and
+then committed to the database. When the store is opened, the lines
+appended to the state files since the last open (by the scripts, or by a
+run that died in between) are imported, reading only the new bytes. A
+state file that was rewritten is imported in full, and one that was
+removed empties its table. The first open migrates the existing state
+files. Imported entries have no hash, size or mtime.
+
+Commands that only read the state ('status', 'proc --dry-run') open the
+store read-only: the database is used as is when it is up to date with
+the state files, and otherwise the state files are imported into an
+in-memory store, so nothing is written.
+"""
+
+from edl.cli import feed as clifeed
+from edl.resources import filesystem
+from edl.resources import log
+from edc import statusindex
+import hashlib
+import os
+import sqlite3
+import time
+import urllib.parse
+import zlib
+
+STATE_DB    = "state.db"
+TAIL_BYTES  = 64
+STAGES      = ['download', 'unzip', 'parse', 'insert', 'save']
+HANDLED     = ('done', 'failed')
+
+# (stage, state file relative to the feed directory, status of its entries)
+STATE_FILES = [
+        ('download',    'zip/state.txt',    'done'),
+        ('unzip',       'xml/state.txt',    'done'),
+        ('parse',       'sql/state.txt',    'done'),
+        ('parse',       'sql/failed.txt',   'failed'),
+        ('insert',      'db/state.txt',     'done'),
+        ('save',        'save/state.txt',   'done'),
+        ]
+
+# the stage whose table lists the files of a stage directory once they
+# have been consumed, for prune
+CONSUMED_BY = {
+        'download'  : ['unzip', 'insert'],
+        'unzip'     : ['parse'],
+        'parse'     : ['insert'],
+        }
+
+PRAGMAS = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=30000",
+        ]
+
+def state_db(feed, ed_path):
+    return os.path.join(statusindex.sidecar_dir(feed, ed_path), STATE_DB)
+
+def state_file(feed_dir, stage, status='done'):
+    for (s, f, st) in STATE_FILES:
+        if s == stage and st == status:
+            return os.path.join(feed_dir, f)
+    raise ValueError("no state file for stage: %s, status: %s" % (stage, status))
+
+def file_stamp(path):
+    """
+    (sha1, size, mtime) of the file at path, or Nones when there is none.
+    """
+    if path is None or not os.path.isfile(path):
+        return (None, None, None)
+    st = os.stat(path)
+    h  = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return (h.hexdigest(), st.st_size, st.st_mtime_ns)
+
+def _tail_crc(fh, offset):
+    start = max(0, offset - TAIL_BYTES)
+    fh.seek(start)
+    return zlib.crc32(fh.read(offset - start))
+
+def append_lines(path, lines):
+    """
+    Append the lines to a state file. A partial last line, left by a
+    writer that died, is terminated first so it does not swallow the
+    first new line.
+    """
+    prefix = ""
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                prefix = "\n"
+    with open(path, 'a') as f:
+        f.write(prefix + "".join(["%s\n" % l for l in lines]))
+
+def rewrite_lines(path, lines):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.writelines(["%s\n" % l for l in lines])
+    os.replace(tmp, path)
+
+class StateStore():
+    """
+    The feed's state database. Opening it brings it up to date with the
+    state files (in full with refresh=True). A store must only be used by
+    the thread that opened it. A readonly store must not record anything.
+    """
+    def __init__(self, feed, ed_path, sync=True, readonly=False, refresh=False):
+        self.feed_dir   = os.path.join(ed_path, 'data', feed)
+        if readonly:
+            self.cnx = None if refresh else self._open_readonly(state_db(feed, ed_path))
+            if self.cnx is None:
+                self.cnx = sqlite3.connect(":memory:", isolation_level=None)
+                self._create_tables()
+                self.sync()
+            return
+        os.makedirs(statusindex.sidecar_dir(feed, ed_path), exist_ok=True)
+        self.cnx        = sqlite3.connect(state_db(feed, ed_path), isolation_level=None)
+        for pragma in PRAGMAS:
+            self.cnx.execute(pragma)
+        self._create_tables()
+        if sync:
+            self.sync(refresh)
+
+    def _create_tables(self):
+        for stage in STAGES:
+            self.cnx.execute("CREATE TABLE IF NOT EXISTS \"%s\" (resource TEXT PRIMARY KEY, "
+                    "status TEXT NOT NULL, hash TEXT, size INTEGER, mtime INTEGER, recorded REAL) "
+                    "WITHOUT ROWID" % stage)
+        self.cnx.execute("CREATE TABLE IF NOT EXISTS state_files (path TEXT PRIMARY KEY, "
+                "size INTEGER, mtime INTEGER, offset INTEGER, crc INTEGER)")
+
+    def _open_readonly(self, path):
+        """
+        The database at path, opened read-only, or None when there is none
+        or it is behind the state files.
+        """
+        if not os.path.exists(path):
+            return None
+        # immutable: a read-only reader would leave -wal and -shm files
+        # behind the WAL mode database
+        cnx = sqlite3.connect("file:%s?mode=ro&immutable=1" % urllib.parse.quote(os.path.abspath(path)),
+                uri=True, isolation_level=None)
+        try:
+            stamps = dict([(p, (size, mtime)) for (p, size, mtime) in
+                cnx.execute("SELECT path, size, mtime FROM state_files")])
+            for (_, rel, _) in STATE_FILES:
+                try:
+                    st      = os.stat(os.path.join(self.feed_dir, rel))
+                    stamp   = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    stamp   = None
+                if stamps.get(rel) != stamp:
+                    cnx.close()
+                    return None
+            return cnx
+        except sqlite3.Error:
+            cnx.close()
+            return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.cnx.close()
+
+    def sync(self, refresh=False):
+        """
+        Import the changes to the state files. With refresh==True every
+        state file is imported in full.
+        """
+        for (stage, rel, status) in STATE_FILES:
+            self._sync_file(stage, rel, status, refresh)
+
+    def _sync_file(self, stage, rel, status, refresh):
+        path    = os.path.join(self.feed_dir, rel)
+        entry   = self.cnx.execute("SELECT size, mtime, offset, crc FROM state_files WHERE path=?", (rel,)).fetchone()
+        try:
+            st  = os.stat(path)
+        except OSError:
+            st  = None
+        if st is None:
+            if entry is not None or self.count(stage, status) > 0:
+                self.cnx.execute("BEGIN IMMEDIATE")
+                self.cnx.execute("DELETE FROM \"%s\" WHERE status=?" % stage, (status,))
+                self.cnx.execute("DELETE FROM state_files WHERE path=?", (rel,))
+                self.cnx.execute("COMMIT")
+            return
+        if not refresh and entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return
+        with open(path, 'rb') as fh:
+            offset = 0
+            if not refresh and entry is not None and 0 < entry[2] <= st.st_size \
+                    and _tail_crc(fh, entry[2]) == entry[3]:
+                offset = entry[2]
+            fh.seek(offset)
+            data    = fh.read(st.st_size - offset)
+            # a partial last line is imported once it is complete
+            end     = data.rfind(b'\n') + 1
+            crc     = _tail_crc(fh, offset + end)
+        names   = [l.strip() for l in data[:end].decode('utf-8').split('\n')]
+        names   = [n for n in names if n]
+        now     = time.time()
+        self.cnx.execute("BEGIN IMMEDIATE")
+        try:
+            if offset == 0:
+                # rewritten (or new): drop what it no longer lists
+                listed  = set(names)
+                gone    = [(r,) for (r,) in self.cnx.execute(
+                    "SELECT resource FROM \"%s\" WHERE status=?" % stage, (status,)) if r not in listed]
+                self.cnx.executemany("DELETE FROM \"%s\" WHERE resource=?" % stage, gone)
+            if status == 'done':
+                # a file that failed and was then done is done
+                self.cnx.executemany("INSERT INTO \"%s\" (resource, status, recorded) VALUES (?, ?, ?) "
+                        "ON CONFLICT(resource) DO UPDATE SET status=excluded.status WHERE status != excluded.status" % stage,
+                        [(n, status, now) for n in names])
+            else:
+                self.cnx.executemany("INSERT OR IGNORE INTO \"%s\" (resource, status, recorded) VALUES (?, ?, ?)" % stage,
+                        [(n, status, now) for n in names])
+            self.cnx.execute("INSERT OR REPLACE INTO state_files (path, size, mtime, offset, crc) VALUES (?, ?, ?, ?, ?)",
+                    (rel, st.st_size, st.st_mtime_ns, offset + end, crc))
+            self.cnx.execute("COMMIT")
+        except Exception:
+            self.cnx.execute("ROLLBACK")
+            raise
+
+    def contains(self, stage, resource, statuses=('done',)):
+        row = self.cnx.execute("SELECT status FROM \"%s\" WHERE resource=?" % stage, (resource,)).fetchone()
+        return row is not None and row[0] in statuses
+
+    def pending(self, stage, resources, statuses=('done',)):
+        """
+        The resources that are not recorded for the stage with one of the
+        statuses, in their original order.
+        """
+        return [r for r in resources if not self.contains(stage, r, statuses)]
+
+    def resources(self, stage, statuses=('done',)):
+        marks = ", ".join(["?"] * len(statuses))
+        return set([r for (r,) in self.cnx.execute(
+            "SELECT resource FROM \"%s\" WHERE status IN (%s)" % (stage, marks), tuple(statuses))])
+
+    def count(self, stage, status='done'):
+        return self.cnx.execute("SELECT count(*) FROM \"%s\" WHERE status=?" % stage, (status,)).fetchone()[0]
+
+    def record(self, stage, resources, source_dir=None, status='done', filename=None):
+        """
+        Record the resources as done (or failed) by the stage: append them
+        to the state file, then commit them with the hash, size and mtime
+        of their file in source_dir (named filename(resource), if given).
+        """
+        resources = list(resources)
+        path = state_file(self.feed_dir, stage, status)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        append_lines(path, resources)
+        self._commit(stage, resources, source_dir, status, filename)
+
+    def _commit(self, stage, resources, source_dir, status, filename):
+        rows = []
+        now  = time.time()
+        for r in resources:
+            f = None
+            if source_dir is not None:
+                f = os.path.join(source_dir, filename(r) if filename else r)
+            rows.append((r, status) + file_stamp(f) + (now,))
+        self.cnx.execute("BEGIN IMMEDIATE")
+        self.cnx.executemany("INSERT OR REPLACE INTO \"%s\" (resource, status, hash, size, mtime, recorded) "
+                "VALUES (?, ?, ?, ?, ?, ?)" % stage, rows)
+        self.cnx.execute("COMMIT")
+
+    def rewrite(self, stage, resources, source_dir=None):
+        """
+        Replace the stage's state with the resources, for the whole-feed
+        'save' state.
+        """
+        resources = list(resources)
+        path = state_file(self.feed_dir, stage)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rewrite_lines(path, resources)
+        self.cnx.execute("DELETE FROM \"%s\"" % stage)
+        self._commit(stage, resources, source_dir, 'done', None)
+
+    def forget(self, stage, resources):
+        """
+        Remove the resources from the stage's state files and table.
+        """
+        resources = set(resources)
+        if not resources:
+            return
+        for status in HANDLED:
+            try:
+                path = state_file(self.feed_dir, stage, status)
+            except ValueError:
+                continue
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                lines = [l.strip() for l in f]
+            rewrite_lines(path, [l for l in lines if l and l not in resources])
+        self.cnx.execute("BEGIN IMMEDIATE")
+        self.cnx.executemany("DELETE FROM \"%s\" WHERE resource=?" % stage, [(r,) for r in resources])
+        self.cnx.execute("COMMIT")
+
+    def clear(self, stage):
+        """
+        Forget the stage's state, after its directory was reset.
+        """
+        self.cnx.execute("BEGIN IMMEDIATE")
+        self.cnx.execute("DELETE FROM \"%s\"" % stage)
+        self.cnx.executemany("DELETE FROM state_files WHERE path=?",
+                [(rel,) for (s, rel, _) in STATE_FILES if s == stage])
+        self.cnx.execute("COMMIT")
+
+def prune(logger, feed, ed_path, stage):
+    """
+    Like `clifeed.prune`, but only removes the files of the stage
+    directory that the next stage has recorded as done, so that pruning
+    never loses work that is still pending. Returns a summary line.
+    """
+    chlogger    = logger.getChild(__name__)
+    p           = clifeed.pre_prune(logger, feed, ed_path, stage)
+    ending      = ".%s" % clifeed.STAGE_DIRS[stage]
+    removed     = 0
+    kept        = 0
+    with StateStore(feed, ed_path) as store:
+        for f in (filesystem.glob_dir(p, ending) if os.path.isdir(p) else []):
+            if any([store.contains(s, f) for s in CONSUMED_BY[stage]]):
+                os.remove(os.path.join(p, f))
+                removed += 1
+            else:
+                kept += 1
+    log.debug(chlogger, {
+        "name"      : __name__,
+        "method"    : "prune",
+        "path"      : ed_path,
+        "feed"      : feed,
+        "target_dir": p,
+        "ending"    : ending,
+        "removed"   : removed,
+        "kept"      : kept,
+        "message"   : "pruned target_dir",
+        })
+    return "%s: removed %d, kept %d not yet processed" % (p, removed, kept)
@@ -0,0 +1,170 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+statusindex.py : cached per-feed stage counts for `feed status`
+
+The stage counts are answered from the feed's state store (see
+`edc.statestore`), which only reads what was appended to the state files
+since it was last opened. The index is a small json file kept in
+'[feed]/.edc/status.json' (the leading dot keeps it out of the 'git add *'
+done by the save stage) with the counts and, per db file, the database
+row count, recomputed when the db file changes.
+"""
+
+from edl.resources import filesystem
+from edl.resources import log
+from edc import statestore
+import concurrent.futures
+import copy
+import json
+import os
+import sqlite3
+
+COLUMNS     = ["feed name","downloaded","unzipped","parsed", "inserted", "databases"]
+STAGES      = ["download", "unzip", "parse", "insert", "save"]
+INDEX_DIR   = ".edc"
+INDEX_FILE  = "status.json"
+
+def sidecar_dir(feed, ed_path):
+    """
+    Directory for edc's per-feed sidecar files.
+    """
+    return os.path.join(ed_path, 'data', feed, INDEX_DIR)
+
+def index_file(feed, ed_path):
+    return os.path.join(sidecar_dir(feed, ed_path), INDEX_FILE)
+
+def load(feed, ed_path):
+    try:
+        with open(index_file(feed, ed_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"stages": {}, "dbs": {}}
+
+def save(feed, ed_path, index):
+    d = sidecar_dir(feed, ed_path)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    tmp = "%s.%d.tmp" % (index_file(feed, ed_path), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(tmp, index_file(feed, ed_path))
+
+def count_rows(db_path):
+    """
+    Total number of rows across all tables in the database.
+    """
+    cnx = sqlite3.connect("file:%s?mode=ro" % db_path, uri=True)
+    try:
+        tables = [r[0] for r in cnx.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        return sum([cnx.execute("SELECT count(*) FROM \"%s\"" % t).fetchone()[0] for t in tables])
+    finally:
+        cnx.close()
+
+def update(logger, feed, ed_path, refresh=False, rows=False, readonly=False):
+    """
+    Bring the feed's index up to date and return it. With refresh==True
+    the cached entries are ignored and everything is rescanned. With
+    readonly==True the state store is opened read-only and the index is
+    not saved.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    index       = {"stages": {}, "dbs": {}} if refresh else load(feed, ed_path)
+    index.pop("files", None)
+    if os.path.exists(feed_dir):
+        with statestore.StateStore(feed, ed_path, readonly=readonly, refresh=refresh) as store:
+            index["stages"] = dict([(s, store.count(s)) for s in STAGES])
+    else:
+        index["stages"] = dict([(s, 0) for s in STAGES])
+    if rows:
+        db_dir  = os.path.join(feed_dir, 'db')
+        dbs     = {}
+        if os.path.exists(db_dir):
+            for db in sorted(filesystem.glob_dir(db_dir, ".db")):
+                st      = os.stat(os.path.join(db_dir, db))
+                entry   = index["dbs"].get(db)
+                if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+                    entry = {"size": st.st_size, "mtime": st.st_mtime_ns,
+                            "rows": count_rows(os.path.join(db_dir, db))}
+                dbs[db] = entry
+        index["dbs"] = dbs
+    if os.path.exists(feed_dir) and not readonly:
+        save(feed, ed_path, index)
+    log.debug(chlogger, {
+        "name"      : __name__,
+        "method"    : "update",
+        "path"      : ed_path,
+        "feed"      : feed,
+        "refresh"   : refresh,
+        "rows"      : rows,
+        })
+    return index
+
+def status_row(logger, feed, ed_path, refresh=False, rows=False):
+    """
+    Return the status values for the feed as a list, in COLUMNS order,
+    followed by the db row count if rows==True.
+    """
+    index   = update(logger, feed, ed_path, refresh, rows, readonly=True)
+    row     = [feed]
+    row.extend([index["stages"][s] for s in STAGES])
+    if rows:
+        row.append(sum([d["rows"] for d in index["dbs"].values()]))
+    return row
+
+def header_row(rows=False):
+    columns = copy.copy(COLUMNS)
+    if rows:
+        columns.append("rows")
+    return columns
+
+def status(logger, feed, ed_path, separator, header, refresh=False, rows=False):
+    """
+    Same output as `clifeed.status`, answered from the index. With
+    rows==True a column with the total db row count is appended.
+    """
+    chlogger    = logger.getChild(__name__)
+    target_dir  = os.path.join(ed_path, 'data', feed)
+    if not os.path.exists(target_dir):
+        log.critical(chlogger, {
+            "name"      : __name__,
+            "method"    : "status",
+            "path"      : ed_path,
+            "feed"      : feed,
+            "target_dir": target_dir,
+            "ERROR"     : "target_dir does not exist"
+            })
+    if header:
+        yield separator.join(header_row(rows))
+    yield separator.join([str(v) for v in status_row(logger, feed, ed_path, refresh, rows)])
+
+def all_status(logger, ed_path, feeds, jobs, refresh=False, rows=False):
+    """
+    Status rows for many feeds, collected on a thread pool of 'jobs'
+    threads. Rows are returned in the order of 'feeds'.
+    """
+    chlogger = logger.getChild(__name__)
+    log.debug(chlogger, {
+        "name"      : __name__,
+        "method"    : "all_status",
+        "path"      : ed_path,
+        "feeds"     : len(feeds),
+        "jobs"      : jobs,
+        })
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return list(pool.map(lambda feed: status_row(logger, feed, ed_path, refresh, rows), feeds))
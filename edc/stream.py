@@ -0,0 +1,326 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+stream.py : stream zip members straight into the feed database
+
+This replaces the unzip -> parse -> insert stages with a single pass. XML is
+read directly from the zip member with an incremental parser, and rows are
+written with executemany in batches, one transaction per zip file.
+
+The tables match the ones generated by `xmlparser.XML2SQLTransormer`:
+
+    * an element with child elements (or attributes) is a table row
+    * an element with only text is a column of its parent row
+    * every row has a synthetic 'id' primary key, and a '[parent]_id'
+      column referencing the row of the enclosing element
+    * the text of a row element (e.g. one with attributes and text) is
+      its 'text' column, as xmltodict's '#text'
+
+Tables and columns are created as they are discovered, so the database
+schema grows to cover optional columns instead of failing the insert.
+Tables with a natural key in the manifest are upserted (see `edc.upsert`).
+"""
+
+from edl.resources import db as edldb
+from edl.resources import filesystem
+from edl.resources import log
+from edl.resources import xmlparser
+from edc import metrics
+from edc import shards as edcshards
+from edc import statestore
+from edc import upsert as edcupsert
+from xml.etree import ElementTree
+import json
+import os
+import sqlite3
+import time
+import uuid
+import zipfile
+
+BATCH_SIZE = 10000
+
+PRAGMAS = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-65536",
+        ]
+
+STREAM_STAGES = ['unzip', 'parse', 'insert']
+# xmltodict's '#text', sanitized as by `XML2SQLTransormer.sqlite_sanitize`
+TEXT_COLUMN   = 'text'
+
+_sanitizer = xmlparser.XML2SQLTransormer(None, None)
+
+def sanitize(name):
+    """
+    Strip the namespace and sanitize like `XML2SQLTransormer.sqlite_sanitize`.
+    """
+    return _sanitizer.sqlite_sanitize(name.rsplit('}', 1)[-1])
+
+def rows(xmlfile):
+    """
+    Incrementally parse the xmlfile (a file object), yielding
+    (table, parent_table, {column : value}) for each row. Elements are
+    discarded as soon as they have been consumed.
+    """
+    stack = []
+    for (event, elem) in ElementTree.iterparse(xmlfile, events=('start', 'end')):
+        if event == 'start':
+            if stack:
+                stack[-1]['has_children'] = True
+            stack.append({
+                'name'          : sanitize(elem.tag),
+                'id'            : str(uuid.uuid4()),
+                'values'        : {},
+                'has_children'  : False,
+                'elem'          : elem,
+                })
+            continue
+        frame   = stack.pop()
+        parent  = stack[-1] if stack else None
+        if frame['has_children'] or elem.attrib or parent is None:
+            values = frame['values']
+            for (k, v) in elem.attrib.items():
+                values[sanitize(k)] = v
+            text = elem.text.strip() if elem.text is not None else ""
+            if text:
+                values[TEXT_COLUMN] = text
+            values['id'] = frame['id']
+            if parent is not None:
+                values["%s_id" % parent['name']] = parent['id']
+            yield (frame['name'], parent['name'] if parent else None, values)
+        else:
+            text = elem.text.strip() if elem.text is not None else None
+            parent['values'][frame['name']] = "" if text is None else text
+        elem.clear()
+        if parent is not None:
+            parent['elem'].remove(elem)
+
+def sql_type(values):
+    """
+    Pick the column type for a list of values, allowing the same upgrades
+    (NULL -> anything, INTEGER -> REAL) as `XML2SQLTransormer.scan_all`.
+    """
+    SqlTypeEnum = xmlparser.SqlTypeEnum
+    result = SqlTypeEnum.NULL
+    for v in values:
+        t = SqlTypeEnum.type_of(v if v != "" else None)
+        if result == SqlTypeEnum.NULL:
+            result = t
+        elif result == SqlTypeEnum.INTEGER and t in (SqlTypeEnum.REAL, SqlTypeEnum.TEXT):
+            result = t
+        elif result == SqlTypeEnum.REAL and t == SqlTypeEnum.TEXT:
+            result = t
+    if result in (SqlTypeEnum.NULL, SqlTypeEnum.BLOB):
+        result = SqlTypeEnum.TEXT
+    return xmlparser.sql_type_str(result)
+
+def connect(db_file):
+    cnx = sqlite3.connect(db_file, isolation_level=None)
+    for pragma in PRAGMAS:
+        cnx.execute(pragma)
+    return cnx
+
+class StreamInserter():
+    """
+    Buffer rows per (table, columns) and flush them with executemany,
+    creating tables and adding columns on demand.
+    """
+    def __init__(self, logger, cnx, batch_size=BATCH_SIZE, keys=None):
+        self.logger     = logger
+        self.cnx        = cnx
+        self.batch_size = batch_size
+        self.keys       = keys or {}
+        self.schema     = {}
+        """schema : map : table name -> set of column names"""
+        self.parents    = {}
+        """parents : map : table name -> parent table name"""
+        self.pending    = {}
+        """pending : map : (table, columns) -> list of value tuples"""
+        self.pending_count  = 0
+        self.inserted       = 0
+        for (name,) in cnx.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+            self.schema[name] = set([r[1] for r in cnx.execute("PRAGMA table_info(%s)" % name)])
+
+    def add(self, table, parent, values):
+        if table not in self.parents:
+            self.parents[table] = parent
+        columns = tuple(sorted(values.keys()))
+        self.pending.setdefault((table, columns), []).append(tuple(values[c] for c in columns))
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self.flush()
+
+    def ensure_schema(self, table, columns, batch):
+        types = dict([(c, sql_type([row[idx] for row in batch])) for (idx, c) in enumerate(columns)])
+        types['id'] = "TEXT"
+        parent = self.parents.get(table)
+        fk_column = "%s_id" % parent if parent else None
+        if fk_column:
+            types[fk_column] = "TEXT"
+        if table not in self.schema:
+            local = ["%s %s" % (c, types[c]) for c in columns if c != fk_column]
+            if fk_column:
+                local.append("%s TEXT" % fk_column)
+                local.append("FOREIGN KEY (%s) REFERENCES %s(id)" % (fk_column, parent))
+            ddl = "CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (id));" % (table, ", ".join(local))
+            self.cnx.execute(ddl)
+            self.schema[table] = set(columns)
+            log.debug(self.logger, {
+                "name"      : __name__,
+                "method"    : "StreamInserter.ensure_schema",
+                "table"     : table,
+                "ddl"       : ddl,
+                })
+            return
+        for c in columns:
+            if c not in self.schema[table]:
+                self.cnx.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, c, types[c]))
+                self.schema[table].add(c)
+                log.info(self.logger, {
+                    "name"      : __name__,
+                    "method"    : "StreamInserter.ensure_schema",
+                    "table"     : table,
+                    "column"    : c,
+                    "message"   : "added column",
+                    })
+
+    def flush(self):
+        for ((table, columns), batch) in self.pending.items():
+            self.ensure_schema(table, columns, batch)
+            sql = "%s INTO %s (%s) VALUES (%s)" % (edcupsert.verb(table, self.keys),
+                    table, ", ".join(columns), ", ".join(["?"] * len(columns)))
+            self.cnx.executemany(sql, batch)
+            self.inserted += len(batch)
+        self.pending        = {}
+        self.pending_count  = 0
+
+def xml_members(zip_path):
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        return [m for m in zf.namelist() if m.lower().endswith(".xml")]
+
+def insert_zip(logger, cnx, zip_path, batch_size=BATCH_SIZE, keys=None, indexed=None):
+    """
+    Insert every xml member of the zip file in a single transaction.
+    Returns the number of rows inserted. 'keys' are the natural keys to
+    upsert on, 'indexed' the set of tables whose natural key index is in
+    place.
+    """
+    indexed = set() if indexed is None else indexed
+    if keys:
+        edcupsert.ensure_indexes(logger, cnx, keys, indexed)
+    inserter = StreamInserter(logger, cnx, batch_size, keys)
+    cnx.execute("BEGIN")
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zf:
+            for member in zf.namelist():
+                if not member.lower().endswith(".xml"):
+                    continue
+                with zf.open(member) as xmlfile:
+                    for (table, parent, values) in rows(xmlfile):
+                        inserter.add(table, parent, values)
+        inserter.flush()
+        cnx.execute("COMMIT")
+    except Exception:
+        cnx.execute("ROLLBACK")
+        raise
+    if keys:
+        edcupsert.ensure_indexes(logger, cnx, keys, indexed)
+    return inserter.inserted
+
+def process_stream(logger, feed, ed_path, batch_size=BATCH_SIZE):
+    """
+    Stream the feed's new zip files into its database.
+
+    As each zip file is committed it is recorded for the stages it
+    replaces, under the names those stages use: the zip file for unzip,
+    its xml members for parse and their .sql names for insert, so the
+    state reads the same as after unzip, parse and insert (and those
+    stages skip it). The save state lists the database files, as the
+    insert stage does. A sharded feed's zip files go to the shard of their
+    date (see `edc.shards`). Yields the name of each zip file inserted.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    zip_dir     = os.path.join(feed_dir, 'zip')
+    db_dir      = os.path.join(feed_dir, 'db')
+    save_dir    = os.path.join(feed_dir, 'save')
+    with open(os.path.join(feed_dir, 'manifest.json'), 'r') as f:
+        resource_name = json.load(f)['name']
+    for d in [db_dir, save_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    shard       = edcshards.scheme(feed, ed_path)
+    keys        = edcupsert.keys(feed, ed_path)
+    indexed     = {}
+    db_file     = os.path.join(db_dir, edldb.gen_db_name(resource_name, 0))
+    store       = statestore.StateStore(feed, ed_path)
+    # earlier streams recorded the zip names for insert
+    new_files   = sorted(store.pending('insert', store.pending('unzip', filesystem.glob_dir(zip_dir, '.zip'))))
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "process_stream",
+        "feed"      : feed,
+        "path"      : ed_path,
+        "db_file"   : db_file,
+        "shard"     : shard,
+        "batch_size": batch_size,
+        "new_files_count" : len(new_files),
+        })
+    cnxs = {}
+    try:
+        for f in new_files:
+            name = edcshards.db_name(resource_name, edcshards.shard_key(f, shard))
+            if name not in cnxs:
+                cnxs[name]      = connect(os.path.join(db_dir, name))
+                indexed[name]   = set()
+            start = time.time()
+            try:
+                count = insert_zip(chlogger, cnxs[name], os.path.join(zip_dir, f), batch_size, keys, indexed[name])
+            except Exception as e:
+                log.error(chlogger, {
+                    "name"      : __name__,
+                    "method"    : "process_stream",
+                    "feed"      : feed,
+                    "zip_file"  : f,
+                    "ERROR"     : "failed to stream zip file into db",
+                    "exception" : str(e),
+                    })
+                continue
+            members = xml_members(os.path.join(zip_dir, f))
+            store.record('unzip', [f], zip_dir)
+            store.record('parse', members)
+            store.record('insert', ["%s.sql" % os.path.splitext(m)[0] for m in members])
+            metrics.report('insert', f, time.time() - start, count, os.path.getsize(os.path.join(zip_dir, f)))
+            log.info(chlogger, {
+                "name"      : __name__,
+                "method"    : "process_stream",
+                "feed"      : feed,
+                "zip_file"  : f,
+                "db_file"   : name,
+                "rows"      : count,
+                })
+            yield f
+    finally:
+        for cnx in cnxs.values():
+            cnx.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            cnx.close()
+        store.rewrite('save', filesystem.glob_dir(db_dir, ".db"))
+        store.close()
+        if shard is not None and cnxs:
+            edcshards.refresh_attach_script(chlogger, feed, ed_path)
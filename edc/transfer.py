@@ -0,0 +1,444 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+transfer.py : concurrent, resumable transfers between a feed and S3
+
+Objects live under 'eap/energy-dashboard/data/[feed]/' in the bucket, as
+laid out by `clifeed.archive_to_s3`. Two stores are supported:
+
+    * HttpStore : the public S3 endpoints (read only, used for restore)
+    * DirStore  : a local directory with the same layout, a stand-in for
+                  the bucket when testing or when staging to a local disk
+
+Restores download into '[target].part' and resume from its size; gzipped
+database artifacts are decompressed as they stream in, and those of the
+other codecs (see `edc.codec`) once they are downloaded. An object is
+verified against the remote size, and against its md5 when the remote
+ETag is a plain md5 (not a multipart ETag). Verified objects are recorded
+in '[feed]/.edc/s3restore.json' so later restores can skip them.
+"""
+
+from edl.cli import feed as clifeed
+from edl.resources import log
+from edl.resources.exec import runyield
+from edc import codec as edccodec
+from urllib.parse import urlparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import requests
+import shutil
+import queue
+import threading
+import zlib
+
+ENDPOINTS = {
+        'digitalocean'  : 'sfo2.digitaloceanspaces.com',
+        'wasabi'        : 's3.us-west-1.wasabisys.com'
+}
+CHUNK_SIZE      = 1 << 20
+MULTIPART_CHUNK = "64M"
+PIPELINE_DEPTH  = 16
+MD5_ETAG        = re.compile(r'^"?([0-9a-f]{32})"?$')
+RESTORE_STATE   = os.path.join(".edc", "s3restore.json")
+# the services and bandwidth limits of the feeds' './src/70_arch.py'
+ARCH_SERVICES   = [('wasabi', '500K'), ('digitalocean', '500K')]
+ARCH_CONCURRENCY = 4
+
+def s3_dir(feed):
+    return os.path.join('eap', 'energy-dashboard', 'data', feed)
+
+def md5_file(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+class HttpStore():
+    """
+    Read only access to a public bucket over https.
+    """
+    def __init__(self, service, concurrency):
+        self.base       = "https://%s" % ENDPOINTS[service]
+        self.session    = requests.Session()
+        adapter         = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+    def url(self, key):
+        return "%s/%s" % (self.base, key)
+    def stat(self, key):
+        """
+        Return (size, md5) for the object, md5 is None if unknown, or None
+        if the object does not exist.
+        """
+        r = self.session.head(self.url(key))
+        if r.status_code != 200:
+            return None
+        m = MD5_ETAG.match(r.headers.get('ETag', ''))
+        return (int(r.headers.get('Content-Length', -1)), m.group(1) if m else None)
+    def get(self, key, offset=0):
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+        r = self.session.get(self.url(key), headers=headers, stream=True)
+        if r.status_code == 200 and offset > 0:
+            raise IOError("server ignored range request for %s" % key)
+        if r.status_code not in (200, 206):
+            raise IOError("GET %s failed with status %d" % (key, r.status_code))
+        return r.iter_content(chunk_size=CHUNK_SIZE)
+    def __repr__(self):
+        return self.base
+
+class DirStore():
+    """
+    A directory laid out like the bucket.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+    def path(self, key):
+        return os.path.join(self.root, key)
+    def url(self, key):
+        return "file://%s" % self.path(key)
+    def stat(self, key):
+        p = self.path(key)
+        if not os.path.exists(p):
+            return None
+        return (os.path.getsize(p), md5_file(p))
+    def get(self, key, offset=0):
+        with open(self.path(key), 'rb') as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    def put(self, local_path, key):
+        p   = self.path(key)
+        tmp = "%s.part" % p
+        if not os.path.exists(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+        shutil.copyfile(local_path, tmp)
+        os.replace(tmp, p)
+    def __repr__(self):
+        return self.root
+
+def restore_plan(logger, feed, ed_path, service):
+    """
+    Return [(key, target)] for the feed, from the urls computed by
+    `clifeed.s3_artifact_urls`. Database artifacts ('.gz' keys) come first,
+    since they are the largest and are decompressed as they download.
+    """
+    plan = []
+    for (url, target) in clifeed.s3_artifact_urls(logger, feed, ed_path, service):
+        plan.append((urlparse(url).path.lstrip('/'), target))
+    return sorted(plan, key=lambda kt: not kt[0].endswith(".gz"))
+
+class RestoreState():
+    """
+    The objects already restored, keyed by object key, with the size and
+    md5 they had on the remote at the time.
+    """
+    def __init__(self, feed_dir):
+        self.path = os.path.join(feed_dir, RESTORE_STATE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                self.objects = json.load(f)
+        except (OSError, ValueError):
+            self.objects = {}
+    def matches(self, key, remote):
+        entry = self.objects.get(key)
+        return entry is not None and entry["size"] == remote[0] \
+                and (remote[1] is None or entry["md5"] == remote[1])
+    def record(self, key, remote):
+        with self.lock:
+            self.objects[key] = {"size": remote[0], "md5": remote[1]}
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "%s.tmp" % self.path
+            with open(tmp, 'w') as f:
+                json.dump(self.objects, f, indent=4, sort_keys=True)
+            os.replace(tmp, self.path)
+
+def verify_failed(logger, key, target, size, remote):
+    log.error(logger, {
+        "name"      : __name__,
+        "method"    : "fetch",
+        "key"       : key,
+        "target"    : target,
+        "size"      : size,
+        "remote"    : list(remote),
+        "ERROR"     : "checksum mismatch, removed partial download",
+        })
+    return 'failed'
+
+def fetch(logger, store, key, target, restored):
+    """
+    Download one object to target, resuming a previous partial download.
+    Returns one of 'skipped', 'restored', 'missing', 'failed'.
+    """
+    chlogger    = logger.getChild(__name__)
+    remote      = store.stat(key)
+    if remote is None:
+        return 'missing'
+    if os.path.exists(target) and restored.matches(key, remote):
+        return 'skipped'
+    if os.path.exists(target) and os.path.getsize(target) == remote[0] \
+            and (remote[1] is None or md5_file(target) == remote[1]):
+        restored.record(key, remote)
+        return 'skipped'
+    if not os.path.exists(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    part    = "%s.part" % target
+    offset  = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > remote[0]:
+        os.remove(part)
+        offset = 0
+    if offset < remote[0]:
+        with open(part, 'ab') as f:
+            for chunk in store.get(key, offset):
+                f.write(chunk)
+    size = os.path.getsize(part)
+    if size != remote[0] or (remote[1] is not None and md5_file(part) != remote[1]):
+        os.remove(part)
+        return verify_failed(chlogger, key, target, size, remote)
+    os.replace(part, target)
+    restored.record(key, remote)
+    return 'restored'
+
+def decompress(part, chunks):
+    """
+    Consumer half of `fetch_gz`: gunzip chunks from the queue into part,
+    until a None chunk arrives. Keeps draining the queue after an error
+    so the producer never blocks.
+    """
+    decompressor    = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    error           = None
+    with open(part, 'wb') as out:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if error is not None:
+                continue
+            try:
+                out.write(decompressor.decompress(chunk))
+            except Exception as e:
+                error = e
+        if error is None:
+            out.write(decompressor.flush())
+            if not decompressor.eof:
+                error = IOError("truncated gzip stream")
+    if error is not None:
+        raise error
+
+def fetch_gz(logger, store, key, target, restored, decompressors):
+    """
+    Download a gzipped object and decompress it to target while it
+    downloads: this thread produces chunks, and a thread from the
+    decompressors pool consumes them. The '.gz' is never written to
+    disk, so a db needs only its own size in free space. A failed
+    transfer starts over, as a gzip stream cannot be resumed.
+    """
+    chlogger    = logger.getChild(__name__)
+    remote      = store.stat(key)
+    if remote is None:
+        return 'missing'
+    if os.path.exists(target) and restored.matches(key, remote):
+        return 'skipped'
+    if not os.path.exists(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    part        = "%s.part" % target
+    chunks      = queue.Queue(maxsize=PIPELINE_DEPTH)
+    consumer    = decompressors.submit(decompress, part, chunks)
+    md5         = hashlib.md5()
+    size        = 0
+    try:
+        for chunk in store.get(key):
+            md5.update(chunk)
+            size += len(chunk)
+            chunks.put(chunk)
+    finally:
+        chunks.put(None)
+        try:
+            consumer.result()
+        except Exception:
+            os.remove(part)
+            raise
+    if size != remote[0] or (remote[1] is not None and md5.hexdigest() != remote[1]):
+        os.remove(part)
+        return verify_failed(chlogger, key, target, size, remote)
+    os.replace(part, target)
+    restored.record(key, remote)
+    return 'restored'
+
+def probe(store, key):
+    """
+    Return (key, codec) of the database artifact for the '.gz' key: 'dist'
+    names it after its codec, so try the extension of each of the CODECS.
+    """
+    stem = key[:-len(edccodec.EXTENSIONS['gzip'])]
+    for codec in edccodec.CODECS:
+        candidate = stem + edccodec.EXTENSIONS[codec]
+        if store.stat(candidate) is not None:
+            return (candidate, codec)
+    return (key, 'gzip')
+
+def fetch_compressed(logger, store, key, target, restored):
+    """
+    Download an object compressed with any of the CODECS next to target,
+    resuming like `fetch`, then decompress it to target and remove it.
+    """
+    remote      = store.stat(key)
+    if remote is None:
+        return 'missing'
+    if os.path.exists(target) and restored.matches(key, remote):
+        return 'skipped'
+    compressed  = "%s%s" % (target, os.path.splitext(key)[1])
+    result      = fetch(logger, store, key, compressed, restored)
+    if result in ['restored', 'skipped']:
+        edccodec.decompress_file(compressed, target)
+        os.remove(compressed)
+        result = 'restored'
+    return result
+
+def restore(logger, feed, ed_path, service, concurrency, store_dir=None):
+    """
+    Restore the feed's zip and db artifacts with up to 'concurrency'
+    transfers in flight, and as many db decompressions running alongside
+    them. Yields "[status] [url]" for each artifact.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    store       = DirStore(store_dir) if store_dir else HttpStore(service, concurrency)
+    plan        = restore_plan(chlogger, feed, ed_path, service)
+    restored    = RestoreState(feed_dir)
+    log.info(chlogger, {
+        "name"      : __name__,
+        "method"    : "restore",
+        "feed"      : feed,
+        "path"      : ed_path,
+        "store"     : str(store),
+        "artifacts" : len(plan),
+        "concurrency": concurrency,
+        })
+
+    def work(key, target):
+        """
+        Returns (status, key), the key of a database artifact being the
+        one of its codec.
+        """
+        try:
+            if key.endswith(".gz"):
+                (key, codec) = probe(store, key)
+                if codec == 'gzip':
+                    return (fetch_gz(chlogger, store, key, target, restored, decompressors), key)
+                return (fetch_compressed(chlogger, store, key, target, restored), key)
+            return (fetch(chlogger, store, key, target, restored), key)
+        except Exception as e:
+            log.error(chlogger, {
+                "name"      : __name__,
+                "method"    : "restore",
+                "feed"      : feed,
+                "key"       : key,
+                "target"    : target,
+                "ERROR"     : "failed to restore artifact",
+                "exception" : str(e),
+                })
+            return ('failed', key)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as decompressors, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(work, key, target) for (key, target) in plan]
+        for future in concurrent.futures.as_completed(futures):
+            (status, key) = future.result()
+            yield "%s %s" % (status, store.url(key))
+
+def archive(logger, feed, ed_path, service, concurrency, bwlimit, store_dir=None):
+    """
+    Archive the feed's dist directory.
+
+    For an S3 service this is `rclone sync`, as in `clifeed.archive_to_s3`,
+    with 'concurrency' parallel transfers, multipart uploads for large
+    files and md5 comparison, so objects that already match are skipped.
+    For a DirStore the files are copied on a thread pool, skipping files
+    whose size and md5 already match.
+    """
+    chlogger    = logger.getChild(__name__)
+    feed_dir    = os.path.join(ed_path, 'data', feed)
+    dist_dir    = os.path.join(feed_dir, 'dist')
+    for d in [dist_dir, os.path.join(dist_dir, 'zip'), os.path.join(dist_dir, 'db')]:
+        if not os.path.exists(d):
+            log.critical(chlogger, {
+                "name"      : __name__,
+                "method"    : "archive",
+                "feed"      : feed,
+                "path"      : ed_path,
+                "dist_dir"  : dist_dir,
+                "ERROR"     : "One of dist_dir|dist_dir/zip|dist_dir/db does not exist",
+                })
+    if store_dir is None:
+        cmd = "rclone sync --bwlimit=%s --no-update-modtime --checksum --transfers=%d --checkers=%d " \
+                "--s3-upload-concurrency=%d --s3-chunk-size=%s --verbose %s/dist %s:%s" % (
+                bwlimit, concurrency, concurrency * 2, concurrency, MULTIPART_CHUNK,
+                feed_dir, service, s3_dir(feed))
+        log.info(chlogger, {
+            "name"      : __name__,
+            "method"    : "archive",
+            "feed"      : feed,
+            "path"      : ed_path,
+            "service"   : service,
+            "cmd"       : cmd,
+            })
+        for output in runyield([cmd], feed_dir):
+            yield output
+        return
+
+    store = DirStore(store_dir)
+    files = []
+    for sub in ['zip', 'db']:
+        for f in sorted(os.listdir(os.path.join(dist_dir, sub))):
+            if os.path.isfile(os.path.join(dist_dir, sub, f)):
+                files.append((os.path.join(dist_dir, sub, f), "%s/%s/%s" % (s3_dir(feed), sub, f)))
+
+    def work(local_path, key):
+        remote = store.stat(key)
+        if remote is not None and remote[0] == os.path.getsize(local_path) and remote[1] == md5_file(local_path):
+            return 'skipped'
+        store.put(local_path, key)
+        if store.stat(key) != (os.path.getsize(local_path), md5_file(local_path)):
+            return 'failed'
+        return 'archived'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {pool.submit(work, local_path, key) : key for (local_path, key) in files}
+        for future in concurrent.futures.as_completed(futures):
+            yield "%s %s" % (future.result(), store.url(futures[future]))
+
+def arch(logger, feed, ed_path, concurrency=ARCH_CONCURRENCY):
+    """
+    The 'arch' stage of a feed whose ./dist edc builds (see
+    `edc.codec.edc_dist`): archive ./dist to each of ARCH_SERVICES, like
+    the feed's './src/70_arch.py', but keep ./dist, so the next dist only
+    rewrites the files whose source changed.
+    """
+    for (service, bwlimit) in ARCH_SERVICES:
+        for output in archive(logger, feed, ed_path, service, concurrency, bwlimit):
+            yield output
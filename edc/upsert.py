@@ -0,0 +1,209 @@
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+upsert.py : idempotent inserts keyed on a natural key
+
+Every row the parser generates gets a fresh uuid 'id', so inserting a
+re-parsed (revised) file adds its rows a second time. The manifest's
+'natural_key' names, per table, the columns that identify a row across
+parses:
+
+    "natural_key": {
+        "report_data": ["data_item", "interval_end_gmt", "interval_num",
+                        "interval_start_gmt", "opr_date", "resource_name"]
+    }
+
+It is enforced with a unique index (ux_[table]_natural_key), and inserts
+into those tables are 'INSERT OR REPLACE' instead of 'INSERT OR IGNORE',
+so a revised row replaces the one it revises. When the index is added to
+a database that already holds duplicates, the last inserted row of each
+key is kept.
+
+'db createddl --save' infers the key. It only infers a key for leaf
+tables, which no other table references, because a replaced row gets the
+new parse's id. The key is the columns other than 'id', the parent id and
+the manifest's 'pk_exclusion' (the measured 'value'), and there must be a
+time column among them. Rows with a NULL in the key never conflict.
+"""
+
+from edl.resources import log
+from edc import indexes as edcindexes
+import json
+import os
+import re
+import sqlite3
+
+KEY_FIELD   = 'natural_key'
+INSERT      = re.compile(r'^INSERT OR IGNORE INTO (\w+) ', re.MULTILINE)
+
+def index_name(table):
+    return "ux_%s_natural_key" % table
+
+def keys(feed, ed_path):
+    """
+    The manifest's 'natural_key' : map : table -> [columns], {} when the
+    feed has none.
+    """
+    with open(os.path.join(ed_path, 'data', feed, 'manifest.json'), 'r') as f:
+        value = json.load(f).get(KEY_FIELD)
+    return dict([(t, c) for (t, c) in (value or {}).items() if c])
+
+def infer(cnx, exclude):
+    """
+    Natural keys for the leaf tables of the sqlite3 connection (schema
+    'main'), leaving out the 'exclude' columns.
+    """
+    tables  = [t for (t,) in cnx.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+    parents = set()
+    fks     = {}
+    for table in tables:
+        refs = cnx.execute("PRAGMA foreign_key_list(%s)" % table).fetchall()
+        parents.update([r[2] for r in refs])
+        fks[table] = set([r[3] for r in refs])
+    result  = {}
+    for table in tables:
+        if table in parents:
+            continue
+        columns = [r[1] for r in cnx.execute("PRAGMA table_info(%s)" % table)]
+        key     = sorted([c for c in columns if c != 'id' and c not in fks[table] and c not in exclude])
+        if key and any([edcindexes.TIME_PATTERN.search(c) for c in key]):
+            result[table] = key
+    return result
+
+def infer_from_ddl(ddl, exclude):
+    cnx = sqlite3.connect(":memory:")
+    try:
+        cnx.executescript("\n".join(ddl))
+        return infer(cnx, exclude)
+    finally:
+        cnx.close()
+
+def upsert_script(script, keys):
+    """
+    Rewrite the inserts of a parsed sql file into the keyed tables as
+    'INSERT OR REPLACE'.
+    """
+    if not keys:
+        return script
+    def replace(m):
+        if m.group(1) in keys:
+            return "INSERT OR REPLACE INTO %s " % m.group(1)
+        return m.group(0)
+    return INSERT.sub(replace, script)
+
+def delete_rows(logger, script, db_path):
+    """
+    Delete the rows a parsed sql file inserted from the database at
+    db_path, by 'id', so that re-inserting a re-parsed file (whose rows
+    have new ids) does not add its parent rows a second time. Returns the
+    number of rows deleted.
+    """
+    cnx = sqlite3.connect(":memory:")
+    try:
+        cnx.executescript(script)
+        cnx.execute("ATTACH DATABASE ? AS feed", (db_path,))
+        tables  = [t for (t,) in cnx.execute("SELECT name FROM main.sqlite_master WHERE type='table'")]
+        have    = set([t for (t,) in cnx.execute("SELECT name FROM feed.sqlite_master WHERE type='table'")])
+        deleted = 0
+        cnx.execute("BEGIN")
+        for table in [t for t in tables if t in have]:
+            columns = [r[1] for r in cnx.execute("PRAGMA feed.table_info(%s)" % table)]
+            if 'id' not in columns:
+                continue
+            deleted += cnx.execute("DELETE FROM feed.%s WHERE id IN (SELECT id FROM main.%s)" % (table, table)).rowcount
+        cnx.execute("COMMIT")
+    finally:
+        cnx.close()
+    log.debug(logger, {
+        "name"      : __name__,
+        "method"    : "delete_rows",
+        "db"        : db_path,
+        "deleted"   : deleted,
+        })
+    return deleted
+
+def verb(table, keys):
+    return "INSERT OR REPLACE" if table in keys else "INSERT OR IGNORE"
+
+def ensure_indexes(logger, cnx, keys, done):
+    """
+    Create the unique index of each keyed table that exists in the
+    database with all of its key columns, and is not in 'done' (a set of
+    tables, updated). Duplicates already in the table are removed first.
+    Must not be called inside a transaction.
+    """
+    for (table, columns) in sorted(keys.items()):
+        if table in done:
+            continue
+        have = set([r[1] for r in cnx.execute("PRAGMA table_info(%s)" % table)])
+        if not have or not set(columns) <= have:
+            continue
+        name = index_name(table)
+        if cnx.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (name,)).fetchone() is None:
+            cols = ", ".join(columns)
+            cnx.execute("BEGIN")
+            try:
+                removed = cnx.execute("DELETE FROM %s WHERE rowid NOT IN (SELECT max(rowid) FROM %s GROUP BY %s)" % (
+                    table, table, cols)).rowcount
+                cnx.execute("CREATE UNIQUE INDEX %s ON %s (%s)" % (name, table, cols))
+                cnx.execute("COMMIT")
+            except Exception:
+                cnx.execute("ROLLBACK")
+                raise
+            log.info(logger, {
+                "name"      : __name__,
+                "method"    : "ensure_indexes",
+                "table"     : table,
+                "index"     : name,
+                "columns"   : columns,
+                "duplicates_removed" : removed,
+                })
+        done.add(table)
+
+def infer_keys(feed, ed_path, ddl):
+    """
+    Natural keys for the table ddl, leaving out the manifest's
+    'pk_exclusion' columns.
+    """
+    with open(os.path.join(ed_path, 'data', feed, 'manifest.json'), 'r') as f:
+        exclude = json.load(f).get('pk_exclusion') or []
+    return infer_from_ddl(ddl, exclude)
+
+def index_ddl(keys):
+    return ["CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s);" % (index_name(t), t, ", ".join(c))
+            for (t, c) in sorted(keys.items())]
+
+def save_keys(logger, feed, ed_path, keys):
+    """
+    Save the keys to the manifest's 'natural_key', unless it already has
+    one, which is kept. Returns the keys in effect.
+    """
+    manifest = os.path.join(ed_path, 'data', feed, 'manifest.json')
+    with open(manifest, 'r') as f:
+        obj = json.load(f)
+    if obj.get(KEY_FIELD):
+        log.info(logger, {
+            "name"      : __name__,
+            "method"    : "save_keys",
+            "feed"      : feed,
+            "message"   : "manifest already declares a natural key, kept",
+            })
+        return obj[KEY_FIELD]
+    obj[KEY_FIELD] = keys
+    with open(manifest, 'w') as f:
+        f.write(json.dumps(obj, indent=4, sort_keys=True))
+    return keys
@@ -153,6 +153,12 @@ setup(
             "Click",
             ],  # Optional
 
+    # Optional dependencies, installed with e.g. `pip install energy-dashboard-client[zstd]`
+    extras_require={
+            "zstd": ["zstandard"],
+            "arrow": ["pyarrow"],
+            },
+
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # `pip` to create the appropriate form of executable for the target
@@ -163,6 +169,7 @@ setup(
     entry_points={  # Optional
         'console_scripts': [
             'edc=edc.main:cli',
+            'edcc=edc.client:main',
         ],
     }
 )
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# edc : Energy Dashboard Command Line Interface
+# Copyright (C) 2019  Todd Greenwood-Geer (Enviro Software Solutions, LLC)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+oasis_standin.py : a local stand-in for the OASIS download server
+
+Serves the files in a directory over http, with Range support, and can
+misbehave like a busy upstream:
+
+    --max-concurrent N  : answer 429 (Retry-After: 1) beyond N requests
+                          in flight
+    --fail-rate F       : answer 503 to a fraction F of the requests
+    --truncate-rate F   : drop the connection half way through the body
+                          for a fraction F of the requests
+
+Any path is served as the file in the directory with the same basename,
+so a feed url like 'http://127.0.0.1:8765/x_START__END_.zip' works with
+a directory of 'x20190901_20190902.zip' style files.
+
+    $ ./oasis_standin.py --dir /tmp/zips --port 8765 --fail-rate 0.2
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import argparse
+import os
+import random
+import re
+import threading
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is 3.7+
+    daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            busy = server.max_concurrent and server.in_flight > server.max_concurrent
+        try:
+            if busy:
+                return self.reply(429, b"busy\n", {"Retry-After": "1"})
+            if random.random() < server.fail_rate:
+                return self.reply(503, b"unavailable\n")
+            path = os.path.join(server.root, os.path.basename(self.path.split('?')[0]))
+            if not os.path.isfile(path):
+                return self.reply(404, b"not found\n")
+            with open(path, 'rb') as f:
+                data = f.read()
+            m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if m:
+                offset = int(m.group(1))
+                if offset >= len(data):
+                    return self.reply(416, b"", {"Content-Range": "bytes */%d" % len(data)})
+                return self.reply(206, data[offset:], {"Content-Range": "bytes %d-%d/%d" % (offset, len(data) - 1, len(data))})
+            if random.random() < server.truncate_rate:
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data[:len(data) // 2])
+                self.close_connection = True
+                return
+            return self.reply(200, data)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def main():
+    parser = argparse.ArgumentParser(description="local stand-in for the OASIS download server")
+    parser.add_argument("--dir", required=True, help="directory of files to serve")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-concurrent", type=int, default=0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.root             = os.path.abspath(args.dir)
+    server.max_concurrent   = args.max_concurrent
+    server.fail_rate        = args.fail_rate
+    server.truncate_rate    = args.truncate_rate
+    server.in_flight        = 0
+    server.lock             = threading.Lock()
+    server.daemon_threads   = True
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
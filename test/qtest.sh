@@ -54,6 +54,7 @@ runcmd "edc --ed-dir ${EDDIR} --help"
 runcmd "edc ${PREFIX} license"
 runcmd "edc ${PREFIX} feeds"
 runcmd "edc ${PREFIX} feeds list"
+runcmd "edc ${PREFIX} --startup-profile feeds list"
 runcmd "edc ${PREFIX} feed"
 runcmd "edc ${PREFIX} feed ${TESTFEED} create -sdy 2019 -sdm 9 -sdd 1 --url=http://zwrob.com/assets/oasis_SZ_q_AS_MILEAGE_CALC_anc_type_ALL_sdt__START_T07_00-0000_edt__END_T07_00-0000_v_1.zip"
 runcmd "edc ${PREFIX} feed ${TESTFEED} manifest show"
@@ -71,7 +72,39 @@ runcmd "edc ${PREFIX} feed ${TESTFEED} reset insert --no-confirm"
 runcmd_should_fail "edc ${PREFIX} feed ${TESTFEED} reset unzip parse insert save dist --no-confirm"
 runcmd "edc ${PREFIX} feed ${TESTFEED} reset unzip parse insert dist --no-confirm"
 runcmd "edc ${PREFIX} feed ${TESTFEED} status --header"
-runcmd "edc ${PREFIX} feed ${TESTFEED} proc unzip parse insert"
+runcmd "edc ${PREFIX} feed ${TESTFEED} proc unzip parse insert --metrics"
+runcmd "edc ${PREFIX} feeds proc unzip parse insert --jobs 2 --match ${TESTFEED}"
+runcmd "edc ${PREFIX} feed ${TESTFEED} proc unzip parse --workers 2"
+runcmd "edc ${PREFIX} feed ${TESTFEED} status --refresh --rows"
+runcmd "edc ${PREFIX} query --match ${TESTFEED} --tables"
+runcmd "edc ${PREFIX} feed ${TESTFEED} db createddl --sample 3"
+runcmd "edc ${PREFIX} feed ${TESTFEED} db checkschema"
+runcmd "edc ${PREFIX} feed ${TESTFEED} db optimize"
+runcmd "edc ${PREFIX} feed ${TESTFEED} db shard"
+runcmd "edc ${PREFIX} feed ${TESTFEED} reinsert --from insert 20190901*"
+# reinserting the same file must not change the row counts
+runcmd "edc ${PREFIX} feed ${TESTFEED} status --refresh --rows"
+ROWS_BEFORE=${RESULT}
+runcmd "edc ${PREFIX} feed ${TESTFEED} reinsert *20190901*"
+runcmd "edc ${PREFIX} feed ${TESTFEED} reinsert *20190901*"
+runcmd "edc ${PREFIX} feed ${TESTFEED} status --refresh --rows"
+if [ "${RESULT}" != "${ROWS_BEFORE}" ]; then
+    echo "TEST FAILED (REINSERT CHANGED THE ROW COUNTS) !!!"
+    exit 1
+fi
+runcmd "edc ${PREFIX} feed ${TESTFEED} proc export"
+runcmd "edc ${PREFIX} feed ${TESTFEED} export"
+runcmd "edc ${PREFIX} feeds proc export --jobs 2 --match ${TESTFEED}"
+runcmd "edc ${PREFIX} feed ${TESTFEED} proc all --dry-run"
+runcmd "edc ${PREFIX} feed ${TESTFEED} proc all export --dry-run"
+runcmd "edc ${PREFIX} feed ${TESTFEED} stats"
+runcmd "edc ${PREFIX} bench --copies 2 --testdata testdata/zip"
+runcmd "edc ${PREFIX} bench --copies 1 --testdata testdata/zip --proc-args=--no-extract"
+runcmd "edc ${PREFIX} bench --copies 1 --testdata testdata/zip --archive-args=--incremental"
+runcmd "edc ${PREFIX} feeds status --format json"
+runcmd "edc ${PREFIX} feeds search maintainer:sarah"
+runcmd "edc ${PREFIX} feeds search abc-test-01"
+runcmd_should_fail "edc ${PREFIX} feeds search AND"
 runcmd "edc ${PREFIX} feed ${TESTFEED} status --header"
 runcmd_ignore_errors "edc ${PREFIX} feed ${TESTFEED} proc save"
 runcmd "edc ${PREFIX} feed ${TESTFEED} status --header"
@@ -85,4 +118,64 @@ runcmd "edc ${PREFIX} feed ${TESTFEED} status --header"
 runcmd "edc ${PREFIX} feed ${TESTFEED} prune unzip --no-confirm"
 runcmd "edc ${PREFIX} feed ${TESTFEED} status --header"
 
+# download from a local stand-in for the OASIS server that fails and
+# truncates responses: every zip must still arrive intact and be recorded
+STANDIN="$(pwd)/standin"
+rm -rf ${STANDIN}
+mkdir -p ${STANDIN}/serve ${STANDIN}/ed/data
+runcmd "edc ${PREFIX} --ed-dir ${STANDIN}/ed feed ${TESTFEED} create -sdy $(date -d '-10 days' +%Y) -sdm $(date -d '-10 days' +%-m) -sdd $(date -d '-10 days' +%-d) --url=http://127.0.0.1:8765/oasis_SZ_q_AS_MILEAGE_CALC_anc_type_ALL_sdt__START_T07_00-0000_edt__END_T07_00-0000_v_1.zip"
+python3 - ${STANDIN} ${TESTFEED} <<'PYEOF'
+# serve a test zip under the basename of each url the feed downloads
+import logging, os, shutil, sys
+from edc import download
+(standin, feed) = sys.argv[1:]
+zips = sorted(os.listdir("testdata/zip"))
+for (i, url) in enumerate(download.manifest_urls(logging.getLogger(), feed, os.path.join(standin, "ed"))):
+    shutil.copyfile(os.path.join("testdata/zip", zips[i % len(zips)]), os.path.join(standin, "serve", os.path.basename(url)))
+PYEOF
+python3 oasis_standin.py --dir ${STANDIN}/serve --port 8765 --fail-rate 0.3 --truncate-rate 0.3 &
+STANDIN_PID=$!
+sleep 1
+runcmd "edc ${PREFIX} --ed-dir ${STANDIN}/ed feed ${TESTFEED} download --concurrency 4 --max-delay 0.5 --retries 20"
+kill ${STANDIN_PID}
+python3 - ${STANDIN} ${TESTFEED} <<'PYEOF'
+import filecmp, logging, os, sys
+from edc import download
+from edl.resources import filesystem
+(standin, feed) = sys.argv[1:]
+zip_dir = os.path.join(standin, "ed", "data", feed, "zip")
+with open(os.path.join(zip_dir, "state.txt")) as f:
+    recorded = set(f.read().split())
+for url in download.manifest_urls(logging.getLogger(), feed, os.path.join(standin, "ed")):
+    got = os.path.join(zip_dir, filesystem.url2filename(url, ending=".zip"))
+    if url not in recorded or not os.path.exists(got) or \
+            not filecmp.cmp(got, os.path.join(standin, "serve", os.path.basename(url)), shallow=False):
+        sys.exit("TEST FAILED (DOWNLOAD MISSING OR CORRUPT: %s) !!!" % url)
+PYEOF
+if [ "$?" != "0" ]; then
+    exit 1
+fi
+rm -rf ${STANDIN}
+
+# local bare repos standing in for the energy-dashboard and its feed submodules
+export GIT_CONFIG_COUNT=1 GIT_CONFIG_KEY_0=protocol.file.allow GIT_CONFIG_VALUE_0=always
+REPOS="$(pwd)/repos"
+rm -rf ${REPOS}
+for r in feed-a feed-b energy-dashboard; do
+    git init -q ${REPOS}/src/${r}
+    echo ${r} > ${REPOS}/src/${r}/README
+    if [ "${r}" == "energy-dashboard" ]; then
+        git -C ${REPOS}/src/${r} submodule -q add file://${REPOS}/feed-a.git data/feed-a
+        git -C ${REPOS}/src/${r} submodule -q add file://${REPOS}/feed-b.git data/feed-b
+    fi
+    git -C ${REPOS}/src/${r} add .
+    git -C ${REPOS}/src/${r} -c user.name=qtest -c user.email=qtest@localhost commit -qm init
+    git clone -q --bare ${REPOS}/src/${r} ${REPOS}/${r}.git
+done
+mkdir ${REPOS}/node
+runcmd "edc ${PREFIX} --ed-dir ${REPOS}/node clone --url file://${REPOS}/energy-dashboard.git --depth 1 --lfs skip"
+runcmd "edc ${PREFIX} --ed-dir ${REPOS}/node/energy-dashboard update --jobs 2 --depth 1 --feeds feed-a"
+runcmd "git -C ${REPOS}/node/energy-dashboard submodule status"
+rm -rf ${REPOS}
+
 echo "QUICK TEST PASSED"